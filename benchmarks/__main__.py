@@ -0,0 +1,76 @@
+"""Run the benchmarks and compare them with a saved baseline
+
+Examples:
+
+    python -m benchmarks --save baseline.json
+    python -m benchmarks --compare baseline.json --threshold 0.2
+    python -m benchmarks --scale 0.1 --filter dispatch
+"""
+import argparse
+import json
+import sys
+
+from benchmarks.stream_bench import BENCHMARKS, LOWER_IS_BETTER_UNITS
+
+
+def run(scale, name_filter, repeat):
+    """Run each benchmark 'repeat' times and keep the best result"""
+    results = {}
+    for name, function in BENCHMARKS.items():
+        if name_filter and name_filter not in name:
+            continue
+        values = []
+        for _ in range(repeat):
+            value, unit = function(scale)
+            values.append(value)
+        value = min(values) if unit in LOWER_IS_BETTER_UNITS else max(values)
+        results[name] = {"value": value, "unit": unit}
+        print(f"{name:<32} {value:>14.1f} {unit}")
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Return the names of the benchmarks that got worse by more than 'threshold'"""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]["value"]
+        new = result["value"]
+        if result["unit"] in LOWER_IS_BETTER_UNITS:
+            change = (old - new) / old if old else 0
+        else:
+            change = (new - old) / old if old else 0
+        status = "REGRESSION" if change < -threshold else "ok"
+        print(f"{name:<32} {change:>+8.1%} {status}")
+        if change < -threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the stream, dispatch and command stack")
+    parser.add_argument("--scale", type=float, default=1.0, help="Scale factor for the problem sizes")
+    parser.add_argument("--filter", help="Only run benchmarks whose name contains this string")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs of each benchmark (default: 3)")
+    parser.add_argument("--save", metavar="PATH", help="Save the results as a JSON baseline")
+    parser.add_argument("--compare", metavar="PATH", help="Compare the results with a JSON baseline")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Relative slowdown that counts as a regression (default: 0.2)")
+    args = parser.parse_args(argv)
+    results = run(args.scale, args.filter, args.repeat)
+    if args.save:
+        with open(args.save, "wt") as f:
+            json.dump({"scale": args.scale, "results": results}, f, indent=2)
+    if args.compare:
+        with open(args.compare, "rt") as f:
+            baseline = json.load(f)
+        if baseline.get("scale") != args.scale:
+            print(f"Warning: baseline was run with scale {baseline.get('scale')}")
+        if compare(results, baseline["results"], args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,46 @@
+from contextlib import contextmanager, suppress
+from functools import partial
+
+from fw.pipe_port import pipe_port_pair
+from fw.stream import EndOfStreamError, TimeoutError
+from fw.worker_thread import worker_thread
+
+
+@contextmanager
+def fake_dut(output_lines=1, line_length=16):
+    """Run a fake command interpreter and yield the port connected to it
+
+    Every command except "fail" succeeds and outputs 'output_lines' lines of
+    'line_length' characters.
+    """
+    external_port, internal_port = pipe_port_pair()
+    output = [str(i).rjust(line_length, "x") for i in range(output_lines)]
+    with external_port, \
+         internal_port, \
+         worker_thread(worker_function=partial(_emulate_command_interpreter, internal_port, output),
+                       stop_function=internal_port.close):
+        yield external_port
+
+
+def _emulate_command_interpreter(port, output, signal_thread_ready):
+    with suppress(EndOfStreamError, TimeoutError), \
+         port.listen() as lines:
+        signal_thread_ready()
+        while True:
+            command = lines.next(timeout_seconds=None)
+            port.send(command)
+            if command == "fail":
+                port.send("ERROR")
+            else:
+                for line in output:
+                    port.send(line)
+                port.send("OK")
+            port.send("Enter command")
+
+
+def boot_log(line_count):
+    """Return a boot log of about 'line_count' lines"""
+    lines = ["Booting...", "Loading blocks..."]
+    lines += [f"Block {i} loaded" for i in range(max(0, line_count - 4))]
+    lines += ["Starting user space", "Enter secret password"]
+    return lines
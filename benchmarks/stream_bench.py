@@ -0,0 +1,170 @@
+"""Benchmarks of the stream, dispatch and command stack
+
+Each benchmark takes a scale factor (1.0 gives the full size) and returns a
+(value, unit) pair. Higher values are better for all of them except the
+memory benchmark.
+"""
+import time
+import tracemalloc
+
+from fw.command_runner import CommandRunner
+from fw.framing import LineFramer
+from fw.stream import Dispatcher, Listener
+
+from benchmarks.fake_dut import fake_dut, boot_log
+
+
+BENCHMARKS = {}
+LOWER_IS_BETTER_UNITS = {"bytes/line"}
+
+
+def benchmark(name):
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+
+def _rate(count, function):
+    start = time.perf_counter()
+    function()
+    return count / (time.perf_counter() - start)
+
+
+def _dispatch_throughput(listener_count, scale):
+    # Each line is read by every listener, so fewer lines for more listeners
+    count = max(1, int(200_000 * scale / listener_count))
+    d = Dispatcher(capacity=count)
+    listeners = [Listener(d) for _ in range(listener_count)]
+    for listener in listeners:
+        listener.__enter__()
+    try:
+        def dispatch_and_deliver_all():
+            for i in range(count):
+                d.dispatch("Block loaded")
+            for listener in listeners:
+                for i in range(count):
+                    listener.next(timeout_seconds=None)
+        return _rate(count, dispatch_and_deliver_all), "lines/s"
+    finally:
+        for listener in listeners:
+            listener.__exit__(None, None, None)
+
+
+@benchmark("dispatch[listeners=1]")
+def dispatch_1(scale):
+    return _dispatch_throughput(1, scale)
+
+
+@benchmark("dispatch[listeners=10]")
+def dispatch_10(scale):
+    return _dispatch_throughput(10, scale)
+
+
+@benchmark("dispatch[listeners=100]")
+def dispatch_100(scale):
+    return _dispatch_throughput(100, scale)
+
+
+@benchmark("skip_until[boot_log]")
+def skip_until_boot_log(scale):
+    log = boot_log(max(4, int(1_000_000 * scale)))
+    d = Dispatcher(capacity=len(log))
+    with Listener(d) as lines:
+        for line in log:
+            d.dispatch(line)
+        return _rate(len(log), lambda: lines.skip_until("Enter secret password", timeout_seconds=None)), "lines/s"
+
+
+def _command_traffic(line_count):
+    """Return the bytes of about 'line_count' lines of repetitive command traffic"""
+    exchange = b"ping\r\npong\r\nOK\r\nEnter command\r\n"
+    return exchange * max(1, line_count // 4)
+
+
+def _chunks(data, size=4096):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@benchmark("framing[command_traffic]")
+def framing_command_traffic(scale):
+    chunks = _chunks(_command_traffic(max(4, int(1_000_000 * scale))))
+    framer = LineFramer(b"\r\n")
+    count = 0
+    start = time.perf_counter()
+    for chunk in chunks:
+        count += len(framer.feed(chunk))
+    return count / (time.perf_counter() - start), "lines/s"
+
+
+@benchmark("memory_per_framed_line")
+def memory_per_framed_line(scale):
+    chunks = _chunks(_command_traffic(max(4, int(100_000 * scale))))
+    count = sum(chunk.count(b"\n") for chunk in chunks)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        framer = LineFramer(b"\r\n")
+        d = Dispatcher(capacity=count)
+        with Listener(d):
+            for chunk in chunks:
+                for line in framer.feed(chunk):
+                    d.dispatch(line)
+            after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return (after - before) / count, "bytes/line"
+
+
+def _command_throughput(output_lines, count):
+    with fake_dut(output_lines=output_lines) as port:
+        cr = CommandRunner(port)
+        def run_all():
+            for _ in range(count):
+                cr.run_command("dump")
+        return _rate(count, run_all), "commands/s"
+
+
+@benchmark("command[output=1]")
+def command_small_output(scale):
+    return _command_throughput(1, max(1, int(2_000 * scale)))
+
+
+@benchmark("command[output=1000]")
+def command_large_output(scale):
+    return _command_throughput(1000, max(1, int(50 * scale)))
+
+
+@benchmark("command_pipeline[output=1]")
+def command_pipeline(scale):
+    count = max(1, int(2_000 * scale))
+    with fake_dut(output_lines=1) as port:
+        cr = CommandRunner(port)
+        return _rate(count, lambda: cr.run_commands(["dump"] * count)), "commands/s"
+
+
+@benchmark("listener_churn")
+def listener_churn(scale):
+    count = max(1, int(100_000 * scale))
+    d = Dispatcher()
+    def churn():
+        for _ in range(count):
+            with Listener(d):
+                pass
+    return _rate(count, churn), "listeners/s"
+
+
+@benchmark("memory_per_buffered_line")
+def memory_per_buffered_line(scale):
+    count = max(1, int(100_000 * scale))
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        d = Dispatcher(capacity=count)
+        with Listener(d):
+            for i in range(count):
+                d.dispatch(f"Block {i} loaded")
+            after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return (after - before) / count, "bytes/line"
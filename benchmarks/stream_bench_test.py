@@ -0,0 +1,9 @@
+import pytest
+
+from benchmarks.stream_bench import BENCHMARKS
+
+
+@pytest.mark.parametrize("name", sorted(BENCHMARKS))
+def test_benchmark_runs(name):
+    value, unit = BENCHMARKS[name](scale=0.001)
+    assert value > 0
@@ -0,0 +1,55 @@
+from fw.command_runner import CommandError, DEFAULT_COMMAND_TIMEOUT_SECONDS, ECHO_TIMEOUT_SECONDS, END_OF_OUTPUT
+from fw.timeout import Deadline, resolve_timeout
+
+
+class AsyncCommandRunner:
+    """Run commands on the DUT through an AsyncPort
+
+    This is the asyncio counterpart of fw.command_runner.CommandRunner.
+    """
+    def __init__(self, debug_port):
+        self._debug_port = debug_port
+
+    async def run_command(self, command, timeout_seconds=DEFAULT_COMMAND_TIMEOUT_SECONDS):
+        """Send a command, collect its output lines and check that it succeeded.
+
+        Returns a list of lines
+        """
+        ok, lines = await self.try_run_command(command, timeout_seconds)
+        if ok:
+            return lines
+        else:
+            raise CommandError("Error running command: " + command)
+
+    async def try_run_command(self, command, timeout_seconds=DEFAULT_COMMAND_TIMEOUT_SECONDS):
+        """Send a command and return whether it succeeded and the lines output by the command.
+
+        Returns a (bool, lines) pair. Like for CommandRunner, 'timeout_seconds'
+        can be a number of seconds, None or a fw.timeout.Deadline, and the
+        timeout never extends past the deadline set with fw.timeout.deadline.
+        """
+        deadline = resolve_timeout(timeout_seconds)
+        async with self._debug_port.listen() as lines:
+            # Send command
+            await self._debug_port.send(command)
+            # Expect command echo
+            await lines.expect_next(command, timeout_seconds=_time_left(deadline))
+            # Read lines until end (OK or ERROR)
+            result = []
+            ok = None
+            while True:
+                line = await lines.next(timeout_seconds=deadline.time_left_now())
+                end = END_OF_OUTPUT.match(line)
+                if end is None:
+                    result.append(line)
+                else:
+                    ok = end.pattern == "OK"
+                    break
+            # Expect next prompt
+            await lines.expect_next("Enter command", timeout_seconds=_time_left(deadline))
+            return ok, result
+
+
+def _time_left(deadline):
+    """Seconds left for the echo or the prompt, which should come quickly"""
+    return Deadline(ECHO_TIMEOUT_SECONDS).earliest(deadline).time_left_now()
@@ -0,0 +1,38 @@
+from contextlib import AsyncExitStack
+
+from fw.aio_stream import AsyncDispatcher, AsyncListener
+from fw.stream import PORT_HISTORY_SIZE, PORT_HISTORY_SECONDS
+from fw.interface import AsyncPort
+
+
+def pipe_port_pair():
+    """Return a pair of async ports connected to each other
+
+    The ports are async context managers.
+    """
+    a_dispatcher = AsyncDispatcher(retention=PORT_HISTORY_SIZE, retention_seconds=PORT_HISTORY_SECONDS)
+    b_dispatcher = AsyncDispatcher(retention=PORT_HISTORY_SIZE, retention_seconds=PORT_HISTORY_SECONDS)
+    a_port = _AsyncPipePort(own_dispatcher=a_dispatcher, other_dispatcher=b_dispatcher)
+    b_port = _AsyncPipePort(own_dispatcher=b_dispatcher, other_dispatcher=a_dispatcher)
+    return a_port, b_port
+
+
+class _AsyncPipePort(AsyncPort, AsyncExitStack):
+    def __init__(self, own_dispatcher, other_dispatcher):
+        super().__init__()
+        self._own_dispatcher = own_dispatcher
+        self._other_dispatcher = other_dispatcher
+        self.callback(self._own_dispatcher.close)
+
+    def close(self):
+        self._own_dispatcher.close()
+
+    async def send(self, value):
+        self._other_dispatcher.dispatch(value)
+
+    def listen(self, since=None):
+        return AsyncListener(self._own_dispatcher, since)
+
+    @property
+    def watchers(self):
+        return self._own_dispatcher.watchers
@@ -0,0 +1,83 @@
+import asyncio
+from contextlib import AsyncExitStack
+import logging
+
+from fw.aio_stream import AsyncDispatcher, AsyncListener
+from fw.framing import LineFramer
+from fw.interface import AsyncPort
+from fw.serial_port import disable_hangup_on_close, READ_BUFFER_SIZE
+from fw.stream import PORT_HISTORY_SIZE, PORT_HISTORY_SECONDS
+
+
+class AsyncSerialPort(AsyncPort, AsyncExitStack):
+    """Line based communication using a serial port on an asyncio event loop
+
+    Instead of a background thread this port registers the file descriptor
+    of the serial device with the event loop and reads whatever has been
+    received when it becomes readable. Received bytes are split into values
+    by a framer, like in SerialPort.
+
+    This class must be created from a coroutine running on the event loop.
+    It is an async context manager.
+    """
+    def __init__(self, device, baudrate, framer=None):
+        super().__init__()
+        self._logger = logging.getLogger(__name__ + "." + self.__class__.__name__)
+        self._logger.debug("init")
+        self.callback(self._logger.debug, "close")
+
+        self._framer = framer if framer is not None else LineFramer()
+        self._read_buffer = memoryview(bytearray(READ_BUFFER_SIZE))
+        self._incoming_line_dispatcher = AsyncDispatcher(retention=PORT_HISTORY_SIZE,
+                                                         retention_seconds=PORT_HISTORY_SECONDS)
+        self.callback(self._incoming_line_dispatcher.close)
+
+        # Open port using pyserial in non-blocking mode
+        import serial
+        self._serial = serial.Serial()
+        self._serial.port = device
+        self._serial.baudrate = baudrate
+        self._serial.timeout = 0
+        self._serial.open()
+        self.callback(self._serial.close)
+        disable_hangup_on_close(self._serial.fileno())
+
+        loop = asyncio.get_running_loop()
+        fd = self._serial.fileno()
+        loop.add_reader(fd, self._receive_lines, loop, fd)
+        self.callback(loop.remove_reader, fd)
+
+    def _receive_lines(self, loop, fd):
+        try:
+            size = min(max(self._serial.in_waiting, 1), READ_BUFFER_SIZE)
+            count = self._serial.readinto(self._read_buffer[:size])
+            if not count:
+                return
+            log_lines = self._logger.isEnabledFor(logging.INFO)
+            for line in self._framer.feed(self._read_buffer[:count]):
+                if log_lines:
+                    self._logger.info(f"<== {line}")
+                self._incoming_line_dispatcher.dispatch(line)
+        except BaseException:
+            # Otherwise the loop keeps calling this for a port that fails
+            loop.remove_reader(fd)
+            raise
+
+    async def send(self, line):
+        if self._logger.isEnabledFor(logging.INFO):
+            self._logger.info(f"==> {line}")
+        self._serial.write(self._framer.encode(line))
+
+    def listen(self, since=None):
+        self._logger.debug("listen")
+        return AsyncListener(self._incoming_line_dispatcher, since)
+
+    @property
+    def watchers(self):
+        return self._incoming_line_dispatcher.watchers
+
+    async def toggle_dtr(self):
+        self._logger.debug("toggle_dtr")
+        self._serial.dtr = False
+        await asyncio.sleep(0.1)
+        self._serial.dtr = True
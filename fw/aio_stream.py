@@ -0,0 +1,149 @@
+import asyncio
+import logging
+
+from fw.matcher import as_matcher
+from fw.stream import (Dispatcher, OverflowPolicy, DEFAULT_BUFFER_CAPACITY, DEFAULT_MAX_BUFFER_CAPACITY,
+                       DEFAULT_TIMEOUT_SECONDS, END_OF_STREAM, NO_VALUE,
+                       EndOfStreamError, MatchError, TimeoutError)
+
+
+class AsyncDispatcher(Dispatcher):
+    """Dispatcher whose listeners wait on an asyncio event loop
+
+    This works like Dispatcher, but listeners are AsyncListeners that wait for
+    new values without blocking a thread. All methods must be called from
+    the thread running the event loop.
+
+    The BLOCK overflow policy is not supported, since 'dispatch' is usually
+    called from a transport callback that can not wait.
+    """
+    def __init__(self, capacity=DEFAULT_BUFFER_CAPACITY, overflow=OverflowPolicy.GROW,
+                 retention=0, retention_seconds=None, max_capacity=DEFAULT_MAX_BUFFER_CAPACITY):
+        if overflow is OverflowPolicy.BLOCK:
+            raise ValueError("AsyncDispatcher does not support OverflowPolicy.BLOCK")
+        super().__init__(capacity, overflow, retention, retention_seconds, max_capacity)
+        self._new_values = None  # Future shared by all waiting listeners
+
+    def dispatch(self, value):
+        super().dispatch(value)
+        self._wake_listeners()
+
+    def close(self):
+        super().close()
+        self._wake_listeners()
+
+    def _wake_listeners(self):
+        if self._new_values is not None:
+            self._new_values.set_result(None)
+            self._new_values = None
+
+    async def wait_for_values(self, timeout_seconds):
+        """Wait until a value is dispatched or the dispatcher is closed
+
+        Raises TimeoutError if that does not happen in time.
+        """
+        if self._new_values is None:
+            self._new_values = asyncio.get_running_loop().create_future()
+        try:
+            # Shield the shared future so that one listener timing out does
+            # not cancel it for the others
+            await asyncio.wait_for(asyncio.shield(self._new_values), timeout_seconds)
+        except asyncio.TimeoutError:
+            raise TimeoutError() from None
+
+
+class AsyncListener:
+    """Async context manager that subscribes to a stream of values from an AsyncDispatcher
+
+    This is the asyncio counterpart of fw.stream.Listener. The methods have
+    the same semantics, but must be awaited. Timeouts are measured using the
+    clock of the event loop.
+    """
+    def __init__(self, dispatcher, since=None):
+        self._logger = logging.getLogger(__name__ + "." + self.__class__.__name__)
+        self._dispatcher = dispatcher
+        self._since = since
+        self._cursor = None
+
+    async def __aenter__(self):
+        self._logger.debug("enter")
+        self._cursor = self._dispatcher.add_listener(self, self._since)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self._logger.debug("exit")
+        self._dispatcher.remove_listener(self)
+        self._cursor = None
+        return False
+
+    @property
+    def dropped(self):
+        """Number of values that were dropped before this listener read them"""
+        assert self._cursor is not None, "Listener not registered"
+        return self._cursor.dropped
+
+    @property
+    def lagged(self):
+        """Whether this listener has fallen behind and missed values"""
+        return self.dropped > 0
+
+    @property
+    def position(self):
+        """Sequence number of the next value this listener will consume"""
+        assert self._cursor is not None, "Listener not registered"
+        return self._cursor.position
+
+    def rewind(self, count):
+        """Go back 'count' values, as far as the history of the dispatcher allows"""
+        assert self._cursor is not None, "Listener not registered"
+        return self._dispatcher.rewind(self._cursor, count)
+
+    async def _next(self, timeout_seconds):
+        assert self._cursor is not None, "Listener not registered"
+        loop = asyncio.get_running_loop()
+        end_time = None if timeout_seconds is None else loop.time() + timeout_seconds
+        while True:
+            value = self._dispatcher.poll(self._cursor)
+            if value is not NO_VALUE:
+                break
+            time_left = None if end_time is None else max(0, end_time - loop.time())
+            await self._dispatcher.wait_for_values(time_left)
+        if value is END_OF_STREAM:
+            raise EndOfStreamError()
+        return value
+
+    async def next(self, timeout_seconds=DEFAULT_TIMEOUT_SECONDS):
+        """Return the next value in the stream and advance the current position"""
+        line = await self._next(timeout_seconds)
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(f"next: {line}")
+        return line
+
+    async def expect_next(self, expected, timeout_seconds=DEFAULT_TIMEOUT_SECONDS):
+        """Consume the next value in the stream and check that it matches the given pattern"""
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(f"expect_next: {expected}")
+        matcher = as_matcher(expected)
+        actual_line = await self._next(timeout_seconds)
+        match = matcher.match(actual_line)
+        if match is None:
+            raise MatchError(f'Expected "{expected}", got "{actual_line}"')
+        return match
+
+    async def skip_until(self, expected, timeout_seconds=DEFAULT_TIMEOUT_SECONDS):
+        """Consume values in the stream until one that matches the given pattern is found"""
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(f"skip_until: {expected}")
+        matcher = as_matcher(expected)
+        loop = asyncio.get_running_loop()
+        end_time = None if timeout_seconds is None else loop.time() + timeout_seconds
+        skipped = 0
+        while True:
+            time_left = None if end_time is None else max(0, end_time - loop.time())
+            line = await self._next(time_left)
+            match = matcher.match(line)
+            if match is not None:
+                self._logger.debug(f"skipped {skipped} lines")
+                return match
+            else:
+                skipped += 1
@@ -0,0 +1,91 @@
+import asyncio
+from contextlib import suppress
+
+import pytest
+
+from fw.aio_command_runner import AsyncCommandRunner
+from fw.aio_pipe_port import pipe_port_pair
+from fw.aio_stream import AsyncDispatcher, AsyncListener
+from fw.command_runner import CommandError
+from fw.stream import EndOfStreamError, TimeoutError
+from fw.timeout import Deadline, deadline
+
+
+TEST_TIMEOUT_SECONDS = 1  # Should be instant in unit tests
+
+
+def test_listeners_see_all_values():
+    async def main():
+        d = AsyncDispatcher()
+        async with AsyncListener(d) as a, AsyncListener(d) as b:
+            waiting = asyncio.ensure_future(b.skip_until("z", TEST_TIMEOUT_SECONDS))
+            await asyncio.sleep(0)
+            for value in ["x", "y", "z"]:
+                d.dispatch(value)
+            assert [await a.next(TEST_TIMEOUT_SECONDS) for _ in range(3)] == ["x", "y", "z"]
+            assert (await waiting).value == "z"
+    asyncio.run(main())
+
+
+def test_timeout_and_end_of_stream():
+    async def main():
+        d = AsyncDispatcher()
+        async with AsyncListener(d) as lines:
+            with pytest.raises(TimeoutError):
+                await lines.next(timeout_seconds=0.01)
+            d.dispatch("x")
+            d.close()
+            await lines.expect_next("x", TEST_TIMEOUT_SECONDS)
+            with pytest.raises(EndOfStreamError):
+                await lines.next(TEST_TIMEOUT_SECONDS)
+    asyncio.run(main())
+
+
+async def emulate_command_interpreter(port):
+    with suppress(EndOfStreamError, TimeoutError):
+        async with port.listen() as lines:
+            while True:
+                command = await lines.next(timeout_seconds=TEST_TIMEOUT_SECONDS)
+                await port.send(command)
+                if command == "ping":
+                    await port.send("pong")
+                    await port.send("OK")
+                elif command == "hang":
+                    await asyncio.sleep(0.05)
+                    await port.send("OK")
+                else:
+                    await port.send("ERROR")
+                await port.send("Enter command")
+
+
+def test_command_runner_over_pipe_port():
+    async def main():
+        external_port, internal_port = pipe_port_pair()
+        async with external_port, internal_port:
+            interpreter = asyncio.ensure_future(emulate_command_interpreter(internal_port))
+            await asyncio.sleep(0)
+            cr = AsyncCommandRunner(external_port)
+            assert await cr.run_command("ping", timeout_seconds=TEST_TIMEOUT_SECONDS) == ["pong"]
+            with pytest.raises(CommandError):
+                await cr.run_command("xyz", timeout_seconds=TEST_TIMEOUT_SECONDS)
+            internal_port.close()
+            await interpreter
+    asyncio.run(main())
+
+
+def test_command_runner_timeouts_like_sync_runner():
+    async def main():
+        external_port, internal_port = pipe_port_pair()
+        async with external_port, internal_port:
+            interpreter = asyncio.ensure_future(emulate_command_interpreter(internal_port))
+            await asyncio.sleep(0)
+            cr = AsyncCommandRunner(external_port)
+            assert await cr.run_command("ping", timeout_seconds=Deadline(TEST_TIMEOUT_SECONDS)) == ["pong"]
+            assert await cr.run_command("ping", timeout_seconds=None) == ["pong"]
+            async with external_port.listen() as lines:
+                with deadline(0.01), pytest.raises(TimeoutError):
+                    await cr.run_command("hang", timeout_seconds=None)
+                await lines.skip_until("Enter command", TEST_TIMEOUT_SECONDS)
+            internal_port.close()
+            await interpreter
+    asyncio.run(main())
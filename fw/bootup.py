@@ -1,72 +1,140 @@
-from contextlib import ExitStack, suppress, contextmanager
+from contextlib import ExitStack, contextmanager
 import logging
 import threading
 
-from fw.worker_thread import worker_thread
-from fw.stream import EndOfStreamError
+from fw.metrics import metrics
+from fw.timeout import Deadline, deadline, resolve_timeout
+from fw.stream import DEFAULT_TIMEOUT_SECONDS
 
 
 PASSWORD = "hunter2"
+RESTART_BANNER = "Booting..."
+RESTART_WATCHER = "restart"
 
 
-def bootup(debug_port, lines):
+def bootup(debug_port, lines, timeout_seconds=None, latency_model=None):
     """Follow the DUT through the boot process
 
     This function assumes that a boot was just triggered before running this
     function. When this function returns the DUT is ready for being used by
     CommandRunner.
+
+    If 'timeout_seconds' (a number of seconds or a fw.timeout.Deadline) is
+    given, it limits the whole boot process instead of each step separately.
+
+    If a fw.latency_model.LatencyModel is given, it records how long each
+    phase of the boot takes, and each phase gets the timeout learned for it.
     """
-    lines.skip_until("Booting...")
-    lines.skip_until("Loading blocks...")
-    lines.skip_until("Starting user space")
-    authenticate(debug_port, lines)
-    lines.expect_next("Enter command")
+    with deadline(timeout_seconds), \
+         metrics.timer("boot.total"):
+        with _boot_phase("boot.until_booting", latency_model) as phase_deadline:
+            lines.skip_until("Booting...", phase_deadline)
+        with _boot_phase("boot.until_loading_blocks", latency_model) as phase_deadline:
+            lines.skip_until("Loading blocks...", phase_deadline)
+        with _boot_phase("boot.loading_blocks", latency_model) as phase_deadline:
+            lines.skip_until("Starting user space", phase_deadline)
+        with _boot_phase("boot.authenticate", latency_model) as phase_deadline:
+            authenticate(debug_port, lines, phase_deadline)
+            lines.expect_next("Enter command", phase_deadline)
+
 
+@contextmanager
+def _boot_phase(name, latency_model):
+    """Time a boot phase, giving the Deadline for it"""
+    with metrics.timer(name):
+        if latency_model is None:
+            yield Deadline(DEFAULT_TIMEOUT_SECONDS)
+        else:
+            with latency_model.measure(name, DEFAULT_TIMEOUT_SECONDS) as phase_deadline:
+                yield phase_deadline
 
-def authenticate(debug_port, lines):
-    lines.skip_until("Enter secret password")
+
+def authenticate(debug_port, lines, timeout_seconds=DEFAULT_TIMEOUT_SECONDS):
+    """Log in, all within 'timeout_seconds' (a number of seconds or a fw.timeout.Deadline)"""
+    step_deadline = resolve_timeout(timeout_seconds)
+    lines.skip_until("Enter secret password", step_deadline)
     debug_port.send(PASSWORD)
-    lines.expect_next(PASSWORD)
-    lines.expect_next("Logged in")
+    lines.expect_next(PASSWORD, step_deadline)
+    lines.expect_next("Logged in", step_deadline)
 
 
 class RestartDetector(ExitStack):
+    """Counts restarts of the DUT, which are unexpected unless allowed
+
+    The restart banner is watched for by a forbidden watcher named
+    RESTART_WATCHER on the debug port (see fw.watchers). Restarts are thus
+    counted before any listener sees the banner, and unexpected ones are
+    violations of that watcher.
+    """
     def __init__(self, debug_port):
         super().__init__()
-        self._debug_port = debug_port
-        self._lock = threading.Lock()
-        self._restart_found = False
-        self._restarts_allowed = False
-        self.enter_context(worker_thread(self._worker_function, stop_function=debug_port.close))
-
-    def _worker_function(self, signal_thread_ready):
-        logger = logging.getLogger(__name__ + "." + self.__class__.__name__)
-        with suppress(EndOfStreamError), \
-             self._debug_port.listen() as lines:
-            signal_thread_ready()
-            while True:
-                line = lines.next()
-                if line == "Booting...":
-                    with self._lock:
-                        if self._restarts_allowed:
-                            logger.info("Found allowed restart")
-                        else:
-                            logger.error("Found unexpected restart")
-                            self._restart_found = True
+        self._logger = logging.getLogger(__name__ + "." + self.__class__.__name__)
+        self._watchers = debug_port.watchers
+        self._watchers.add(RESTART_WATCHER, RESTART_BANNER, callback=self._log_restart, forbidden=True)
+        self.callback(self._watchers.remove, RESTART_WATCHER)
+
+    def _log_restart(self, name, line):
+        self._logger.info("Found restart")
+
+    @property
+    def restart_count(self):
+        """Number of restarts seen so far, both allowed and unexpected ones"""
+        return self._watchers.match_count(RESTART_WATCHER)
 
     def check_restart_found_and_clear(self):
-        with self._lock:
-            status = self._restart_found
-            self._restart_found = False
-            return status
+        return bool(self._watchers.take_violations(RESTART_WATCHER))
 
-    @contextmanager
     def allow_restarts(self):
+        return self._watchers.allow(RESTART_WATCHER)
+
+
+class BootState:
+    """Keeps track of whether the DUT is still in the state left by bootup
+
+    The state is known to be good after a clean boot has been recorded. It
+    becomes dirty when the restart detector sees a restart, when a command
+    that changes the state of the DUT is run, or when 'invalidate' is called
+    (for example because a test failed).
+    """
+    STATE_CHANGING_COMMANDS = frozenset(["reset"])
+
+    def __init__(self, restart_detector):
+        self._logger = logging.getLogger(__name__ + "." + self.__class__.__name__)
+        self._restart_detector = restart_detector
+        self._lock = threading.Lock()
+        self._restart_count_at_boot = None
+        self._dirty_reason = "Not booted yet"  # None only after a recorded boot
+
+    def record_boot(self):
+        """Record that 'bootup' just completed successfully"""
+        with self._lock:
+            self._restart_count_at_boot = self._restart_detector.restart_count
+            self._dirty_reason = None
+
+    def invalidate(self, reason):
+        """Record that the state of the DUT is no longer known"""
+        with self._lock:
+            if self._dirty_reason is None:
+                self._logger.info(f"Boot state invalidated: {reason}")
+                self._dirty_reason = reason
+
+    def observe_command(self, command):
+        """Invalidate the state if the command changes it
+
+        Intended to be passed as 'command_observer' to CommandRunner.
+        """
+        if command in self.STATE_CHANGING_COMMANDS:
+            self.invalidate(f'Ran "{command}" command')
+
+    def dirty_reason(self):
+        """Return why the state is not known to be good, or None if it is"""
         with self._lock:
-            old = self._restarts_allowed
-            self._restarts_allowed = True
-        try:
-            yield
-        finally:
-            with self._lock:
-                self._restarts_allowed = old
+            if self._dirty_reason is not None:
+                return self._dirty_reason
+            elif self._restart_detector.restart_count != self._restart_count_at_boot:
+                return "DUT restarted"
+            else:
+                return None
+
+    def is_known_good(self):
+        return self.dirty_reason() is None
@@ -0,0 +1,39 @@
+from fw.bootup import BootState
+
+
+class FakeRestartDetector:
+    restart_count = 0
+
+
+def test_unknown_until_booted():
+    bs = BootState(FakeRestartDetector())
+    assert not bs.is_known_good()
+    bs.record_boot()
+    assert bs.is_known_good()
+
+
+def test_restart_makes_state_dirty():
+    rd = FakeRestartDetector()
+    bs = BootState(rd)
+    bs.record_boot()
+    rd.restart_count += 1
+    assert bs.dirty_reason() == "DUT restarted"
+    bs.record_boot()
+    assert bs.is_known_good()
+
+
+def test_state_changing_command_makes_state_dirty():
+    bs = BootState(FakeRestartDetector())
+    bs.record_boot()
+    bs.observe_command("ping")
+    assert bs.is_known_good()
+    bs.observe_command("reset")
+    assert not bs.is_known_good()
+
+
+def test_first_invalidation_reason_is_kept():
+    bs = BootState(FakeRestartDetector())
+    bs.record_boot()
+    bs.invalidate("Test failed")
+    bs.invalidate("Power cycle")
+    assert bs.dirty_reason() == "Test failed"
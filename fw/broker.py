@@ -0,0 +1,350 @@
+"""Share one debug port between several processes, like pytest-xdist workers
+
+A Broker runs in the process that owns the port. It publishes each received
+line into a ring buffer in shared memory and serves a Unix socket, over which
+BrokerPorts in other processes send lines and DTR toggles to the DUT. Received
+lines are not copied through the socket: the broker only writes a wake-up
+byte to it, and each BrokerPort reads the new lines from shared memory.
+
+The shared memory starts with RING_HEADER, followed by an index of (byte
+offset, length) pairs packed as RING_SLOT and the ring of line data. The
+header holds the sequence number of the next line and the total number of
+bytes written, the same two values including the line being written, and a
+closed flag. It works like a seqlock: the writer publishes the line it is
+about to write before overwriting anything, and readers check after copying
+a line that the writer has not started to overwrite it.
+
+Run "python -m fw.broker DEVICE BAUDRATE SOCKET" to serve a serial port, and
+pass --debug-port-broker=SOCKET to pytest to use it.
+"""
+from contextlib import ExitStack
+from multiprocessing import shared_memory
+import argparse
+import logging
+import os
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import threading
+
+from fw.interface import Port
+from fw.stream import (Dispatcher, Listener, EndOfStreamError,
+                       PORT_HISTORY_SIZE, PORT_HISTORY_SECONDS)
+from fw.worker_thread import worker_thread
+
+
+RING_HEADER = struct.Struct("<QQQQQ")
+RING_SLOT = struct.Struct("<QQ")
+
+DEFAULT_SLOTS = 4096
+DEFAULT_DATA_SIZE = 1 << 20
+
+_SEND = b"S"
+_TOGGLE_DTR = b"D"
+_WAKE_UP = b"\0"
+
+
+class SharedLineRing:
+    """Lines in a ring buffer in shared memory, with a single writer
+
+    The writer creates the ring with 'create'. Readers in other processes
+    attach to it by name. A reader that falls more than a whole ring behind
+    the writer skips the lines that were overwritten. Lines longer than the
+    data ring are truncated to fit.
+
+    This class is a context manager. The writer removes the shared memory
+    when it exits.
+    """
+    def __init__(self, memory, slots, owner):
+        self._logger = logging.getLogger(__name__ + "." + self.__class__.__name__)
+        self._memory = memory
+        self._buffer = memory.buf
+        self._slots = slots
+        self._data_start = RING_HEADER.size + slots * RING_SLOT.size
+        self._data_size = len(self._buffer) - self._data_start
+        self._owner = owner
+
+    @classmethod
+    def create(cls, slots=DEFAULT_SLOTS, data_size=DEFAULT_DATA_SIZE):
+        size = RING_HEADER.size + slots * RING_SLOT.size + data_size
+        memory = shared_memory.SharedMemory(create=True, size=size)
+        RING_HEADER.pack_into(memory.buf, 0, 0, 0, 0, 0, 0)
+        return cls(memory, slots, owner=True)
+
+    @classmethod
+    def attach(cls, name, slots):
+        memory = _attach_shared_memory(name)
+        return cls(memory, slots, owner=False)
+
+    @property
+    def name(self):
+        return self._memory.name
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._buffer = None
+        self._memory.close()
+        if self._owner:
+            self._memory.unlink()
+        return False
+
+    def position(self):
+        """Sequence number of the next line to be written"""
+        return RING_HEADER.unpack_from(self._buffer, 0)[0]
+
+    def is_closed(self):
+        return bool(RING_HEADER.unpack_from(self._buffer, 0)[4])
+
+    def append(self, data):
+        """Write a line (bytes). Only the creator of the ring may write."""
+        buffer = self._buffer
+        sequence, offset, _, _, closed = RING_HEADER.unpack_from(buffer, 0)
+        if len(data) > self._data_size:
+            self._logger.warning(f"Truncating a line of {len(data)} bytes to the "
+                                 f"{self._data_size} bytes of the ring")
+            data = data[:self._data_size]
+        length = len(data)
+        # Readers that copy the slot or bytes about to be overwritten see this
+        RING_HEADER.pack_into(buffer, 0, sequence, offset, sequence + 1, offset + length, closed)
+        start = offset % self._data_size
+        first = min(length, self._data_size - start)
+        buffer[self._data_start + start:self._data_start + start + first] = data[:first]
+        if first < length:
+            buffer[self._data_start:self._data_start + length - first] = data[first:]
+        RING_SLOT.pack_into(buffer, RING_HEADER.size + (sequence % self._slots) * RING_SLOT.size, offset, length)
+        # Publish the line last, so that readers never see a partial one
+        RING_HEADER.pack_into(buffer, 0, sequence + 1, offset + length, sequence + 1, offset + length, closed)
+
+    def close_stream(self):
+        sequence, offset, _, _, _ = RING_HEADER.unpack_from(self._buffer, 0)
+        RING_HEADER.pack_into(self._buffer, 0, sequence, offset, sequence, offset, 1)
+
+    def read(self, sequence):
+        """Return (line, next sequence number, number of skipped lines)
+
+        The line is None if 'sequence' has not been written yet.
+        """
+        buffer = self._buffer
+        skipped = 0
+        while True:
+            end = RING_HEADER.unpack_from(buffer, 0)[0]
+            if sequence >= end:
+                return None, sequence, skipped
+            if end - sequence > self._slots:
+                skipped += end - self._slots - sequence
+                sequence = end - self._slots
+            slot = RING_HEADER.size + (sequence % self._slots) * RING_SLOT.size
+            offset, length = RING_SLOT.unpack_from(buffer, slot)
+            start = offset % self._data_size
+            first = min(length, self._data_size - start)
+            data = bytes(buffer[self._data_start + start:self._data_start + start + first])
+            if first < length:
+                data += bytes(buffer[self._data_start:self._data_start + length - first])
+            # The writer may have started overwriting the line while it was copied
+            _, _, begun, reserved, _ = RING_HEADER.unpack_from(buffer, 0)
+            if begun - sequence <= self._slots and reserved - offset <= self._data_size:
+                return data, sequence + 1, skipped
+            skipped += 1
+            sequence += 1
+
+
+def _attach_shared_memory(name):
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching registers the memory with the resource
+        # tracker of this process, which would remove it when this process exits
+        from multiprocessing import resource_tracker
+        memory = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(memory._name, "shared_memory")
+        return memory
+
+
+class Broker(ExitStack):
+    """Serve 'port' to BrokerPorts in other processes over a Unix socket at 'address'
+
+    This class is a context manager. Exiting it ends the streams of all
+    connected BrokerPorts.
+    """
+    def __init__(self, port, address, slots=DEFAULT_SLOTS, data_size=DEFAULT_DATA_SIZE):
+        super().__init__()
+        self._logger = logging.getLogger(__name__ + "." + self.__class__.__name__)
+        self._port = port
+        self._slots = slots
+        self._clients_lock = threading.Lock()
+        self._clients = set()
+        self._lines = port.listen()  # Closed to stop the worker thread
+        self._ring = self.enter_context(SharedLineRing.create(slots, data_size))
+        self._server = _Server(address, self)
+        self.callback(os.remove, address)
+        self.callback(self._server.server_close)
+        self.callback(self._disconnect_clients)
+        self.enter_context(worker_thread(self._publish_lines, stop_function=self._lines.close))
+        self.enter_context(worker_thread(self._serve, stop_function=self._server.shutdown))
+
+    def _serve(self, signal_thread_ready):
+        signal_thread_ready()
+        self._server.serve_forever()
+
+    def _publish_lines(self, signal_thread_ready):
+        with self._lines as lines:
+            signal_thread_ready()
+            while True:
+                try:
+                    line = lines.next(timeout_seconds=None)
+                except EndOfStreamError:
+                    break
+                self._ring.append(line.encode("utf8"))
+                self._wake_up_clients()
+        self._ring.close_stream()
+        self._wake_up_clients()
+
+    def _wake_up_clients(self):
+        with self._clients_lock:
+            for client in self._clients:
+                try:
+                    client.send(_WAKE_UP, socket.MSG_DONTWAIT)
+                except BlockingIOError:
+                    pass  # Earlier wake-ups have not been read yet
+                except OSError:
+                    pass  # Client is going away
+
+    def _disconnect_clients(self):
+        self._ring.close_stream()
+        with self._clients_lock:
+            for client in self._clients:
+                client.shutdown(socket.SHUT_RDWR)
+
+    def _handle_client(self, connection, requests):
+        # Register for wake-ups before the client learns where the ring
+        # starts, so that no line goes without one
+        with self._clients_lock:
+            self._clients.add(connection)
+        self._logger.debug("client connected")
+        try:
+            connection.sendall(f"{self._ring.name} {self._slots}\n".encode("utf8"))
+            for request in requests:
+                kind, value = request[:1], request[1:].rstrip(b"\n").decode("utf8")
+                if kind == _SEND:
+                    self._port.send(value)
+                elif kind == _TOGGLE_DTR:
+                    self._port.toggle_dtr()
+                else:
+                    self._logger.warning(f"Unknown request {request!r}")
+        finally:
+            with self._clients_lock:
+                self._clients.discard(connection)
+            self._logger.debug("client disconnected")
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, address, broker):
+        self.broker = broker
+        super().__init__(address, _RequestHandler)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.broker._handle_client(self.connection, self.rfile)
+
+
+class BrokerPort(Port, ExitStack):
+    """Port to the DUT through a Broker in another process
+
+    Lines are read from the shared memory of the broker and dispatched to
+    listeners of this port, so they have the same API as for any other port.
+
+    This class is a context manager.
+    """
+    def __init__(self, address):
+        super().__init__()
+        self._logger = logging.getLogger(__name__ + "." + self.__class__.__name__)
+        self._send_lock = threading.Lock()
+        self._socket = self.enter_context(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+        self._socket.connect(address)
+        # Wake-ups read along with the first line can be dropped, since the
+        # ring is read before waiting for the next one
+        with self._socket.makefile("rb") as f:
+            name, slots = f.readline().decode("utf8").split()
+        self._ring = self.enter_context(SharedLineRing.attach(name, int(slots)))
+        self._dispatcher = Dispatcher(retention=PORT_HISTORY_SIZE, retention_seconds=PORT_HISTORY_SECONDS)
+        self.callback(self._dispatcher.close)
+        self.enter_context(worker_thread(self._receive_lines, stop_function=self._stop))
+
+    def _stop(self):
+        self._socket.shutdown(socket.SHUT_RDWR)
+
+    def _receive_lines(self, signal_thread_ready):
+        sequence = self._ring.position()
+        signal_thread_ready()
+        while True:
+            # Check for the end before reading the published lines, so that
+            # none are lost when the broker closes right after writing them
+            closed = self._ring.is_closed()
+            sequence = self._dispatch_published_lines(sequence)
+            if closed:
+                break
+            try:
+                woken = self._socket.recv(4096)
+            except OSError:
+                break
+            if not woken:
+                self._dispatch_published_lines(sequence)
+                break
+        self._dispatcher.close()
+
+    def _dispatch_published_lines(self, sequence):
+        while True:
+            data, sequence, skipped = self._ring.read(sequence)
+            if skipped:
+                self._logger.warning(f"Lagging behind the broker, skipped {skipped} lines")
+            if data is None:
+                return sequence
+            # A truncated line may end in the middle of a character
+            self._dispatcher.dispatch(data.decode("utf8", errors="replace"))
+
+    def send(self, value):
+        """Send a line, which can not contain a newline since requests are separated by them"""
+        if "\n" in value:
+            raise ValueError(f"Can not send a value with a newline through the broker: {value!r}")
+        with self._send_lock:
+            self._socket.sendall(_SEND + value.encode("utf8") + b"\n")
+
+    def listen(self, since=None):
+        return Listener(self._dispatcher, since)
+
+    @property
+    def watchers(self):
+        return self._dispatcher.watchers
+
+    def toggle_dtr(self):
+        with self._send_lock:
+            self._socket.sendall(_TOGGLE_DTR + b"\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Share a serial port with pytest workers")
+    parser.add_argument("device")
+    parser.add_argument("baudrate", type=int)
+    parser.add_argument("address", help="Path of the Unix socket to serve")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    from fw.serial_port import SerialPort
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+    with SerialPort(args.device, args.baudrate) as port, \
+         Broker(port, args.address):
+        try:
+            stopped.wait()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())
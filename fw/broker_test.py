@@ -0,0 +1,136 @@
+from contextlib import suppress
+from functools import partial
+import os
+import subprocess
+import sys
+
+import pytest
+
+from fw.broker import Broker, BrokerPort, SharedLineRing, RING_HEADER
+from fw.command_runner import CommandRunner
+from fw.pipe_port import pipe_port_pair
+from fw.stream import EndOfStreamError, TimeoutError
+from fw.worker_thread import worker_thread
+
+
+TEST_TIMEOUT_SECONDS = 1  # Should be instant in unit tests
+
+
+@pytest.fixture
+def fake_dut():
+    external_port, internal_port = pipe_port_pair()
+    with external_port, \
+         internal_port, \
+         worker_thread(worker_function=partial(emulate_ping, internal_port),
+                       stop_function=internal_port.close):
+        yield external_port
+
+
+def emulate_ping(port, signal_thread_ready):
+    with suppress(EndOfStreamError, TimeoutError), \
+         port.listen() as lines:
+        signal_thread_ready()
+        while True:
+            command = lines.next(timeout_seconds=TEST_TIMEOUT_SECONDS)
+            port.send(command)
+            port.send("pong")
+            port.send("OK")
+            port.send("Enter command")
+
+
+def test_ring_wraps_around():
+    with SharedLineRing.create(slots=4, data_size=16) as writer, \
+         SharedLineRing.attach(writer.name, slots=4) as reader:
+        sequence = 0
+        for i in range(10):
+            writer.append(f"line {i}".encode("utf8"))
+            data, sequence, skipped = reader.read(sequence)
+            assert (data, skipped) == (f"line {i}".encode("utf8"), 0)
+        assert reader.read(sequence) == (None, 10, 0)
+
+
+def test_lagging_reader_skips_overwritten_lines():
+    with SharedLineRing.create(slots=4, data_size=64) as writer, \
+         SharedLineRing.attach(writer.name, slots=4) as reader:
+        for i in range(10):
+            writer.append(f"{i}".encode("utf8"))
+        assert reader.read(0) == (b"6", 7, 6)
+
+
+def test_oversized_line_is_truncated():
+    with SharedLineRing.create(slots=4, data_size=8) as writer, \
+         SharedLineRing.attach(writer.name, slots=4) as reader:
+        writer.append(b"0123456789")
+        writer.append(b"next")
+        assert reader.read(0) == (b"next", 2, 1)  # The truncated line was overwritten at once
+        writer.append(b"0123456789")
+        assert reader.read(2) == (b"01234567", 3, 0)
+
+
+def test_reader_lagging_by_whole_ring():
+    with SharedLineRing.create(slots=4, data_size=64) as writer, \
+         SharedLineRing.attach(writer.name, slots=4) as reader:
+        for i in range(4):
+            writer.append(f"{i}".encode("utf8"))
+        assert reader.read(0) == (b"0", 1, 0)
+        begin_append(writer, 1)
+        # Slot 0 is being reused, so line 0 may already be torn
+        assert reader.read(0) == (b"1", 2, 1)
+
+
+def test_reader_skips_line_whose_data_is_being_overwritten():
+    with SharedLineRing.create(slots=8, data_size=8) as writer, \
+         SharedLineRing.attach(writer.name, slots=8) as reader:
+        writer.append(b"aaaa")
+        writer.append(b"bbbb")
+        begin_append(writer, 4)
+        assert reader.read(0) == (b"bbbb", 2, 1)
+
+
+def begin_append(writer, length):
+    """Leave the ring as the writer does right before overwriting anything"""
+    sequence, written, _, _, closed = RING_HEADER.unpack_from(writer._buffer, 0)
+    RING_HEADER.pack_into(writer._buffer, 0, sequence, written, sequence + 1, written + length, closed)
+
+
+@pytest.fixture
+def broker_address(fake_dut, tmp_path):
+    address = str(tmp_path / "broker.sock")
+    with Broker(fake_dut, address, slots=16, data_size=256):
+        yield address
+
+
+def test_commands_through_broker(broker_address):
+    with BrokerPort(broker_address) as a, \
+         BrokerPort(broker_address) as b, \
+         b.listen() as observed:
+        for _ in range(20):
+            assert CommandRunner(a).run_command("ping", timeout_seconds=TEST_TIMEOUT_SECONDS) == ["pong"]
+            observed.skip_until("Enter command", TEST_TIMEOUT_SECONDS)
+        with pytest.raises(ValueError):
+            a.send("ping\nping")
+
+
+def test_broker_port_in_other_process(broker_address):
+    code = ("import sys; from fw.broker import BrokerPort; from fw.command_runner import CommandRunner\n"
+            "with BrokerPort(sys.argv[1]) as port:\n"
+            "    print(CommandRunner(port).run_command('ping', timeout_seconds=1))")
+    result = subprocess.run([sys.executable, "-c", code, broker_address],
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            capture_output=True, text=True, timeout=10)
+    assert result.stdout == "['pong']\n", result.stderr
+    # The other process must not have removed the shared memory
+    with BrokerPort(broker_address) as port:
+        assert CommandRunner(port).run_command("ping", timeout_seconds=TEST_TIMEOUT_SECONDS) == ["pong"]
+
+
+def test_closing_broker_ends_streams(fake_dut, tmp_path):
+    address = str(tmp_path / "broker.sock")
+    with Broker(fake_dut, address) as broker, \
+         BrokerPort(address) as port, \
+         port.listen() as lines:
+        port.send("ping")
+        lines.skip_until("Enter command", TEST_TIMEOUT_SECONDS)
+        broker.close()
+        with pytest.raises(EndOfStreamError):
+            lines.next(TEST_TIMEOUT_SECONDS)
@@ -1,16 +1,46 @@
 from contextlib import contextmanager
 import logging
+import os
+import tempfile
+import threading
 import time
 
+from fw.metrics import metrics
 
-_IMAGINED_STATE_FILE_PATH = "charging_cable.txt"
+
+# Outside the working tree, so that test runs do not leave it in the repository
+DEFAULT_STATE_FILE_PATH = os.path.join(tempfile.gettempdir(), "fw-charging-cable.txt")
+DEFAULT_SETTLE_SECONDS = 1
+_STATE_NAMES = {True: "connected", False: "disconnected"}
 
 
 class ChargingCable:
-    """Controls an imaginary charging cable"""
-    def __init__(self):
+    """Controls an imaginary charging cable
+
+    The relay is given 'settle_seconds' before and after each switch. The
+    last state is stored in the state file, so a relay that is already in the
+    requested state is not switched again, also across sessions.
+
+    The methods are thread safe, so they can be run by a HardwareScheduler.
+    """
+    def __init__(self, state_file_path=DEFAULT_STATE_FILE_PATH, settle_seconds=DEFAULT_SETTLE_SECONDS):
         self._logger = logging.getLogger(__name__ + "." + self.__class__.__name__)
-        self._last_state = None  # "None" means unknown, and is distinct from False and True
+        self._state_file_path = state_file_path
+        self._settle_seconds = settle_seconds
+        self._lock = threading.Lock()
+        self._last_state = self._read_state_file()  # "None" means unknown, and is distinct from False and True
+
+    def _read_state_file(self):
+        try:
+            with open(self._state_file_path, "rt") as f:
+                content = f.read().strip()
+        except FileNotFoundError:
+            return None
+        for state, name in _STATE_NAMES.items():
+            if content == name:
+                self._logger.debug(f"Relay state from last session: {name}")
+                return state
+        return None
 
     @contextmanager
     def temporarily_disconnected(self):
@@ -22,24 +52,29 @@ class ChargingCable:
 
     def connect(self):
         self._logger.debug("connect")
-        if self._last_state != True:
-            self._logger.info("Connecting charger cable...")
-            self._set_relay(True)
-            self._logger.info("Done.")
-        self._last_state = True
+        with self._lock:
+            if self._last_state != True:
+                self._logger.info("Connecting charger cable...")
+                self._set_relay(True)
+                self._logger.info("Done.")
+            self._last_state = True
 
     def disconnect(self):
         self._logger.debug("disconnect")
-        if self._last_state != False:
-            self._logger.info("Disconnecting charger cable...")
-            self._set_relay(False)
-            self._logger.info("Done.")
-        self._last_state = False
+        with self._lock:
+            if self._last_state != False:
+                self._logger.info("Disconnecting charger cable...")
+                self._set_relay(False)
+                self._logger.info("Done.")
+            self._last_state = False
 
     def _set_relay(self, state):
-        time.sleep(1)
-        with open(_IMAGINED_STATE_FILE_PATH, "wt") as f:
-            content = "connected" if state else "disconnected"
-            f.write(content)
+        with metrics.timer("cable.set_relay"):
+            self._switch_relay(state)
+
+    def _switch_relay(self, state):
+        time.sleep(self._settle_seconds)
+        with open(self._state_file_path, "wt") as f:
+            f.write(_STATE_NAMES[state])
         self._logger.info("*relay says click*")
-        time.sleep(1)
+        time.sleep(self._settle_seconds)
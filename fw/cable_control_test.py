@@ -0,0 +1,13 @@
+from fw.cable_control import ChargingCable
+
+
+def test_relay_state_persists_across_sessions(tmp_path):
+    path = str(tmp_path / "cable.txt")
+    ChargingCable(path, settle_seconds=0).connect()
+    cc = ChargingCable(path, settle_seconds=0)
+    switched = []
+    cc._switch_relay = switched.append
+    cc.connect()
+    assert switched == []
+    cc.disconnect()
+    assert switched == [False]
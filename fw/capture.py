@@ -0,0 +1,201 @@
+"""Compact binary capture of the traffic on a port
+
+A capture file starts with MAGIC and FILE_HEADER, followed by records. Each
+record is a header packed as RECORD_HEADER (time.monotonic_ns() timestamp,
+record kind and payload length) followed by the payload bytes. Text payloads
+are stored UTF-8 encoded. Monotonic timestamps keep the timing of a replay
+right even if the wall clock is stepped while recording. FILE_HEADER holds
+the offset to add to them to get nanoseconds since the epoch.
+
+Run "python -m fw.capture FILE" to print a capture, optionally sliced by
+test id or time range.
+"""
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+from contextlib import ExitStack
+from queue import SimpleQueue, Empty
+import argparse
+import mmap
+import struct
+import sys
+import time
+
+from fw.worker_thread import worker_thread
+
+
+MAGIC = b"FWCAP2\n\0"
+FILE_HEADER = struct.Struct("<q")
+RECORD_HEADER = struct.Struct("<qBI")
+
+RECEIVED = 1  # Value received from the DUT
+SENT = 2  # Value sent to the DUT
+MARK = 3  # Start of a test (payload is the test id) or end of it (empty payload)
+EVENT = 4  # Something done to the DUT outside of the data stream, like toggling DTR
+
+KIND_NAMES = {RECEIVED: "<==", SENT: "==>", MARK: "###", EVENT: "***"}
+
+DEFAULT_FLUSH_INTERVAL_SECONDS = 0.5
+DEFAULT_BATCH_SIZE = 1024
+
+
+Record = namedtuple("Record", ["timestamp_ns", "kind", "payload"])
+
+
+class TrafficRecorder(ExitStack):
+    """Append timestamped records to a capture file from a background thread
+
+    'record' only timestamps the value and puts it on a queue, so it is cheap
+    to call from a receive thread. Encoding, packing and writing happen in a
+    background thread. It writes and flushes the records in batches of up to
+    'batch_size' records, waiting at most 'flush_interval_seconds' for a batch
+    to fill up.
+
+    This class is a context manager. Exiting it writes all queued records.
+    """
+    def __init__(self, path, flush_interval_seconds=DEFAULT_FLUSH_INTERVAL_SECONDS,
+                 batch_size=DEFAULT_BATCH_SIZE):
+        super().__init__()
+        self._flush_interval_seconds = flush_interval_seconds
+        self._batch_size = batch_size
+        self._queue = SimpleQueue()
+        self._file = self.enter_context(open(path, "wb"))
+        self._file.write(MAGIC)
+        self._file.write(FILE_HEADER.pack(time.time_ns() - time.monotonic_ns()))
+        self.enter_context(worker_thread(self._write_records, stop_function=lambda: self._queue.put(None)))
+
+    def record(self, kind, value):
+        """Record a value (str or bytes) of the given kind"""
+        self._queue.put((time.monotonic_ns(), kind, value))
+
+    def mark(self, test_id):
+        """Record the start of a test, or the end of it if 'test_id' is empty"""
+        self.record(MARK, test_id)
+
+    def _write_records(self, signal_thread_ready):
+        signal_thread_ready()
+        batch = bytearray()
+        stopping = False
+        while not stopping:
+            # Collect records until the batch is full or has waited long enough
+            items = [self._queue.get()]
+            batch_end_time = time.monotonic() + self._flush_interval_seconds
+            while items[-1] is not None and len(items) < self._batch_size:
+                timeout = batch_end_time - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(self._queue.get(timeout=timeout))
+                except Empty:
+                    break
+            for item in items:
+                if item is None:
+                    stopping = True
+                    break
+                timestamp_ns, kind, value = item
+                payload = value.encode("utf8") if isinstance(value, str) else bytes(value)
+                batch += RECORD_HEADER.pack(timestamp_ns, kind, len(payload))
+                batch += payload
+            self._file.write(batch)
+            self._file.flush()
+            batch.clear()
+
+
+class CaptureReader(ExitStack):
+    """Random access to the records of a capture file
+
+    The file is memory mapped and indexed once when opened. Timestamps are
+    time.monotonic_ns() values of the recording process. Add
+    'epoch_offset_ns' to get nanoseconds since the epoch.
+
+    This class is a context manager.
+    """
+    def __init__(self, path):
+        super().__init__()
+        f = self.enter_context(open(path, "rb"))
+        if not f.read(len(MAGIC)) == MAGIC:
+            raise ValueError(f"Not a capture file: {path}")
+        self._map = self.enter_context(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        self.epoch_offset_ns, = FILE_HEADER.unpack_from(self._map, len(MAGIC))
+        self._offsets = array("Q")
+        self._timestamps = array("q")
+        offset = len(MAGIC) + FILE_HEADER.size
+        end = len(self._map)
+        while offset + RECORD_HEADER.size <= end:
+            timestamp_ns, kind, length = RECORD_HEADER.unpack_from(self._map, offset)
+            if offset + RECORD_HEADER.size + length > end:
+                break  # Truncated last record, for example after a crash
+            self._offsets.append(offset)
+            self._timestamps.append(timestamp_ns)
+            offset += RECORD_HEADER.size + length
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, index):
+        offset = self._offsets[index]
+        timestamp_ns, kind, length = RECORD_HEADER.unpack_from(self._map, offset)
+        start = offset + RECORD_HEADER.size
+        return Record(timestamp_ns, kind, self._map[start:start + length])
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def records(self, start_ns=None, end_ns=None):
+        """Return the records with timestamps in [start_ns, end_ns)"""
+        first = 0 if start_ns is None else bisect_left(self._timestamps, start_ns)
+        last = len(self) if end_ns is None else bisect_left(self._timestamps, end_ns)
+        return [self[i] for i in range(first, last)]
+
+    def test_ids(self):
+        """Return the ids of all tests marked in the capture, in order"""
+        return [record.payload.decode("utf8") for record in self if record.kind == MARK and record.payload]
+
+    def records_for_test(self, test_id):
+        """Return the records between the start and the end of the given test"""
+        marker = test_id.encode("utf8")
+        result = None
+        for record in self:
+            if record.kind == MARK:
+                if result is not None:
+                    return result
+                if record.payload == marker:
+                    result = []
+            elif result is not None:
+                result.append(record)
+        return result if result is not None else []
+
+
+def format_record(record, epoch_offset_ns=0):
+    seconds = (record.timestamp_ns + epoch_offset_ns) / 1_000_000_000
+    return f"{seconds:.6f} {KIND_NAMES.get(record.kind, '???')} {record.payload.decode('utf8', 'replace')}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Print the records of a traffic capture file")
+    parser.add_argument("path")
+    parser.add_argument("--test", help="Only show records of the test with this id")
+    parser.add_argument("--start", type=float, help="Only show records from this time (seconds since the epoch)")
+    parser.add_argument("--end", type=float, help="Only show records before this time (seconds since the epoch)")
+    parser.add_argument("--list-tests", action="store_true", help="List the ids of the tests in the capture")
+    args = parser.parse_args(argv)
+    with CaptureReader(args.path) as reader:
+        if args.list_tests:
+            for test_id in reader.test_ids():
+                print(test_id)
+            return
+        if args.test is not None:
+            records = reader.records_for_test(args.test)
+        else:
+            records = reader.records()
+        offset_ns = reader.epoch_offset_ns
+        start_ns = None if args.start is None else int(args.start * 1_000_000_000) - offset_ns
+        end_ns = None if args.end is None else int(args.end * 1_000_000_000) - offset_ns
+        for record in records:
+            if (start_ns is None or record.timestamp_ns >= start_ns) and \
+               (end_ns is None or record.timestamp_ns < end_ns):
+                print(format_record(record, offset_ns))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,68 @@
+import time
+
+from fw.capture import TrafficRecorder, CaptureReader, RECEIVED, SENT, EVENT, main
+
+
+def test_record_and_read_back(tmp_path):
+    path = str(tmp_path / "traffic.cap")
+    with TrafficRecorder(path) as recorder:
+        recorder.record(EVENT, "toggle_dtr")
+        recorder.mark("test_a")
+        recorder.record(SENT, "ping")
+        recorder.record(RECEIVED, "pong")
+        recorder.mark("")
+        recorder.mark("test_b")
+        recorder.record(RECEIVED, b"\x00\xff")
+    with CaptureReader(path) as reader:
+        assert len(reader) == 7
+        assert reader.test_ids() == ["test_a", "test_b"]
+        assert [(r.kind, r.payload) for r in reader.records_for_test("test_a")] == \
+            [(SENT, b"ping"), (RECEIVED, b"pong")]
+        assert [r.payload for r in reader.records_for_test("test_b")] == [b"\x00\xff"]
+        assert reader.records_for_test("test_c") == []
+
+
+def test_slice_by_time(tmp_path):
+    path = str(tmp_path / "traffic.cap")
+    with TrafficRecorder(path) as recorder:
+        recorder.record(RECEIVED, "early")
+        time.sleep(0.01)
+        middle_ns = time.monotonic_ns()
+        time.sleep(0.01)
+        recorder.record(RECEIVED, "late")
+    with CaptureReader(path) as reader:
+        assert [r.payload for r in reader.records(start_ns=middle_ns)] == [b"late"]
+        assert [r.payload for r in reader.records(end_ns=middle_ns)] == [b"early"]
+
+
+def test_truncated_record_is_ignored(tmp_path):
+    path = tmp_path / "traffic.cap"
+    with TrafficRecorder(str(path)) as recorder:
+        recorder.record(RECEIVED, "complete")
+        recorder.record(RECEIVED, "truncated")
+    path.write_bytes(path.read_bytes()[:-3])
+    with CaptureReader(str(path)) as reader:
+        assert [r.payload for r in reader] == [b"complete"]
+
+
+def test_command_line_tool(tmp_path, capsys):
+    path = str(tmp_path / "traffic.cap")
+    with TrafficRecorder(path) as recorder:
+        recorder.mark("test_a")
+        recorder.record(SENT, "ping")
+    main([path, "--test", "test_a"])
+    assert capsys.readouterr().out.strip().endswith("==> ping")
+
+
+def test_command_line_tool_slices_by_wall_clock_time(tmp_path, capsys):
+    path = str(tmp_path / "traffic.cap")
+    with TrafficRecorder(path) as recorder:
+        recorder.record(RECEIVED, "early")
+        time.sleep(0.01)
+        middle = time.time()
+        time.sleep(0.01)
+        recorder.record(RECEIVED, "late")
+    main([path, "--start", str(middle)])
+    output = capsys.readouterr().out.strip()
+    assert output.endswith("<== late")
+    assert abs(float(output.split()[0]) - middle) < 1
@@ -0,0 +1,136 @@
+from contextlib import ExitStack
+import itertools
+import logging
+import threading
+
+from fw.interface import Port
+from fw.stream import (Dispatcher, Listener, EndOfStreamError,
+                       PORT_HISTORY_SIZE, PORT_HISTORY_SECONDS)
+from fw.worker_thread import worker_thread
+
+
+TAG_PREFIX = "@"
+
+
+def tag(channel_id, line):
+    """Return 'line' tagged for channel 'channel_id', as sent on the link"""
+    return f"{TAG_PREFIX}{channel_id} {line}"
+
+
+def split_tag(line):
+    """Return (channel id, line without the tag), or (None, line) for an untagged line"""
+    if not line.startswith(TAG_PREFIX):
+        return None, line
+    channel_id, separator, rest = line[len(TAG_PREFIX):].partition(" ")
+    if not separator or not channel_id.isdigit():
+        return None, line
+    return int(channel_id), rest
+
+
+class ChannelMux(Port, ExitStack):
+    """Share one link to the DUT between several independent channels
+
+    Each channel from 'open_channel' is a Port of its own. Lines sent on a
+    channel are tagged with its id, like "@3 ping", and the DUT tags each
+    line of its response and the prompt after it in the same way (see
+    mock_device/mock_device.ino). Tagged lines are routed to the listeners of
+    the matching channel only, without the tag, so for example a
+    CommandRunner per thread can run commands at the same time without
+    seeing each others output.
+
+    Untagged lines, like boot banners, are not part of any response. They
+    are available from 'listen' on the multiplexer itself. Listeners of the
+    underlying port still see all lines as they are, so a RestartDetector on
+    that port keeps working.
+
+    Values must be strings. This class is a context manager.
+    """
+    def __init__(self, port):
+        super().__init__()
+        self._logger = logging.getLogger(__name__ + "." + self.__class__.__name__)
+        self._port = port
+        self._send_lock = threading.Lock()
+        self._channels_lock = threading.Lock()
+        self._channel_ids = itertools.count(1)
+        self._channels = {}  # channel id -> Dispatcher
+        self._untagged = Dispatcher(retention=PORT_HISTORY_SIZE, retention_seconds=PORT_HISTORY_SECONDS)
+        self.callback(self._close_channels)
+        self._lines = port.listen()  # Closed to stop the worker thread
+        self.enter_context(worker_thread(self._route_lines, stop_function=self._lines.close))
+
+    def _route_lines(self, signal_thread_ready):
+        with self._lines as lines:
+            signal_thread_ready()
+            while True:
+                try:
+                    line = lines.next(timeout_seconds=None)
+                except EndOfStreamError:
+                    break
+                channel_id, value = split_tag(line)
+                if channel_id is None:
+                    self._untagged.dispatch(line)
+                    continue
+                with self._channels_lock:
+                    dispatcher = self._channels.get(channel_id)
+                if dispatcher is not None:
+                    dispatcher.dispatch(value)
+                else:
+                    self._logger.warning(f"Line for unknown channel {channel_id}: {value}")
+        self._close_channels()
+
+    def _close_channels(self):
+        with self._channels_lock:
+            for dispatcher in self._channels.values():
+                dispatcher.close()
+        self._untagged.close()
+
+    def open_channel(self):
+        """Return a new Channel, which is a Port and a context manager"""
+        with self._channels_lock:
+            channel_id = next(self._channel_ids)
+            dispatcher = Dispatcher(retention=PORT_HISTORY_SIZE, retention_seconds=PORT_HISTORY_SECONDS)
+            self._channels[channel_id] = dispatcher
+        self._logger.debug(f"open channel {channel_id}")
+        return Channel(self, channel_id, dispatcher)
+
+    def _close_channel(self, channel_id):
+        self._logger.debug(f"close channel {channel_id}")
+        with self._channels_lock:
+            self._channels.pop(channel_id).close()
+
+    def send(self, line):
+        """Send an untagged line"""
+        with self._send_lock:
+            self._port.send(line)
+
+    def listen(self, since=None):
+        """Listen to the untagged lines"""
+        return Listener(self._untagged, since)
+
+    @property
+    def watchers(self):
+        return self._untagged.watchers
+
+
+class Channel(Port, ExitStack):
+    """One channel of a ChannelMux
+
+    Exiting the context closes the channel. Listeners of the channel then
+    reach the end of the stream.
+    """
+    def __init__(self, mux, channel_id, dispatcher):
+        super().__init__()
+        self.channel_id = channel_id
+        self._mux = mux
+        self._dispatcher = dispatcher
+        self.callback(mux._close_channel, channel_id)
+
+    def send(self, line):
+        self._mux.send(tag(self.channel_id, line))
+
+    def listen(self, since=None):
+        return Listener(self._dispatcher, since)
+
+    @property
+    def watchers(self):
+        return self._dispatcher.watchers
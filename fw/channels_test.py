@@ -0,0 +1,83 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from functools import partial
+
+import pytest
+
+from fw.channels import ChannelMux, tag, split_tag
+from fw.command_runner import CommandRunner
+from fw.pipe_port import pipe_port_pair
+from fw.stream import EndOfStreamError, TimeoutError
+from fw.worker_thread import worker_thread
+
+
+TEST_TIMEOUT_SECONDS = 1  # Should be instant in unit tests
+
+
+@pytest.fixture
+def fake_tagging_device():
+    external_port, internal_port = pipe_port_pair()
+    with external_port, \
+         internal_port, \
+         worker_thread(worker_function=partial(emulate_tagging_device, internal_port),
+                       stop_function=internal_port.close):
+        yield external_port
+
+
+def emulate_tagging_device(port, signal_thread_ready):
+    """Like mock_device.ino: echo a command and tag each response line and the next prompt like it"""
+    with suppress(EndOfStreamError, TimeoutError), \
+         port.listen() as lines:
+        signal_thread_ready()
+        while True:
+            line = lines.next(timeout_seconds=TEST_TIMEOUT_SECONDS)
+            port.send(line)
+            channel_id, command = split_tag(line)
+            reply = port.send if channel_id is None else lambda value: port.send(tag(channel_id, value))
+            if command.startswith("count "):
+                for i in range(int(command.split()[1])):
+                    reply(str(i))
+                reply("OK")
+            else:
+                reply("ERROR")
+            reply("Enter command")
+
+
+def test_split_tag():
+    assert split_tag(tag(12, "ping")) == (12, "ping")
+    assert split_tag("ping") == (None, "ping")
+    assert split_tag("@home") == (None, "@home")
+
+
+def test_concurrent_commands_on_separate_channels(fake_tagging_device):
+    def run(count):
+        with mux.open_channel() as channel:
+            cr = CommandRunner(channel)
+            return [cr.run_command(f"count {count}", timeout_seconds=TEST_TIMEOUT_SECONDS) for _ in range(20)]
+    with ChannelMux(fake_tagging_device) as mux, \
+         ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(run, range(1, 5)))
+    for count, outputs in zip(range(1, 5), results):
+        assert outputs == [[str(i) for i in range(count)]] * 20
+
+
+def test_untagged_lines_are_not_routed_to_channels(fake_tagging_device):
+    with ChannelMux(fake_tagging_device) as mux, \
+         mux.listen() as untagged, \
+         mux.open_channel() as channel, \
+         channel.listen() as lines:
+        channel.send("count 1")
+        assert [lines.next(TEST_TIMEOUT_SECONDS) for _ in range(4)] == ["count 1", "0", "OK", "Enter command"]
+        mux.send("count 1")
+        assert [untagged.next(TEST_TIMEOUT_SECONDS) for _ in range(4)] == ["count 1", "0", "OK", "Enter command"]
+        with pytest.raises(TimeoutError):
+            lines.next(timeout_seconds=0.01)
+
+
+def test_closing_mux_ends_channel_streams(fake_tagging_device):
+    with ChannelMux(fake_tagging_device) as mux, \
+         mux.open_channel() as channel, \
+         channel.listen() as lines:
+        mux.close()
+        with pytest.raises(EndOfStreamError):
+            lines.next(TEST_TIMEOUT_SECONDS)
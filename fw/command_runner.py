@@ -1,7 +1,21 @@
-from fw.timeout import TimeoutCalculator
+from concurrent.futures import Future
+from contextlib import ExitStack
+from queue import Queue
+import sys
+import threading
+import time
+
+from fw.matcher import Matcher
+from fw.metrics import metrics
+from fw.timeout import Deadline, resolve_timeout
+from fw.worker_thread import worker_thread
 
 
 DEFAULT_COMMAND_TIMEOUT_SECONDS = 20
+ECHO_TIMEOUT_SECONDS = 3
+LEARNED_TIMEOUT = object()  # Timeout learned by the latency model, or the default without one
+DEFAULT_PIPELINE_WINDOW = 4
+END_OF_OUTPUT = Matcher("OK", "ERROR")
 
 
 class CommandError(Exception):
@@ -9,10 +23,25 @@ class CommandError(Exception):
 
 
 class CommandRunner:
-    def __init__(self, debug_port):
+    """Run commands on the DUT
+
+    Timeouts can be given in seconds or as a fw.timeout.Deadline, and never
+    extend past the deadline set with fw.timeout.deadline.
+
+    If 'command_observer' is given, it is called with each command just before
+    the command is sent.
+
+    If a fw.latency_model.LatencyModel is given, it records how long each
+    command takes. Commands run without an explicit timeout then get the
+    timeout learned for them, instead of DEFAULT_COMMAND_TIMEOUT_SECONDS.
+    Waiting for the echo and the prompt gets a learned timeout too.
+    """
+    def __init__(self, debug_port, command_observer=None, latency_model=None):
         self._debug_port = debug_port
+        self._command_observer = command_observer
+        self._latency_model = latency_model
 
-    def run_command(self, command, timeout_seconds=DEFAULT_COMMAND_TIMEOUT_SECONDS):
+    def run_command(self, command, timeout_seconds=LEARNED_TIMEOUT):
         """Send a command, collect its output lines and check that it succeeded.
 
         Returns a list of lines
@@ -23,30 +52,292 @@ class CommandRunner:
         else:
             raise CommandError("Error running command: " + command)
 
-    def try_run_command(self, command, timeout_seconds=DEFAULT_COMMAND_TIMEOUT_SECONDS):
+    def try_run_command(self, command, timeout_seconds=LEARNED_TIMEOUT):
         """Send a command and return whether it succeeded and the lines output by the command.
 
         Returns a (bool, lines) pair.
         """
-        with self._debug_port.listen() as lines:
-            # Send command
+        with self.stream_command(command, timeout_seconds) as output:
+            lines = list(output)
+        return output.ok, lines
+
+    def stream_command(self, command, timeout_seconds=LEARNED_TIMEOUT,
+                       stop_when=None, max_lines=None, max_bytes=None, sink=None):
+        """Send a command and return a CommandOutput that yields its output lines as they arrive.
+
+        Use the result as a context manager:
+
+            with command_runner.stream_command("dump", sink=write_lines_to(f)) as output:
+                for line in output:
+                    ...
+            assert output.ok
+        """
+        deadline = resolve_timeout(_command_timeout(self._latency_model, command, timeout_seconds))
+        return CommandOutput(self._debug_port, command, deadline, stop_when, max_lines, max_bytes, sink,
+                             self._command_observer, self._latency_model)
+
+    def pipeline(self, window=DEFAULT_PIPELINE_WINDOW, timeout_seconds=LEARNED_TIMEOUT):
+        """Return a CommandPipeline for sending commands ahead of their responses"""
+        return CommandPipeline(self._debug_port, window, timeout_seconds, self._observe, self._latency_model)
+
+    def run_commands(self, commands, window=DEFAULT_PIPELINE_WINDOW,
+                     timeout_seconds=LEARNED_TIMEOUT, check=False):
+        """Run several commands, sending up to 'window' of them ahead.
+
+        Returns a list of (bool, lines) pairs, one per command. If 'check' is
+        true, a CommandError is raised for the first command that failed once
+        all commands have completed.
+        """
+        commands = list(commands)
+        with self.pipeline(window, timeout_seconds) as pipeline:
+            futures = [pipeline.submit(command) for command in commands]
+        results = [future.result() for future in futures]
+        if check:
+            for command, (ok, _) in zip(commands, results):
+                if not ok:
+                    raise CommandError("Error running command: " + command)
+        return results
+
+    def _observe(self, command):
+        if self._command_observer is not None:
+            self._command_observer(command)
+
+
+def _command_timeout(latency_model, command, timeout_seconds):
+    if timeout_seconds is not LEARNED_TIMEOUT:
+        return timeout_seconds
+    elif latency_model is None:
+        return DEFAULT_COMMAND_TIMEOUT_SECONDS
+    else:
+        return latency_model.timeout(_latency_key(command), DEFAULT_COMMAND_TIMEOUT_SECONDS)
+
+
+def _latency_key(command):
+    """Durations are learned per command name, whatever the arguments are"""
+    return "command." + command.partition(" ")[0]
+
+
+class CommandPipeline(ExitStack):
+    """Send commands without waiting for the responses of earlier ones
+
+    The timeout applies to each command separately, counted from when the
+    previous response has been read. Since the responses are read by a
+    background thread, a fw.timeout.deadline context of the caller does not
+    apply; pass a Deadline as timeout to limit the total time instead.
+
+    Up to 'window' commands can be waiting for their responses at the same
+    time. 'submit' blocks while the window is full. A background thread reads
+    the responses in order and resolves the future of the command that caused
+    each of them. If a response can not be read (for example because of a
+    timeout) the following responses can not be trusted, so all the remaining
+    commands fail too.
+
+    This class is a context manager. Exiting it waits for all submitted
+    commands to complete.
+    """
+    def __init__(self, debug_port, window, timeout_seconds, command_observer=None, latency_model=None):
+        super().__init__()
+        self._debug_port = debug_port
+        self._command_observer = command_observer
+        self._latency_model = latency_model
+        self._timeout_seconds = timeout_seconds
+        self._window = threading.Semaphore(window)
+        self._send_lock = threading.Lock()
+        self._in_flight = Queue()
+        self._lines = self.enter_context(debug_port.listen())
+        self.enter_context(worker_thread(self._worker_function,
+                                         stop_function=lambda: self._in_flight.put(None)))
+
+    def submit(self, command):
+        """Send a command and return a Future for its (bool, lines) pair"""
+        self._window.acquire()
+        future = Future()
+        with self._send_lock:
+            self._in_flight.put((command, future))
+            if self._command_observer is not None:
+                self._command_observer(command)
             self._debug_port.send(command)
-            # Expect command echo
-            lines.expect_next(command, timeout_seconds=3)
-            # Read lines until end (OK or ERROR)
-            tc = TimeoutCalculator(timeout_seconds)
-            result = []
-            ok = None
-            while True:
-                line = lines.next(timeout_seconds=tc.time_left_now())
-                if line == "OK":
-                    ok = True
-                    break
-                elif line == "ERROR":
-                    ok = False
-                    break
+        return future
+
+    def _worker_function(self, signal_thread_ready):
+        signal_thread_ready()
+        error = None
+        while True:
+            item = self._in_flight.get()
+            if item is None:
+                return
+            command, future = item
+            if error is None:
+                try:
+                    timeout = _command_timeout(self._latency_model, command, self._timeout_seconds)
+                    result = _read_response(self._lines, command, resolve_timeout(timeout), self._latency_model)
+                except Exception as e:
+                    error = e
+                    future.set_exception(e)
                 else:
-                    result.append(line)
-            # Expect next prompt
-            lines.expect_next("Enter command", timeout_seconds=3)
-            return ok, result
+                    future.set_result(result)
+            else:
+                future.set_exception(CommandError(f"Earlier command in pipeline failed: {error!r}"))
+            self._window.release()
+
+
+class CommandOutput(ExitStack):
+    """Output lines of a command, available while the command is running
+
+    Iterating over this object yields the output lines as they arrive.
+    Iteration stops early after a line for which 'stop_when' returns true, or
+    when 'max_lines' lines or 'max_bytes' bytes (UTF-8 encoded) have been
+    yielded. 'truncated' then tells that lines were left out. Each yielded
+    line is also passed to 'sink', if given.
+
+    The final status is available as 'ok' once the command has finished.
+    'wait' finishes the command and returns the status. Lines that have not
+    been iterated over yet are still passed to the sink, until iteration
+    would have stopped. The rest of the output is discarded.
+
+    This class is a context manager. The command is sent when entering it.
+    Exiting it waits for the command to finish, so that the DUT is ready for
+    the next command.
+    """
+    def __init__(self, debug_port, command, deadline, stop_when=None, max_lines=None, max_bytes=None,
+                 sink=None, command_observer=None, latency_model=None):
+        super().__init__()
+        self._debug_port = debug_port
+        self._command = command
+        self._deadline = deadline
+        self._stop_when = stop_when
+        self._max_lines = max_lines
+        self._max_bytes = max_bytes
+        self._sink = sink
+        self._command_observer = command_observer
+        self._latency_model = latency_model
+        self.truncated = False
+        self._response = None
+        self._output = None
+
+    def __enter__(self):
+        super().__enter__()
+        try:
+            lines = self.enter_context(self._debug_port.listen())
+            if self._command_observer is not None:
+                self._command_observer(self._command)
+            self._debug_port.send(self._command)
+            self._response = _Response(lines, self._command, self._deadline, self._latency_model)
+        except BaseException:
+            # Nobody will exit the context, so the listener must be removed here
+            super().__exit__(*sys.exc_info())
+            raise
+        self._output = self._iterate_output()
+        return self
+
+    @property
+    def ok(self):
+        """Whether the command succeeded, or None if it has not finished yet"""
+        return self._response.ok if self._response is not None else None
+
+    def __iter__(self):
+        return self._output
+
+    def _iterate_output(self):
+        line_count = 0
+        byte_count = 0
+        while True:
+            line = self._response.next_line()
+            if line is None:
+                return
+            line_count += 1
+            if self._max_bytes is not None:
+                byte_count += len(line.encode("utf8"))
+                if byte_count > self._max_bytes:
+                    self.truncated = True
+                    return
+            if self._sink is not None:
+                self._sink(line)
+            yield line
+            if (self._stop_when is not None and self._stop_when(line)) or \
+               (self._max_lines is not None and line_count >= self._max_lines):
+                self.truncated = self._response.next_line() is not None
+                return
+
+    def wait(self):
+        """Finish the command and return whether it succeeded"""
+        for _ in self._output:
+            pass
+        while self._response.next_line() is not None:
+            self.truncated = True
+        return self.ok
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            try:
+                self.wait()
+            except BaseException:
+                super().__exit__(*sys.exc_info())
+                raise
+        return super().__exit__(exc_type, exc_value, traceback)
+
+
+def write_lines_to(file):
+    """Return a CommandOutput sink that writes each line to a text file"""
+    def sink(line):
+        file.write(line + "\n")
+    return sink
+
+
+class _Response:
+    """Reads the response to a command that has just been sent"""
+    def __init__(self, lines, command, deadline, latency_model=None):
+        self.ok = None
+        self._lines = lines
+        self._command = command
+        self._deadline = deadline
+        self._latency_model = latency_model
+        self._echo_timeout_seconds = ECHO_TIMEOUT_SECONDS
+        if latency_model is not None:
+            self._echo_timeout_seconds = latency_model.timeout("command.echo", ECHO_TIMEOUT_SECONDS)
+        self._line_count = 0
+        self._start = time.monotonic()
+        # Expect command echo
+        lines.expect_next(command, timeout_seconds=Deadline(self._echo_timeout_seconds).earliest(deadline))
+        echo_seconds = time.monotonic() - self._start
+        metrics.observe_seconds("command.echo", echo_seconds)
+        if latency_model is not None:
+            latency_model.record("command.echo", echo_seconds)
+
+    def next_line(self):
+        """Return the next output line, or None once the command has finished"""
+        if self.ok is not None:
+            return None
+        # Read lines until end (OK or ERROR)
+        line = self._lines.next(timeout_seconds=self._deadline)
+        end = END_OF_OUTPUT.match(line)
+        if end is None:
+            if not self._line_count:
+                metrics.observe_seconds("command.first_line", time.monotonic() - self._start)
+            self._line_count += 1
+            return line
+        metrics.observe_seconds("command.end", time.monotonic() - self._start)
+        # Expect next prompt
+        self._lines.expect_next("Enter command",
+                                timeout_seconds=Deadline(self._echo_timeout_seconds).earliest(self._deadline))
+        total_seconds = time.monotonic() - self._start
+        metrics.observe_seconds("command.total", total_seconds)
+        if self._latency_model is not None:
+            self._latency_model.record(_latency_key(self._command), total_seconds)
+        self.ok = end.pattern == "OK"
+        metrics.increment("command.ok" if self.ok else "command.error")
+        return None
+
+
+def _read_response(lines, command, deadline, latency_model=None):
+    """Read the response to a command that has just been sent
+
+    Returns a (bool, lines) pair.
+    """
+    response = _Response(lines, command, deadline, latency_model)
+    result = []
+    while True:
+        line = response.next_line()
+        if line is None:
+            return response.ok, result
+        result.append(line)
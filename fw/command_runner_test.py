@@ -4,7 +4,8 @@ from threading import Event
 
 import pytest
 
-from fw.command_runner import CommandRunner, CommandError
+from fw.command_runner import CommandRunner, CommandError, write_lines_to
+from fw.latency_model import LatencyModel, DEFAULT_MIN_TIMEOUT_SECONDS
 from fw.pipe_port import pipe_port_pair
 from fw.stream import EndOfStreamError, TimeoutError
 from fw.worker_thread import worker_thread
@@ -33,6 +34,10 @@ def emulate_command_interpreter(port, signal_thread_ready):
             if command == "ping":
                 port.send("pong")
                 port.send("OK")
+            elif command == "dump":
+                for i in range(10):
+                    port.send(str(i))
+                port.send("OK")
             else:
                 port.send("ERROR")
             port.send("Enter command")
@@ -62,3 +67,90 @@ def test_failing_run_command(fake_command_interpreter):
     with pytest.raises(CommandError):
         lines = cr.run_command("xyz", timeout_seconds=TEST_TIMEOUT_SECONDS)
 
+
+def test_run_commands(fake_command_interpreter):
+    cr = CommandRunner(fake_command_interpreter)
+    results = cr.run_commands(["ping", "xyz", "ping"], window=2, timeout_seconds=TEST_TIMEOUT_SECONDS)
+    assert results == [(True, ["pong"]), (False, []), (True, ["pong"])]
+
+
+def test_failing_run_commands(fake_command_interpreter):
+    cr = CommandRunner(fake_command_interpreter)
+    with pytest.raises(CommandError):
+        cr.run_commands(["ping", "xyz"], timeout_seconds=TEST_TIMEOUT_SECONDS, check=True)
+
+
+def test_pipeline_futures(fake_command_interpreter):
+    cr = CommandRunner(fake_command_interpreter)
+    with cr.pipeline(window=3, timeout_seconds=TEST_TIMEOUT_SECONDS) as pipeline:
+        futures = [pipeline.submit("ping") for _ in range(10)]
+        assert futures[0].result(timeout=TEST_TIMEOUT_SECONDS) == (True, ["pong"])
+    assert all(future.result() == (True, ["pong"]) for future in futures)
+
+
+def test_stream_command(fake_command_interpreter):
+    cr = CommandRunner(fake_command_interpreter)
+    with cr.stream_command("dump", timeout_seconds=TEST_TIMEOUT_SECONDS) as output:
+        assert output.ok is None
+        assert list(output) == [str(i) for i in range(10)]
+    assert output.ok
+    assert not output.truncated
+
+
+def test_stream_command_stops_early(fake_command_interpreter):
+    cr = CommandRunner(fake_command_interpreter)
+    with cr.stream_command("dump", timeout_seconds=TEST_TIMEOUT_SECONDS, stop_when=lambda line: line == "2") as output:
+        assert list(output) == ["0", "1", "2"]
+    assert output.ok
+    assert output.truncated
+    # The remaining output was consumed, so the next command works
+    assert cr.run_command("ping", timeout_seconds=TEST_TIMEOUT_SECONDS) == ["pong"]
+
+
+def test_stream_command_limits(fake_command_interpreter):
+    cr = CommandRunner(fake_command_interpreter)
+    with cr.stream_command("dump", timeout_seconds=TEST_TIMEOUT_SECONDS, max_lines=4) as output:
+        assert len(list(output)) == 4
+    with cr.stream_command("dump", timeout_seconds=TEST_TIMEOUT_SECONDS, max_bytes=3) as output:
+        assert list(output) == ["0", "1", "2"]
+    assert output.truncated
+
+
+def test_failed_echo_removes_listener():
+    external_port, internal_port = pipe_port_pair()
+    with external_port, internal_port:
+        cr = CommandRunner(external_port)
+        output = cr.stream_command("ping", timeout_seconds=0.01)
+        with internal_port.listen() as sent:
+            # Nothing is sent before the context is entered
+            with pytest.raises(TimeoutError):
+                sent.next(timeout_seconds=0.01)
+            with pytest.raises(TimeoutError):
+                with output:
+                    pass
+            assert sent.next(TEST_TIMEOUT_SECONDS) == "ping"
+        with pytest.raises(TimeoutError):
+            cr.try_run_command("ping", timeout_seconds=0.01)
+        assert external_port._own_dispatcher._cursors == {}
+
+
+def test_stream_command_sink(fake_command_interpreter, tmp_path):
+    cr = CommandRunner(fake_command_interpreter)
+    path = tmp_path / "dump.txt"
+    with open(path, "wt") as f, \
+         cr.stream_command("dump", timeout_seconds=TEST_TIMEOUT_SECONDS, sink=write_lines_to(f)) as output:
+        assert output.wait()
+    assert path.read_text().splitlines() == [str(i) for i in range(10)]
+
+
+def test_learned_timeouts(fake_command_interpreter):
+    model = LatencyModel(min_samples=2)
+    cr = CommandRunner(fake_command_interpreter, latency_model=model)
+    for _ in range(2):
+        cr.run_command("ping")
+    cr.try_run_command("set 1")
+    cr.try_run_command("set 2")
+    assert model.timeout("command.ping", 20) == DEFAULT_MIN_TIMEOUT_SECONDS
+    assert model.timeout("command.set", 20) == DEFAULT_MIN_TIMEOUT_SECONDS
+    assert model.timeout("command.echo", 3) == DEFAULT_MIN_TIMEOUT_SECONDS
+    assert model.timeout("command.dump", 20) == 20
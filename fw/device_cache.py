@@ -0,0 +1,95 @@
+"""Remember which tests passed on which firmware build
+
+Tests that only read from the DUT give the same result for the same
+firmware, so they need not run again until the firmware or the test changes.
+The key of a passed test covers the firmware version, the test source and the
+test parameters. fw.systest_plugin takes the source from the test module,
+its conftest files and the modules that define its fixtures.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MAX_AGE_SECONDS = 7 * 24 * 60 * 60
+
+
+def cache_key(firmware_version, test_id, source, params=None):
+    """Return the cache key of a test run
+
+    'source' is the source code the test depends on (bytes) and 'params' its
+    parameters, which must have a stable repr.
+    """
+    digest = hashlib.sha256()
+    for part in (firmware_version.encode("utf8"), test_id.encode("utf8"), source,
+                 repr(sorted((params or {}).items())).encode("utf8")):
+        digest.update(len(part).to_bytes(8, "little"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class DeviceCache:
+    """Passed tests stored as one small file per key in 'directory'
+
+    'firmware_version' is None until the version of the DUT is recorded,
+    and nothing is cached before that. Each hit renews an entry, and 'evict'
+    removes entries that were not used for 'max_age_seconds' as well as the
+    least recently used ones beyond 'max_entries'. Several processes can
+    share the directory.
+    """
+    def __init__(self, directory, max_entries=DEFAULT_MAX_ENTRIES, max_age_seconds=DEFAULT_MAX_AGE_SECONDS):
+        self._logger = logging.getLogger(__name__ + "." + self.__class__.__name__)
+        self._directory = directory
+        self._max_entries = max_entries
+        self._max_age_seconds = max_age_seconds
+        self.firmware_version = None
+        os.makedirs(directory, exist_ok=True)
+
+    def record_firmware_version(self, version):
+        if version != self.firmware_version:
+            self._logger.info(f"firmware version {version}")
+        self.firmware_version = version
+
+    def _path(self, key):
+        return os.path.join(self._directory, key + ".json")
+
+    def has_passed(self, key):
+        try:
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def record_pass(self, key, test_id):
+        entry = {"test": test_id, "firmware": self.firmware_version, "time": time.time()}
+        fd, temporary_path = tempfile.mkstemp(dir=self._directory, suffix=".tmp")
+        with os.fdopen(fd, "wt") as f:
+            json.dump(entry, f)
+        os.replace(temporary_path, self._path(key))
+
+    def evict(self):
+        """Remove old entries and the least recently used ones beyond 'max_entries'"""
+        oldest_kept = time.time() - self._max_age_seconds
+        entries = []
+        with os.scandir(self._directory) as it:
+            for entry in it:
+                if not entry.name.endswith(".json"):
+                    continue
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    pass  # Evicted by another process
+        entries.sort(reverse=True)
+        evicted = [path for index, (mtime, path) in enumerate(entries)
+                   if index >= self._max_entries or mtime < oldest_kept]
+        for path in evicted:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        if evicted:
+            self._logger.debug(f"evicted {len(evicted)} entries")
@@ -0,0 +1,33 @@
+import os
+import time
+
+from fw.device_cache import DeviceCache, cache_key
+
+
+def test_key_changes_with_firmware_source_and_params():
+    key = cache_key("v1.0", "test_x", b"source", {"n": 1})
+    assert key == cache_key("v1.0", "test_x", b"source", {"n": 1})
+    assert key != cache_key("v1.1", "test_x", b"source", {"n": 1})
+    assert key != cache_key("v1.0", "test_y", b"source", {"n": 1})
+    assert key != cache_key("v1.0", "test_x", b"changed", {"n": 1})
+    assert key != cache_key("v1.0", "test_x", b"source", {"n": 2})
+
+
+def test_passes_are_remembered(tmp_path):
+    cache = DeviceCache(str(tmp_path))
+    cache.record_firmware_version("v1.0")
+    key = cache_key(cache.firmware_version, "test_x", b"source")
+    assert not cache.has_passed(key)
+    cache.record_pass(key, "test_x")
+    assert DeviceCache(str(tmp_path)).has_passed(key)
+
+
+def test_evicts_old_and_least_recently_used_entries(tmp_path):
+    cache = DeviceCache(str(tmp_path), max_entries=2, max_age_seconds=60)
+    now = time.time()
+    for index, age in enumerate([120, 3, 2, 1]):
+        cache.record_pass(f"key{index}", f"test_{index}")
+        os.utime(tmp_path / f"key{index}.json", (now - age, now - age))
+    assert cache.has_passed("key1")  # Renews it
+    cache.evict()
+    assert sorted(os.listdir(tmp_path)) == ["key1.json", "key3.json"]
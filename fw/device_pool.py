@@ -0,0 +1,103 @@
+from collections import namedtuple
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import time
+
+from fw.cable_control import DEFAULT_STATE_FILE_PATH
+
+
+DEFAULT_LEASE_TIMEOUT_SECONDS = 60
+DEFAULT_LOCK_DIR = os.path.join(tempfile.gettempdir(), "fw-device-pool")
+
+
+DeviceConfig = namedtuple("DeviceConfig", ["name", "serial_path", "baudrate", "cable_state_file"])
+DeviceConfig.__doc__ = """Everything needed to talk to one DUT"""
+
+DEFAULT_DEVICES = [DeviceConfig("default", "/dev/ttyUSB0", 115200, DEFAULT_STATE_FILE_PATH)]
+
+
+class DevicePoolError(Exception):
+    pass
+
+
+def load_device_configs(path):
+    """Read device configs from a JSON file
+
+    The file contains an object with a "devices" list. Each device is an
+    object with the fields of DeviceConfig.
+    """
+    with open(path, "rt") as f:
+        content = json.load(f)
+    return [DeviceConfig(**device) for device in content["devices"]]
+
+
+class DevicePool:
+    """Lease devices exclusively, also across processes
+
+    Each device has a lock file in 'lock_dir'. A device is leased by taking
+    an exclusive lock on its file, which is released automatically if the
+    process dies. This lets parallel test processes (for example
+    pytest-xdist workers) each get a DUT of their own.
+    """
+    def __init__(self, devices, lock_dir=DEFAULT_LOCK_DIR):
+        assert devices, "Device pool is empty"
+        self._logger = logging.getLogger(__name__ + "." + self.__class__.__name__)
+        self._devices = list(devices)
+        self._lock_dir = lock_dir
+        os.makedirs(lock_dir, exist_ok=True)
+
+    @property
+    def devices(self):
+        return list(self._devices)
+
+    @contextmanager
+    def lease(self, preferred_index=0, timeout_seconds=DEFAULT_LEASE_TIMEOUT_SECONDS):
+        """Lease a free device for the duration of the context
+
+        Devices are tried in order starting at 'preferred_index' (modulo the
+        number of devices), so that workers numbered 0..N-1 spread over N
+        devices. If all devices are busy, this waits for one to become free
+        and raises DevicePoolError after 'timeout_seconds'.
+        """
+        end_time = time.monotonic() + timeout_seconds
+        count = len(self._devices)
+        while True:
+            for offset in range(count):
+                device = self._devices[(preferred_index + offset) % count]
+                lock_file = self._try_lock(device)
+                if lock_file is not None:
+                    break
+            else:
+                if time.monotonic() > end_time:
+                    raise DevicePoolError(f"No free device among {count} within {timeout_seconds} s")
+                time.sleep(0.1)
+                continue
+            break
+        self._logger.info(f"Leased device {device.name}")
+        try:
+            yield device
+        finally:
+            self._logger.info(f"Released device {device.name}")
+            lock_file.close()
+
+    def _try_lock(self, device):
+        lock_file = open(os.path.join(self._lock_dir, device.name + ".lock"), "wb")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        return lock_file
+
+
+def worker_index():
+    """Return the number of the pytest-xdist worker running this process
+
+    Returns 0 when not running under pytest-xdist.
+    """
+    worker = os.environ.get("PYTEST_XDIST_WORKER", "gw0")
+    return int(worker[2:])
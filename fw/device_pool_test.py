@@ -0,0 +1,43 @@
+import json
+
+import pytest
+
+from fw.device_pool import DeviceConfig, DevicePool, DevicePoolError, load_device_configs
+
+
+DEVICES = [DeviceConfig(f"board{i}", f"/dev/ttyUSB{i}", 115200, f"board{i}_cable.txt") for i in range(2)]
+
+
+@pytest.fixture
+def pool(tmp_path):
+    return DevicePool(DEVICES, lock_dir=str(tmp_path))
+
+
+def test_load_device_configs(tmp_path):
+    path = tmp_path / "devices.json"
+    path.write_text(json.dumps({"devices": [d._asdict() for d in DEVICES]}))
+    assert load_device_configs(str(path)) == DEVICES
+
+
+def test_workers_get_different_devices(pool):
+    with pool.lease(preferred_index=0) as a, pool.lease(preferred_index=0) as b:
+        assert {a.name, b.name} == {"board0", "board1"}
+
+
+def test_preferred_index_spreads_workers(pool):
+    with pool.lease(preferred_index=1) as device:
+        assert device.name == "board1"
+
+
+def test_released_device_can_be_leased_again(pool):
+    with pool.lease(preferred_index=0) as a:
+        pass
+    with pool.lease(preferred_index=0) as b:
+        assert a == b
+
+
+def test_no_free_device(pool):
+    with pool.lease(), pool.lease():
+        with pytest.raises(DevicePoolError):
+            with pool.lease(timeout_seconds=0):
+                pass
@@ -0,0 +1,121 @@
+import codecs
+
+
+DEFAULT_INTERN_SIZE = 1024
+INTERN_MAX_LENGTH = 64
+INTERN_PAUSE_LINES = 16 * 1024
+
+
+class LineFramer:
+    """Split a byte stream into lines of text
+
+    Received bytes are appended to a single buffer and frames are found with
+    'bytearray.find', so no intermediate copies are made before decoding.
+    Only complete frames are decoded, which means that a multibyte character
+    split across two reads is decoded correctly once the rest has arrived.
+
+    The terminator can be any byte string, for example b"\\r\\n" or b"\\0".
+    Surrounding whitespace is stripped from each line unless 'strip' is False.
+
+    Most traffic repeats the same few lines, like prompts and "OK". Lines of
+    up to INTERN_MAX_LENGTH bytes are kept in a cache of 'intern_size'
+    entries (0 turns it off), so that a repeated line is neither decoded
+    nor stripped again, and all its copies share one string object.
+    """
+    def __init__(self, terminator=b"\n", encoding="utf8", strip=True, intern_size=DEFAULT_INTERN_SIZE):
+        assert terminator, "Terminator must not be empty"
+        self._terminator = terminator
+        self._encoding = encoding
+        self._strip = strip
+        self._buffer = bytearray()
+        self._decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        self._intern_size = intern_size
+        self._interned = {}  # bytes of a line -> decoded line
+        self._lookups = 0  # Since the cache was last cleared
+        self._intern_paused = 0  # Number of lines to decode without the cache
+
+    def feed(self, data):
+        """Add received bytes and return a list of the lines completed by them"""
+        buffer = self._buffer
+        buffer += data
+        terminator = self._terminator
+        interned = self._interned if self._intern_size else None
+        lines = []
+        start = 0
+        with memoryview(buffer) as view:
+            while True:
+                end = buffer.find(terminator, start)
+                if end < 0:
+                    break
+                if interned is not None and end - start <= INTERN_MAX_LENGTH and not self._intern_paused:
+                    self._lookups += 1
+                    key = bytes(view[start:end])
+                    line = interned.get(key)
+                    if line is None:
+                        line = self._decode(view[start:end])
+                        if len(interned) >= self._intern_size:
+                            self._refresh_interned()
+                        interned[key] = line
+                else:
+                    line = self._decode(view[start:end])
+                    if self._intern_paused:
+                        self._intern_paused -= 1
+                lines.append(line)
+                start = end + len(terminator)
+        if start:
+            del buffer[:start]
+        return lines
+
+    def _refresh_interned(self):
+        # Start over with the lines that are still repeated from now on. The
+        # cache filled up with one entry per miss, so if fewer than half of the
+        # lookups were hits, like in a boot log of numbered lines, looking lines
+        # up only costs time and the cache takes a break.
+        if self._lookups < 2 * self._intern_size:
+            self._intern_paused = INTERN_PAUSE_LINES
+        self._interned.clear()
+        self._lookups = 0
+
+    def _decode(self, data):
+        line = self._decoder.decode(data, final=True)
+        return line.strip() if self._strip else line
+
+    def encode(self, line):
+        """Return the bytes to send for a line"""
+        return line.encode(self._encoding) + self._terminator
+
+
+class LengthPrefixedFramer:
+    """Split a byte stream into binary frames preceded by their length
+
+    Each frame starts with an unsigned integer header of 'header_size' bytes
+    giving the number of payload bytes that follow. Frames are returned as
+    bytes objects.
+    """
+    def __init__(self, header_size=2, byteorder="big"):
+        self._header_size = header_size
+        self._byteorder = byteorder
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """Add received bytes and return a list of the frames completed by them"""
+        buffer = self._buffer
+        buffer += data
+        header_size = self._header_size
+        frames = []
+        start = 0
+        with memoryview(buffer) as view:
+            while len(buffer) - start >= header_size:
+                length = int.from_bytes(view[start:start + header_size], self._byteorder)
+                end = start + header_size + length
+                if end > len(buffer):
+                    break
+                frames.append(bytes(view[start + header_size:end]))
+                start = end
+        if start:
+            del buffer[:start]
+        return frames
+
+    def encode(self, payload):
+        """Return the bytes to send for a frame"""
+        return len(payload).to_bytes(self._header_size, self._byteorder) + payload
@@ -0,0 +1,48 @@
+from fw.framing import LineFramer, LengthPrefixedFramer, INTERN_PAUSE_LINES
+
+
+def test_lines_split_across_reads():
+    f = LineFramer()
+    assert f.feed(b"Boot") == []
+    assert f.feed(b"ing...\r\nLoading") == ["Booting..."]
+    assert f.feed(b" blocks...\r\nBlock 0 loaded\r\n") == ["Loading blocks...", "Block 0 loaded"]
+
+
+def test_multibyte_character_split_across_reads():
+    f = LineFramer()
+    data = "Temperatur 23 °C\n".encode("utf8")
+    split = data.index("°".encode("utf8")) + 1
+    assert f.feed(data[:split]) == []
+    assert f.feed(data[split:]) == ["Temperatur 23 °C"]
+
+
+def test_nul_terminator():
+    f = LineFramer(terminator=b"\0", strip=False)
+    assert f.feed(b"a \0b\0c") == ["a ", "b"]
+    assert f.encode("c") == b"c\0"
+
+
+def test_repeated_lines_share_one_string():
+    f = LineFramer(intern_size=2)
+    first, second = f.feed(b"OK\r\nOK\r\n")
+    assert first == second == "OK"
+    assert first is second
+    assert f.feed(b"a\nb\nc\nOK\n" + b"x" * 100 + b"\n") == ["a", "b", "c", "OK", "x" * 100]
+
+
+def test_interning_pauses_for_lines_that_do_not_repeat():
+    f = LineFramer(intern_size=4)
+    lines = [f"Block {i} loaded" for i in range(8)]
+    assert f.feed("".join(line + "\n" for line in lines).encode("utf8")) == lines
+    first, second = f.feed(b"OK\nOK\n")
+    assert first == second and first is not second
+    f.feed(b"\n" * INTERN_PAUSE_LINES)
+    first, second = f.feed(b"OK\nOK\n")
+    assert first is second
+
+
+def test_length_prefixed_frames():
+    f = LengthPrefixedFramer(header_size=2)
+    data = f.encode(b"\x00\x01\n") + f.encode(b"") + f.encode(b"xyz")
+    assert f.feed(data[:4]) == []
+    assert f.feed(data[4:]) == [b"\x00\x01\n", b"", b"xyz"]
@@ -0,0 +1,49 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+import logging
+import threading
+
+
+DEFAULT_MAX_WORKERS = 4
+
+
+class HardwareScheduler(ExitStack):
+    """Run slow hardware actions in the background
+
+    'submit' returns a concurrent.futures.Future right away, so that other
+    setup work can be done while relays switch and devices boot. Actions on
+    the same resource (for example a charging cable or a debug port) run in
+    the order they were submitted. Actions on different resources can run at
+    the same time, unless ordered explicitly with 'after'.
+
+    This class is a context manager. Exiting it waits for all actions.
+    """
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        super().__init__()
+        self._logger = logging.getLogger(__name__ + "." + self.__class__.__name__)
+        self._executor = self.enter_context(ThreadPoolExecutor(max_workers, thread_name_prefix="hardware"))
+        self._lock = threading.Lock()
+        self._last_action = {}  # resource -> future of its last submitted action
+
+    def submit(self, resource, function, *args, after=(), **kwargs):
+        """Run 'function' once earlier actions on 'resource' and the futures in 'after' are done
+
+        If an action that this one waits for fails, this one fails with the
+        same exception without running.
+        """
+        with self._lock:
+            dependencies = list(after)
+            previous = self._last_action.get(resource)
+            if previous is not None:
+                dependencies.append(previous)
+            # Dependencies were submitted earlier and the executor starts
+            # actions in order, so waiting for them can not dead lock
+            future = self._executor.submit(self._run, dependencies, function, args, kwargs)
+            self._last_action[resource] = future
+            return future
+
+    def _run(self, dependencies, function, args, kwargs):
+        for dependency in dependencies:
+            dependency.result()
+        self._logger.debug(f"running {getattr(function, '__qualname__', function)}")
+        return function(*args, **kwargs)
@@ -0,0 +1,40 @@
+import threading
+import time
+
+import pytest
+
+from fw.hardware_scheduler import HardwareScheduler
+
+
+TEST_TIMEOUT_SECONDS = 1  # Should be instant in unit tests
+
+
+def test_actions_on_same_resource_run_in_order():
+    done = []
+    resource = object()
+    with HardwareScheduler() as hs:
+        slow = hs.submit(resource, lambda: (time.sleep(0.05), done.append("slow")))
+        fast = hs.submit(resource, lambda: done.append("fast"))
+        fast.result(TEST_TIMEOUT_SECONDS)
+    assert done == ["slow", "fast"]
+
+
+def test_actions_on_different_resources_overlap():
+    barrier = threading.Barrier(2, timeout=TEST_TIMEOUT_SECONDS)
+    with HardwareScheduler() as hs:
+        a = hs.submit("a", barrier.wait)
+        b = hs.submit("b", barrier.wait)
+        a.result(TEST_TIMEOUT_SECONDS)
+        b.result(TEST_TIMEOUT_SECONDS)
+
+
+def test_failed_dependency_fails_dependent():
+    ran = []
+    def fail():
+        raise RuntimeError("relay stuck")
+    with HardwareScheduler() as hs:
+        failing = hs.submit("cable", fail)
+        dependent = hs.submit("port", ran.append, 1, after=[failing])
+        with pytest.raises(RuntimeError):
+            dependent.result(TEST_TIMEOUT_SECONDS)
+    assert ran == []
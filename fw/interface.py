@@ -18,6 +18,38 @@ class Port:
         """Send a value"""
         raise NotImplementedError()
 
-    def listen(self):
-        """Returns a Listener context manager"""
+    def listen(self, since=None):
+        """Returns a Listener context manager
+
+        Values already received can be included by passing a sequence number
+        or time.monotonic() timestamp as 'since', as far as they are still in
+        the history of the port (see fw.stream.Dispatcher).
+        """
+        raise NotImplementedError()
+
+    @property
+    def watchers(self):
+        """The fw.watchers.WatcherRegistry that checks each received value"""
+        raise NotImplementedError()
+
+
+class AsyncPort:
+    """Bidirection communication of values on an asyncio event loop
+
+    This is the asyncio counterpart of Port, with the same sharing semantics.
+    Sending is a coroutine and 'listen' returns an async context manager
+    whose methods must be awaited.
+    """
+
+    async def send(self, value):
+        """Send a value"""
+        raise NotImplementedError()
+
+    def listen(self, since=None):
+        """Returns an AsyncListener async context manager"""
+        raise NotImplementedError()
+
+    @property
+    def watchers(self):
+        """The fw.watchers.WatcherRegistry that checks each received value"""
         raise NotImplementedError()
@@ -0,0 +1,107 @@
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+from fw.metrics import Histogram, SECONDS_SCALE
+from fw.timeout import Deadline
+
+
+DEFAULT_PERCENTILE = 99.9
+DEFAULT_MARGIN = 3
+DEFAULT_MIN_SAMPLES = 20
+DEFAULT_MIN_TIMEOUT_SECONDS = 1
+
+
+class LatencyModel:
+    """Timeouts learned from how long things took before
+
+    Durations are recorded per key, for example "command.version" or
+    "boot.authenticate". Once a key has at least 'min_samples' durations, its
+    timeout is the given percentile of them times 'margin', but at least
+    'min_timeout_seconds'. Until then the default timeout is used. This way a
+    hung DUT is found out quickly, while slower builds still get a multiple of
+    the usual time.
+
+    If 'path' is given, durations recorded before are loaded from that JSON
+    file, and 'save' adds the new ones to it. Saving locks the file, so
+    several processes can share it. All methods are thread safe.
+    """
+    def __init__(self, path=None, percentile=DEFAULT_PERCENTILE, margin=DEFAULT_MARGIN,
+                 min_samples=DEFAULT_MIN_SAMPLES, min_timeout_seconds=DEFAULT_MIN_TIMEOUT_SECONDS):
+        self._logger = logging.getLogger(__name__ + "." + self.__class__.__name__)
+        self._path = path
+        self._percentile = percentile
+        self._margin = margin
+        self._min_samples = min_samples
+        self._min_timeout_seconds = min_timeout_seconds
+        self._lock = threading.Lock()
+        self._histograms = {}  # key -> Histogram of all durations
+        self._new = {}  # key -> Histogram of durations not saved yet
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, "rt") as f:
+                    self._histograms = _load(f)
+            except ValueError as e:
+                self._logger.warning(f"Ignoring unreadable latency stats in {path}: {e}")
+
+    def record(self, key, seconds):
+        with self._lock:
+            for histograms in (self._histograms, self._new):
+                histogram = histograms.get(key)
+                if histogram is None:
+                    histogram = histograms[key] = Histogram(SECONDS_SCALE)
+                histogram.record(seconds)
+
+    def timeout(self, key, default_seconds):
+        """Return the learned timeout for 'key', or 'default_seconds' if there is too little data"""
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None or histogram.count < self._min_samples:
+                return default_seconds
+            learned = histogram.percentile(self._percentile) * self._margin
+        return max(learned, self._min_timeout_seconds)
+
+    @contextmanager
+    def measure(self, key, default_seconds):
+        """Give a Deadline with the timeout for 'key' and record the duration of the context
+
+        Nothing is recorded if the context raises an exception, so timeouts
+        do not count as durations.
+        """
+        start = time.monotonic()
+        yield Deadline(self.timeout(key, default_seconds))
+        self.record(key, time.monotonic() - start)
+
+    def save(self):
+        """Add the durations recorded since the last save to the file"""
+        if self._path is None:
+            return
+        with self._lock:
+            new, self._new = self._new, {}
+        with open(self._path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                histograms = _load(f)
+            except ValueError:
+                histograms = {}  # Replace an unreadable file
+            for key, histogram in new.items():
+                if key in histograms:
+                    histograms[key].merge(histogram)
+                else:
+                    histograms[key] = histogram
+            f.seek(0)
+            f.truncate()
+            json.dump({key: histogram.as_dict() for key, histogram in sorted(histograms.items())}, f)
+        self._logger.debug(f"saved durations of {len(new)} keys to {self._path}")
+
+
+def _load(f):
+    f.seek(0)
+    content = f.read()
+    if not content:
+        return {}
+    return {key: Histogram.from_dict(data) for key, data in json.loads(content).items()}
@@ -0,0 +1,47 @@
+import pytest
+
+from fw.latency_model import LatencyModel
+
+
+def test_default_until_enough_samples():
+    model = LatencyModel(min_samples=3, margin=2, min_timeout_seconds=0.1)
+    model.record("command.ping", 0.5)
+    model.record("command.ping", 0.5)
+    assert model.timeout("command.ping", 20) == 20
+    model.record("command.ping", 1.0)
+    assert model.timeout("command.ping", 20) == pytest.approx(2.0, rel=0.05)
+    assert model.timeout("command.version", 20) == 20
+
+
+def test_minimum_timeout():
+    model = LatencyModel(min_samples=1, min_timeout_seconds=1)
+    model.record("command.ping", 0.001)
+    assert model.timeout("command.ping", 20) == 1
+
+
+def test_failed_measurements_are_not_recorded():
+    model = LatencyModel(min_samples=1)
+    with pytest.raises(RuntimeError):
+        with model.measure("boot.authenticate", 60):
+            raise RuntimeError()
+    assert model.timeout("boot.authenticate", 60) == 60
+
+
+def test_durations_are_saved_between_sessions(tmp_path):
+    path = str(tmp_path / "latency.json")
+    for _ in range(2):
+        model = LatencyModel(path, min_samples=2, margin=1, min_timeout_seconds=0)
+        model.record("command.ping", 2.0)
+        model.save()
+    assert LatencyModel(path, min_samples=2, margin=1, min_timeout_seconds=0).timeout("command.ping", 20) == \
+        pytest.approx(2.0, rel=0.05)
+
+
+def test_unreadable_file_is_ignored(tmp_path):
+    path = tmp_path / "latency.json"
+    path.write_text("not json")
+    model = LatencyModel(str(path), min_samples=1)
+    assert model.timeout("command.ping", 20) == 20
+    model.record("command.ping", 2.0)
+    model.save()
+    assert LatencyModel(str(path), min_samples=1).timeout("command.ping", 20) != 20
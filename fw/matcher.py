@@ -0,0 +1,112 @@
+from collections import namedtuple
+import re
+
+
+Match = namedtuple("Match", ["pattern", "value", "match"])
+Match.__doc__ = """Result of a successful match
+
+'pattern' is the pattern that matched, 'value' is the value that was matched
+and 'match' is the match object (a re.Match for prefixes and regular
+expressions, the return value for predicates and None for literals).
+"""
+
+
+class Prefix:
+    """Pattern that matches values that start with the given string"""
+    __slots__ = ("prefix",)
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+    def __repr__(self):
+        return f"Prefix({self.prefix!r})"
+
+
+class Matcher:
+    """Match values against several patterns at once
+
+    A pattern can be one of:
+
+    - a string, which matches values that are equal to it
+    - a Prefix, which matches values that start with its string
+    - a compiled regular expression, which matches values where it is found
+    - a callable, which matches values for which it returns a true value
+
+    The patterns are compiled when the matcher is created: literals are put in
+    a dict and all prefixes are combined into a single regular expression. If
+    several patterns match a value, the one given first wins.
+
+    Values that are not strings only match literals that are equal to them and
+    predicates, which are checked one by one.
+    """
+    def __init__(self, *patterns):
+        self.patterns = patterns
+        self._literals = {}
+        self._others = []  # (index, match function) pairs in pattern order
+        prefix_alternatives = []
+        for index, pattern in enumerate(patterns):
+            if isinstance(pattern, str):
+                self._literals.setdefault(pattern, index)
+            elif isinstance(pattern, Prefix):
+                prefix_alternatives.append(f"(?P<p{index}>{re.escape(pattern.prefix)})")
+            elif isinstance(pattern, re.Pattern):
+                self._others.append((index, pattern.search))
+            elif callable(pattern):
+                self._others.append((index, pattern))
+            else:
+                raise TypeError(f"Unsupported pattern: {pattern!r}")
+        if prefix_alternatives:
+            self._prefixes = re.compile("|".join(prefix_alternatives))
+        else:
+            self._prefixes = None
+
+    def __repr__(self):
+        return "Matcher(" + ", ".join(repr(pattern) for pattern in self.patterns) + ")"
+
+    def match(self, value):
+        """Return a Match for the first pattern that matches value, or None"""
+        if not isinstance(value, str):
+            return self._match_other(value)
+        no_match = len(self.patterns)
+        best = self._literals.get(value, no_match)
+        match = None
+        if self._prefixes is not None:
+            m = self._prefixes.match(value)
+            if m is not None:
+                index = int(m.lastgroup[1:])
+                if index < best:
+                    best, match = index, m
+        for index, function in self._others:
+            if index >= best:
+                break
+            result = function(value)
+            if result:
+                best, match = index, result
+                break
+        if best == no_match:
+            return None
+        return Match(self.patterns[best], value, match)
+
+    def _match_other(self, value):
+        # May be unhashable, and neither prefixes nor regular expressions apply
+        for pattern in self.patterns:
+            if isinstance(pattern, str):
+                if pattern == value:
+                    return Match(pattern, value, None)
+            elif not isinstance(pattern, (Prefix, re.Pattern)):
+                result = pattern(value)
+                if result:
+                    return Match(pattern, value, result)
+        return None
+
+
+def as_matcher(expected):
+    """Turn a pattern, a list or tuple of patterns or a matcher into a matcher"""
+    if isinstance(expected, Matcher):
+        return expected
+    elif isinstance(expected, (tuple, list)):
+        return Matcher(*expected)
+    elif isinstance(expected, (set, frozenset)):
+        raise TypeError("Patterns must be given in order, as a list or tuple, since the first one wins")
+    else:
+        return Matcher(expected)
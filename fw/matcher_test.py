@@ -0,0 +1,75 @@
+import re
+
+import pytest
+
+from fw.matcher import Matcher, Prefix, as_matcher
+from fw.stream import Dispatcher, Listener
+
+
+TEST_TIMEOUT_SECONDS = 1  # Should be instant in unit tests
+
+
+def test_literal():
+    m = Matcher("Booting...", "Loading blocks...")
+    match = m.match("Loading blocks...")
+    assert match.pattern == "Loading blocks..."
+    assert match.match is None
+    assert m.match("Booting") is None
+
+
+def test_prefix():
+    m = Matcher(Prefix("Block "), Prefix("Bl"))
+    match = m.match("Block 3 loaded")
+    assert match.pattern.prefix == "Block "
+    assert match.match.group() == "Block "
+
+
+def test_regex():
+    m = Matcher(re.compile(r"Block (\d+) loaded"))
+    assert m.match("Block 7 loaded").match.group(1) == "7"
+    assert m.match("Starting user space") is None
+
+
+def test_predicate():
+    m = Matcher(str.isdigit)
+    assert m.match("42").match is True
+    assert m.match("x") is None
+
+
+def test_first_pattern_wins():
+    m = Matcher(Prefix("OK"), "OK")
+    assert isinstance(m.match("OK").pattern, Prefix)
+    m = Matcher("OK", Prefix("OK"))
+    assert m.match("OK").pattern == "OK"
+    m = Matcher(lambda value: value == "OK", Prefix("O"))
+    assert m.match("OK").match is True
+
+
+def test_values_that_are_not_strings():
+    m = Matcher(Prefix("x"), re.compile("x"), "x", lambda value: value == ["x"])
+    assert m.match(["x"]).match is True
+    assert m.match({"x": 1}) is None
+    assert m.match(None) is None
+
+
+def test_unsupported_pattern():
+    with pytest.raises(TypeError):
+        Matcher(42)
+
+
+def test_as_matcher():
+    m = Matcher("x")
+    assert as_matcher(m) is m
+    assert as_matcher(("x", "y")).match("y").pattern == "y"
+    with pytest.raises(TypeError):
+        as_matcher({"x", "y"})
+
+
+def test_skip_until_any_of():
+    d = Dispatcher()
+    with Listener(d) as lines:
+        for value in ["Booting...", "Block 0 loaded", "PANIC: oops", "Starting user space"]:
+            d.dispatch(value)
+        match = lines.skip_until(["Starting user space", Prefix("PANIC")], TEST_TIMEOUT_SECONDS)
+        assert match.value == "PANIC: oops"
+        assert lines.expect_next("Starting user space", TEST_TIMEOUT_SECONDS).value == "Starting user space"
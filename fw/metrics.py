@@ -0,0 +1,192 @@
+from contextlib import contextmanager
+import threading
+import time
+
+
+SUB_BUCKET_BITS = 5  # Bucket tops are 16 to 31, which gives a relative error of at most 1/16 (about 6%)
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+SECONDS_SCALE = 1_000_000  # Latencies are recorded with microsecond resolution
+
+
+class Histogram:
+    """Histogram with HDR-style log-linear buckets
+
+    Values are scaled by 'scale' and rounded to integers. Small integers get
+    a bucket each, larger ones share buckets whose width grows with the
+    magnitude, so the relative error stays bounded while the memory use only
+    grows with the logarithm of the largest value.
+    """
+    def __init__(self, scale=1):
+        self._scale = scale
+        self._buckets = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        scaled = max(0, int(value * self._scale))
+        index = _bucket_index(scaled)
+        self._buckets[index] = self._buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add all values recorded by another histogram with the same scale"""
+        for index, count in other._buckets.items():
+            self._buckets[index] = self._buckets.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def percentile(self, percent):
+        """Return an upper bound of the given percentile, or None if empty"""
+        if not self.count:
+            return None
+        rank = max(1, round(self.count * percent / 100))
+        seen = 0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen >= rank:
+                return min(_bucket_upper_bound(index) / self._scale, self.max)
+        return self.max
+
+    def as_dict(self):
+        """Return the full state as a JSON serializable dict"""
+        return {
+            "scale": self._scale,
+            "buckets": {str(index): count for index, count in self._buckets.items()},
+            "count": self.count,
+            "total": self.total,
+            "min": self.min,
+            "max": self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Make a histogram from the result of 'as_dict'"""
+        histogram = cls(data["scale"])
+        histogram._buckets = {int(index): count for index, count in data["buckets"].items()}
+        histogram.count = data["count"]
+        histogram.total = data["total"]
+        histogram.min = data["min"]
+        histogram.max = data["max"]
+        return histogram
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "min": self.min,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+def _bucket_index(value):
+    if value < SUB_BUCKET_COUNT:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return (shift << SUB_BUCKET_BITS) + (value >> shift)
+
+
+def _bucket_upper_bound(index):
+    if index < SUB_BUCKET_COUNT:
+        return index
+    shift = index >> SUB_BUCKET_BITS
+    top = index & (SUB_BUCKET_COUNT - 1)
+    return ((top + 1) << shift) - 1
+
+
+class MetricsRegistry:
+    """Named counters and histograms
+
+    All methods are thread safe. Histograms are created on first use. While
+    'enabled' is false nothing is recorded, so that hot paths do not take
+    the lock. Callers can check it to skip computing values too.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def increment(self, name, amount=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def observe(self, name, value):
+        """Record a value that is not a duration, like a count or a size"""
+        self._record(name, value, 1)
+
+    def observe_seconds(self, name, seconds):
+        """Record a duration"""
+        self._record(name, seconds, SECONDS_SCALE)
+
+    def _record(self, name, value, scale):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram(scale)
+            histogram.record(value)
+
+    @contextmanager
+    def timer(self, name):
+        """Record the duration of the context"""
+        if not self.enabled:
+            yield
+            return
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe_seconds(name, time.monotonic() - start)
+
+    def merge(self, other):
+        """Add everything recorded by another registry"""
+        counters, histograms = other._take_copy()
+        with self._lock:
+            for name, value in counters.items():
+                self._counters[name] = self._counters.get(name, 0) + value
+            for name, histogram in histograms.items():
+                own = self._histograms.get(name)
+                if own is None:
+                    own = self._histograms[name] = Histogram(histogram._scale)
+                own.merge(histogram)
+
+    def _take_copy(self):
+        with self._lock:
+            histograms = {}
+            for name, histogram in self._histograms.items():
+                copy = histograms[name] = Histogram(histogram._scale)
+                copy.merge(histogram)
+            return dict(self._counters), histograms
+
+    def snapshot(self):
+        """Return the current values as a JSON serializable dict"""
+        counters, histograms = self._take_copy()
+        return {
+            "counters": counters,
+            "histograms": {name: histogram.summary() for name, histogram in sorted(histograms.items())},
+        }
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+metrics = MetricsRegistry(enabled=False)  # Default registry used by the fw package, see fw.metrics_plugin
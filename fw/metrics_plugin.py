@@ -0,0 +1,65 @@
+"""Pytest plugin that reports the metrics collected by fw.metrics
+
+Load with "-p fw.metrics_plugin". Use --metrics-report for a table in the
+terminal summary and --metrics-json=PATH to save per-test and per-session
+metrics as JSON. Metrics are only collected when one of them is given.
+"""
+import json
+
+import pytest
+
+from fw.metrics import metrics, MetricsRegistry
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("metrics")
+    group.addoption("--metrics-report", action="store_true",
+                    help="Show a table of stream, command and boot metrics")
+    group.addoption("--metrics-json", metavar="PATH",
+                    help="Save per-test and per-session metrics as JSON")
+
+
+def pytest_configure(config):
+    if not config.getoption("--metrics-report") and not config.getoption("--metrics-json"):
+        return
+    metrics.enabled = True
+    config.pluginmanager.register(_MetricsCollector(config), "fw-metrics-collector")
+
+
+def pytest_unconfigure(config):
+    metrics.enabled = False
+
+
+class _MetricsCollector:
+    def __init__(self, config):
+        self._config = config
+        self._session = MetricsRegistry()
+        self._per_test = {}
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_protocol(self, item):
+        metrics.reset()
+        yield
+        self._per_test[item.nodeid] = metrics.snapshot()
+        self._session.merge(metrics)
+        metrics.reset()
+
+    def pytest_sessionfinish(self, session):
+        path = self._config.getoption("--metrics-json")
+        if path:
+            with open(path, "wt") as f:
+                json.dump({"tests": self._per_test, "session": self._session.snapshot()}, f, indent=2)
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if not self._config.getoption("--metrics-report"):
+            return
+        snapshot = self._session.snapshot()
+        terminalreporter.section("metrics")
+        for name, value in sorted(snapshot["counters"].items()):
+            terminalreporter.write_line(f"{name:<32} {value:>10}")
+        columns = ["count", "mean", "p50", "p90", "p99", "max"]
+        terminalreporter.write_line(f"{'histogram':<32} " + " ".join(f"{c:>10}" for c in columns))
+        for name, summary in snapshot["histograms"].items():
+            cells = [f"{summary['count']:>10}"]
+            cells += [f"{summary[c]:>10.6g}" for c in columns[1:]]
+            terminalreporter.write_line(f"{name:<32} " + " ".join(cells))
@@ -0,0 +1,42 @@
+from fw.metrics import Histogram, MetricsRegistry
+
+
+def test_histogram_percentiles_are_close():
+    h = Histogram(scale=1000)
+    for i in range(1, 1001):
+        h.record(i / 1000)
+    assert h.count == 1000
+    assert h.min == 0.001
+    assert h.max == 1
+    assert 0.5 <= h.percentile(50) <= 0.5 * 1.04
+    assert 0.99 <= h.percentile(99) <= 1
+
+
+def test_histogram_small_values_are_exact():
+    h = Histogram()
+    for value in [0, 1, 2, 3]:
+        h.record(value)
+    assert [h.percentile(p) for p in (25, 50, 75, 100)] == [0, 1, 2, 3]
+
+
+def test_registry_merge():
+    a = MetricsRegistry()
+    b = MetricsRegistry()
+    a.increment("lines")
+    b.increment("lines", 2)
+    a.observe_seconds("echo", 0.1)
+    with b.timer("echo"):
+        pass
+    a.merge(b)
+    snapshot = a.snapshot()
+    assert snapshot["counters"] == {"lines": 3}
+    assert snapshot["histograms"]["echo"]["count"] == 2
+
+
+def test_disabled_registry_records_nothing():
+    registry = MetricsRegistry(enabled=False)
+    registry.increment("lines")
+    registry.observe("lag", 3)
+    with registry.timer("echo"):
+        pass
+    assert registry.snapshot() == {"counters": {}, "histograms": {}}
@@ -1,6 +1,6 @@
 from contextlib import ExitStack
 
-from fw.stream import Dispatcher, Listener
+from fw.stream import Dispatcher, Listener, PORT_HISTORY_SIZE, PORT_HISTORY_SECONDS
 
 
 def pipe_port_pair():
@@ -8,8 +8,8 @@ def pipe_port_pair():
 
     The ports are context managers.
     """
-    a_dispatcher = Dispatcher()
-    b_dispatcher = Dispatcher()
+    a_dispatcher = Dispatcher(retention=PORT_HISTORY_SIZE, retention_seconds=PORT_HISTORY_SECONDS)
+    b_dispatcher = Dispatcher(retention=PORT_HISTORY_SIZE, retention_seconds=PORT_HISTORY_SECONDS)
     a_port = _PipePort(own_dispatcher=a_dispatcher, other_dispatcher=b_dispatcher)
     b_port = _PipePort(own_dispatcher=b_dispatcher, other_dispatcher=a_dispatcher)
     return a_port, b_port
@@ -26,5 +26,9 @@ class _PipePort(ExitStack):
     def send(self, value):
         self._other_dispatcher.dispatch(value)
 
-    def listen(self):
-        return Listener(self._own_dispatcher)
+    def listen(self, since=None):
+        return Listener(self._own_dispatcher, since)
+
+    @property
+    def watchers(self):
+        return self._own_dispatcher.watchers
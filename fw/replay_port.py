@@ -0,0 +1,98 @@
+from contextlib import ExitStack
+import logging
+import threading
+
+from fw.capture import RECEIVED, SENT, EVENT, MARK, KIND_NAMES
+from fw.interface import Port
+from fw.stream import Dispatcher, Listener, PORT_HISTORY_SIZE, PORT_HISTORY_SECONDS
+from fw.worker_thread import worker_thread
+
+
+class ReplayError(Exception):
+    pass
+
+
+class ReplayPort(Port, ExitStack):
+    """Port that plays back recorded traffic instead of talking to a DUT
+
+    'records' are fw.capture.Record tuples, for example from a
+    fw.capture.CaptureReader. Received values are dispatched to listeners
+    with their recorded timing divided by 'speed'. A speed of None plays them
+    back as fast as possible.
+
+    Sent values and events (like DTR toggles) are checked against the
+    recording: 'send' and 'toggle_dtr' raise a ReplayError if they do not
+    match the next recorded one. Playback does not pass a recorded send
+    until the same value has actually been sent, so responses never arrive
+    before their requests. When the recording ends, the stream is closed.
+
+    This class is a context manager.
+    """
+    def __init__(self, records, speed=1.0):
+        super().__init__()
+        self._logger = logging.getLogger(__name__ + "." + self.__class__.__name__)
+        self._records = [record for record in records if record.kind != MARK]
+        self._speed = speed
+        self._condition = threading.Condition()
+        self._next_outgoing = self._find_outgoing(0)
+        self._stopped = False
+        self._dispatcher = Dispatcher(retention=PORT_HISTORY_SIZE, retention_seconds=PORT_HISTORY_SECONDS)
+        self.callback(self._dispatcher.close)
+        self.enter_context(worker_thread(self._play, stop_function=self._stop))
+
+    def _find_outgoing(self, start):
+        for index in range(start, len(self._records)):
+            if self._records[index].kind != RECEIVED:
+                return index
+        return len(self._records)
+
+    def _stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def _play(self, signal_thread_ready):
+        signal_thread_ready()
+        previous_timestamp_ns = None
+        for index, record in enumerate(self._records):
+            with self._condition:
+                if record.kind == RECEIVED:
+                    if self._speed is not None and previous_timestamp_ns is not None:
+                        delay = (record.timestamp_ns - previous_timestamp_ns) / 1_000_000_000 / self._speed
+                        if delay > 0:
+                            self._condition.wait_for(lambda: self._stopped, timeout=delay)
+                else:
+                    self._condition.wait_for(lambda: self._stopped or self._next_outgoing > index)
+                if self._stopped:
+                    return
+            if record.kind == RECEIVED:
+                self._dispatcher.dispatch(record.payload.decode("utf8"))
+            previous_timestamp_ns = record.timestamp_ns
+        self._logger.debug("end of recording")
+        self._dispatcher.close()
+
+    def _expect_outgoing(self, kind, value):
+        with self._condition:
+            if self._next_outgoing >= len(self._records):
+                raise ReplayError(f"Unexpected {KIND_NAMES[kind]} {value}: recording has ended")
+            record = self._records[self._next_outgoing]
+            expected = record.payload.decode("utf8")
+            if record.kind != kind or expected != value:
+                raise ReplayError(f"Expected {KIND_NAMES[record.kind]} {expected}, got {KIND_NAMES[kind]} {value}")
+            self._next_outgoing = self._find_outgoing(self._next_outgoing + 1)
+            self._condition.notify_all()
+
+    def send(self, value):
+        self._logger.debug(f"==> {value}")
+        self._expect_outgoing(SENT, value)
+
+    def listen(self, since=None):
+        return Listener(self._dispatcher, since)
+
+    @property
+    def watchers(self):
+        return self._dispatcher.watchers
+
+    def toggle_dtr(self):
+        self._logger.debug("toggle_dtr")
+        self._expect_outgoing(EVENT, "toggle_dtr")
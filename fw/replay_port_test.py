@@ -0,0 +1,81 @@
+import time
+
+import pytest
+
+from fw.bootup import bootup, PASSWORD
+from fw.capture import Record, RECEIVED, SENT, EVENT, MARK
+from fw.command_runner import CommandRunner
+from fw.replay_port import ReplayPort, ReplayError
+from fw.stream import EndOfStreamError
+
+
+TEST_TIMEOUT_SECONDS = 1  # Should be instant in unit tests
+
+
+def recording(*entries):
+    """Make records from (seconds, kind, value) tuples"""
+    return [Record(int(seconds * 1_000_000_000), kind, value.encode("utf8")) for seconds, kind, value in entries]
+
+
+PING = recording(
+    (0.0, MARK, "test_ping"),
+    (0.0, SENT, "ping"),
+    (0.1, RECEIVED, "ping"),
+    (0.2, RECEIVED, "pong"),
+    (0.3, RECEIVED, "OK"),
+    (0.4, RECEIVED, "Enter command"),
+)
+
+BOOT = recording(
+    (0.0, EVENT, "toggle_dtr"),
+    (0.5, RECEIVED, "Booting..."),
+    (3.5, RECEIVED, "Loading blocks..."),
+    (3.7, RECEIVED, "Block 0 loaded"),
+    (3.8, RECEIVED, "Starting user space"),
+    (4.3, RECEIVED, "Enter secret password"),
+    (5.0, SENT, PASSWORD),
+    (5.1, RECEIVED, PASSWORD),
+    (5.1, RECEIVED, "Logged in"),
+    (5.1, RECEIVED, "Enter command"),
+)
+
+
+def test_command_runner():
+    with ReplayPort(PING, speed=None) as port:
+        cr = CommandRunner(port)
+        assert cr.run_command("ping", timeout_seconds=TEST_TIMEOUT_SECONDS) == ["pong"]
+
+
+def test_bootup_as_fast_as_possible():
+    with ReplayPort(BOOT, speed=None) as port, \
+         port.listen() as lines:
+        start = time.monotonic()
+        port.toggle_dtr()
+        bootup(port, lines, timeout_seconds=TEST_TIMEOUT_SECONDS)
+        assert time.monotonic() - start < TEST_TIMEOUT_SECONDS
+
+
+def test_timing_is_scaled():
+    with ReplayPort(PING, speed=4) as port, \
+         port.listen() as lines:
+        start = time.monotonic()
+        port.send("ping")
+        lines.skip_until("Enter command", timeout_seconds=TEST_TIMEOUT_SECONDS)
+        assert 0.09 < time.monotonic() - start < 0.5
+
+
+def test_mismatching_send():
+    with ReplayPort(PING, speed=None) as port:
+        with pytest.raises(ReplayError):
+            port.send("version")
+
+
+def test_end_of_recording():
+    with ReplayPort(PING, speed=None) as port, \
+         port.listen() as lines:
+        port.send("ping")
+        lines.skip_until("Enter command", timeout_seconds=TEST_TIMEOUT_SECONDS)
+        with pytest.raises(EndOfStreamError):
+            lines.next(timeout_seconds=TEST_TIMEOUT_SECONDS)
+        with pytest.raises(ReplayError):
+            port.send("ping")
@@ -1,81 +1,117 @@
 from contextlib import ExitStack
 import logging
-from queue import Queue
+import selectors
+import termios
 import time
-import threading
-
-import serial
 
+from fw.capture import RECEIVED, SENT, EVENT
+from fw.framing import LineFramer
 from fw.interface import Port
-from fw.stream import Dispatcher, Listener, EndOfStreamError
-from fw.worker_thread import worker_thread
+from fw.stream import Dispatcher, Listener, PORT_HISTORY_SIZE, PORT_HISTORY_SECONDS
+from fw.worker_thread import worker_thread, Waker
+
+
+READ_BUFFER_SIZE = 4096
 
 
 class SerialPort(Port, ExitStack):
     """Line based communication using a serial port
 
+    A background thread waits for received bytes with a selector, without a
+    timeout, and is woken up through a self-pipe when the port is closed.
+    Received bytes are read in bulk and split into values by a framer. The
+    default framer is a LineFramer, which gives lines of text. Pass a framer
+    to use another terminator or binary frames.
+
+    If a fw.capture.TrafficRecorder is given, all traffic is recorded by it.
+    Logging of each line can then be turned off with 'log_traffic', which
+    keeps string formatting and terminal output off the receive thread.
+
     This class is a context manager.
     """
-    def __init__(self, device, baudrate):
+    def __init__(self, device, baudrate, framer=None, recorder=None, log_traffic=True):
         super().__init__()
         self._logger = logging.getLogger(__name__ + "." + self.__class__.__name__)
         self._logger.debug("init")
         self.callback(self._logger.debug, "close")
 
-        # Workaround for incompatibility between Linux DTR handling and
-        # Arduino usage of DTR for reset
-        import os
-        os.system(f"stty -F {device} -hupcl")
-
-        self._incoming_line_dispatcher = Dispatcher()
+        self._framer = framer if framer is not None else LineFramer()
+        self._recorder = recorder
+        self._log_traffic = log_traffic
+        self._incoming_line_dispatcher = Dispatcher(retention=PORT_HISTORY_SIZE,
+                                                    retention_seconds=PORT_HISTORY_SECONDS)
         self.callback(self._incoming_line_dispatcher.close)
 
-        # Open port using pyserial
+        # Open port using pyserial. Imported here so that test runs that do
+        # not touch the hardware do not pay for it.
+        import serial
         self._serial = serial.Serial()
         self._serial.port = device
         self._serial.baudrate = baudrate
-        self._serial.timeout = 1  # timeout for reads
+        self._serial.timeout = 0  # Waiting is done by the selector
         self._serial.open()
+        self.callback(self._serial.close)
+        disable_hangup_on_close(self._serial.fileno())
 
-        # Start background worker thread and make sure it and the socket are
-        # torn down at exit
+        # Start background worker thread and make sure it is stopped before
+        # the port is closed at exit
+        self._waker = self.enter_context(Waker())
         self.enter_context(worker_thread(worker_function=self._receive_lines,
-                                         stop_function=self._serial.close))
-
-    def _close(self):
-        self._logger.debug("close")
-        self._serial.close()
+                                         stop_function=self._waker.wake))
 
     def _receive_lines(self, signal_thread_ready):
         self._logger.debug("worker thread begin")
-        try:
+        read_buffer = memoryview(bytearray(READ_BUFFER_SIZE))
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._serial.fileno(), selectors.EVENT_READ)
+            selector.register(self._waker, selectors.EVENT_READ)
             signal_thread_ready()
             while True:
-                byteline = self._serial.readline()
-                if byteline is None:
-                    return
-                elif byteline:
-                    line = byteline.decode("utf8").strip()
-                    self._logger.info("<== " + line)
+                ready = [key.fileobj for key, _ in selector.select()]
+                if self._waker in ready:
+                    break
+                # Take everything that has been received so far
+                size = min(max(self._serial.in_waiting, 1), READ_BUFFER_SIZE)
+                count = self._serial.readinto(read_buffer[:size])
+                for line in self._framer.feed(read_buffer[:count]):
+                    if self._recorder is not None:
+                        self._recorder.record(RECEIVED, line)
+                    if self._log_traffic:
+                        self._logger.info(f"<== {line}")
                     self._incoming_line_dispatcher.dispatch(line)
-        except Exception as e:
-            if self._serial.is_open:
-                raise e
-            else:
-                # About to shut down. Error probably caused by that.
-                pass
         self._logger.debug("worker thread end")
 
     def send(self, line):
-        self._logger.info("==> " + line)
-        self._serial.write(line.encode("utf8") + b"\n")
+        if self._recorder is not None:
+            self._recorder.record(SENT, line)
+        if self._log_traffic:
+            self._logger.info(f"==> {line}")
+        self._serial.write(self._framer.encode(line))
 
-    def listen(self):
+    def listen(self, since=None):
         self._logger.debug("listen")
-        return Listener(self._incoming_line_dispatcher)
+        return Listener(self._incoming_line_dispatcher, since)
+
+    @property
+    def watchers(self):
+        return self._incoming_line_dispatcher.watchers
 
     def toggle_dtr(self):
         self._logger.debug("toggle_dtr")
+        if self._recorder is not None:
+            self._recorder.record(EVENT, "toggle_dtr")
         self._serial.dtr = False
         time.sleep(0.1)
         self._serial.dtr = True
+
+
+def disable_hangup_on_close(fd):
+    """Keep DTR asserted when the serial device open as 'fd' is closed
+
+    Workaround for incompatibility between Linux DTR handling and Arduino
+    usage of DTR for reset. Same as "stty -hupcl", but without starting a
+    process for it.
+    """
+    attributes = termios.tcgetattr(fd)
+    attributes[2] &= ~termios.HUPCL  # cflag
+    termios.tcsetattr(fd, termios.TCSANOW, attributes)
@@ -0,0 +1,17 @@
+import os
+import termios
+
+from fw.serial_port import disable_hangup_on_close
+
+
+def test_disable_hangup_on_close():
+    parent_fd, child_fd = os.openpty()
+    try:
+        attributes = termios.tcgetattr(child_fd)
+        attributes[2] |= termios.HUPCL
+        termios.tcsetattr(child_fd, termios.TCSANOW, attributes)
+        disable_hangup_on_close(child_fd)
+        assert not termios.tcgetattr(child_fd)[2] & termios.HUPCL
+    finally:
+        os.close(child_fd)
+        os.close(parent_fd)
@@ -1,13 +1,22 @@
 from contextlib import contextmanager
+from enum import Enum
 import logging
-from queue import Queue, Empty
+import threading
+import time
 
-
-from fw.timeout import TimeoutCalculator
+from fw.matcher import as_matcher
+from fw.metrics import metrics
+from fw.timeout import resolve_timeout
+from fw.watchers import WatcherRegistry
 
 
 DEFAULT_TIMEOUT_SECONDS = 60
+DEFAULT_BUFFER_CAPACITY = 4096
+DEFAULT_MAX_BUFFER_CAPACITY = 1 << 20  # Values, limits OverflowPolicy.GROW
+PORT_HISTORY_SIZE = 1024  # Values kept for late listeners of ports
+PORT_HISTORY_SECONDS = 60
 END_OF_STREAM = object()  # Unique sentinel value
+NO_VALUE = object()  # Unique sentinel value
 
 
 class StreamError(Exception):
@@ -26,31 +35,200 @@ class TimeoutError(StreamError):
     pass
 
 
+class BufferOverflowError(StreamError):
+    pass
+
+
+class OverflowPolicy(Enum):
+    """What a dispatcher does when its slowest listener is a full buffer behind"""
+    GROW = "grow"
+    BLOCK = "block"
+    DROP_OLDEST = "drop_oldest"
+    RAISE = "raise"
+
+
 class Dispatcher:
     """Allow multiple listeners to independently consume a stream of values
 
     This class acts as the producer in a producer-consumer pattern, but also
     manages the life cycles of new consumers.
 
-    Each listener has its own "current value" in the stream. This is achieved
-    by having each listener consume stream values by popping them off a queue.
-    The queue represents the future values for that listener, and each
-    listener has its own queue.
+    Dispatched values are stored once in a shared ring buffer of fixed
+    capacity. Each listener has its own "current value" in the stream, which
+    is represented by a cursor (a sequence number) into the buffer. Consuming
+    a value advances the cursor of that listener only.
+
+    When the slowest listener is a whole buffer behind the producer the
+    overflow policy decides what happens to the next dispatched value:
+
+    - OverflowPolicy.GROW: the buffer doubles its capacity, so the producer
+      never waits. This is the default. Once the buffer reaches
+      'max_capacity' values it drops values like DROP_OLDEST, and it shrinks
+      back to 'capacity' when all listeners have caught up.
+    - OverflowPolicy.BLOCK: the producer waits until there is room.
+    - OverflowPolicy.DROP_OLDEST: the oldest values are dropped for the
+      listeners that have not consumed them yet. These listeners are marked
+      as lagged.
+    - OverflowPolicy.RAISE: like DROP_OLDEST, but the next read of each
+      listener that lost values raises a BufferOverflowError. The producer
+      is never interrupted.
+
+    Each dispatched value has a sequence number, counting from 0. By default
+    listeners only see values dispatched after they were added. With a
+    'retention' the dispatcher also keeps a history of up to that many of the
+    latest values, which listeners can start from or rewind into. If
+    'retention_seconds' is given, values older than that are left out of the
+    history. The history lives in the same ring buffer, so it uses no memory
+    beyond 'capacity' values, and it never holds back the producer.
+
+    Each value is also checked by the 'watchers' (a fw.watchers.WatcherRegistry)
+    before any listener can see it.
 
     The stream can also be closed. This causes listener methods to raise an
     EndOfStreamError if they attempt to read values past the end.
     """
-    def __init__(self):
+    def __init__(self, capacity=DEFAULT_BUFFER_CAPACITY, overflow=OverflowPolicy.GROW,
+                 retention=0, retention_seconds=None, max_capacity=DEFAULT_MAX_BUFFER_CAPACITY):
+        assert capacity > 0, "Capacity must be positive"
+        assert 0 <= retention <= capacity, "Retention must fit in the buffer"
+        self._logger = logging.getLogger(__name__ + "." + self.__class__.__name__)
+        self._capacity = capacity
+        self._initial_capacity = capacity
+        self._max_capacity = max(capacity, max_capacity)
+        self._overflow = overflow
+        self._retention = retention
+        self._retention_seconds = retention_seconds
+        self._buffer = [None] * capacity
+        # Dispatch times, only needed to find values in the history
+        self._timestamps = [0.0] * capacity if retention else None
+        self._write_position = 0  # Sequence number of the next value
+        self._min_position = 0  # Lower bound of all cursor positions
         self._is_closed = False
-        self._listener_queues = {}
+        self._cursors = {}
+        self._condition = threading.Condition()
+        self._producer_waiting = False
+        self._last_dispatch_time = None
+        self._dropped_values = 0  # Not yet added to the metrics
+        self._watchers = None  # Created when first used
+
+    @property
+    def watchers(self):
+        with self._condition:
+            if self._watchers is None:
+                self._watchers = WatcherRegistry()
+            return self._watchers
 
     def dispatch(self, value):
         """Distribute value to each listener
 
         This method is called by the producer."""
-        assert not self._is_closed, "Dispatcher is closed"
-        for queue in self._listener_queues.values():
-            queue.put(value)
+        now = time.monotonic()
+        if self._watchers is not None:
+            self._watchers.check(value)
+        with self._condition:
+            assert not self._is_closed, "Dispatcher is closed"
+            if self._write_position - self._min_position >= self._capacity:
+                if not self._make_room():
+                    return
+            index = self._write_position % self._capacity
+            self._buffer[index] = value
+            if self._timestamps is not None:
+                self._timestamps[index] = now
+            self._write_position += 1
+            self._condition.notify_all()
+            dropped, self._dropped_values = self._dropped_values, 0
+            last_dispatch_time, self._last_dispatch_time = self._last_dispatch_time, now
+        # Metrics are recorded outside the condition, see 'read'
+        if metrics.enabled:
+            if dropped:
+                metrics.increment("stream.dropped_values", dropped)
+            if last_dispatch_time is not None:
+                metrics.observe_seconds("stream.line_interval", now - last_dispatch_time)
+
+    def _make_room(self):
+        # Cursors only move forward, so the cached minimum only needs to be
+        # recalculated when the buffer looks full.
+        self._update_min_position()
+        if not self._is_full():
+            return True
+        if self._overflow is OverflowPolicy.BLOCK:
+            self._producer_waiting = True
+            try:
+                self._condition.wait_for(lambda: self._update_min_position() or not self._is_full())
+            finally:
+                self._producer_waiting = False
+            return not self._is_closed
+        elif self._overflow is OverflowPolicy.GROW and self._capacity < self._max_capacity:
+            self._resize(min(self._capacity * 2, self._max_capacity))
+            if self._capacity == self._max_capacity:
+                self._logger.warning(f"Buffer reached its maximum of {self._capacity} values, "
+                                     "lagging listeners will lose values")
+            return True
+        else:
+            oldest_kept = self._write_position - self._capacity + 1
+            for listener, cursor in self._cursors.items():
+                if cursor.position < oldest_kept:
+                    if not cursor.dropped:
+                        self._logger.warning(f"Listener {listener!r} is lagging, dropping values")
+                    if self._overflow is OverflowPolicy.RAISE:
+                        cursor.overflowed = True
+                    cursor.dropped += oldest_kept - cursor.position
+                    self._dropped_values += oldest_kept - cursor.position
+                    cursor.position = oldest_kept
+            self._min_position = oldest_kept
+            return True
+
+    def _shrink_if_caught_up(self):
+        # Leaves room to dispatch a few values before growing again
+        self._update_min_position()
+        if self._write_position - self._min_position <= self._initial_capacity // 2:
+            self._resize(self._initial_capacity)
+
+    def _resize(self, capacity):
+        self._logger.debug(f"resizing buffer to {capacity} values")
+        buffer = [None] * capacity
+        timestamps = [0.0] * capacity if self._timestamps is not None else None
+        # Unread values and the history are all within the last values that fit in both
+        start = max(0, self._write_position - min(capacity, self._capacity))
+        for position in range(start, self._write_position):
+            buffer[position % capacity] = self._buffer[position % self._capacity]
+            if timestamps is not None:
+                timestamps[position % capacity] = self._timestamps[position % self._capacity]
+        self._capacity = capacity
+        self._buffer = buffer
+        self._timestamps = timestamps
+
+    def _update_min_position(self):
+        if self._cursors:
+            self._min_position = min(cursor.position for cursor in self._cursors.values())
+        else:
+            self._min_position = self._write_position
+
+    def _is_full(self):
+        return not self._is_closed and self._write_position - self._min_position >= self._capacity
+
+    def _history_start(self):
+        # Sequence number of the oldest value that listeners can go back to
+        start = max(0, self._write_position - self._retention)
+        if self._retention_seconds is not None and start < self._write_position:
+            start = self._first_position_since(time.monotonic() - self._retention_seconds, start)
+        return start
+
+    def _first_position_since(self, timestamp, low):
+        # Binary search, dispatch times increase with the sequence number
+        high = self._write_position
+        while low < high:
+            middle = (low + high) // 2
+            if self._timestamps[middle % self._capacity] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    @property
+    def position(self):
+        """Sequence number of the next value to be dispatched"""
+        return self._write_position
 
     def close(self):
         """Tell listeneres stream has ended
@@ -59,33 +237,131 @@ class Dispatcher:
         dispatcher multiple times.
 
         A listener will raise an EndOfStreamError if it attempts to read any
-        values past any values already existing in its queue.
+        values past any values already existing in the buffer.
         """
-        if self._is_closed:
-            return
-        for queue in self._listener_queues.values():
-            queue.put(END_OF_STREAM)
-        self._is_closed = True
+        with self._condition:
+            self._is_closed = True
+            self._condition.notify_all()
 
-    def add_listener(self, listener):
+    def add_listener(self, listener, since=None):
         """Register a new listener
 
-        Dispatched values will appear in the returned queue, starting from the
-        time of registration. Previously dispatched values will not be seen by
-        this listener.
+        Returns the cursor of the listener. Dispatched values will be readable
+        through the cursor, starting from the time of registration. Previously
+        dispatched values will not be seen by this listener, unless 'since' is
+        given. It can be a sequence number (an int) or a time.monotonic()
+        timestamp (a float). The listener then starts with the first value in
+        the history at or after it.
         """
-        queue = Queue()
-        self._listener_queues[listener] = queue
-        return queue
+        with self._condition:
+            position = self._write_position
+            if since is not None:
+                start = self._history_start()
+                if isinstance(since, float):
+                    position = self._first_position_since(since, start)
+                else:
+                    position = min(max(since, start), self._write_position)
+                self._min_position = min(self._min_position, position)
+            cursor = _Cursor(position)
+            self._cursors[listener] = cursor
+            return cursor
 
     def remove_listener(self, listener):
         """Stop receiving values
 
         Values dispached in the future will not be seen by this listener.
         Previously dispatched values that has not been consumed by the
-        listener remains in the listener's queue.
+        listener are released, which may unblock the producer.
         """
-        del self._listener_queues[listener]
+        with self._condition:
+            del self._cursors[listener]
+            if self._producer_waiting:
+                self._condition.notify_all()
+            if self._capacity > self._initial_capacity:
+                self._shrink_if_caught_up()
+
+    def close_listener(self, listener):
+        """End the stream for one listener only, waking it up if it is waiting
+
+        The listener raises EndOfStreamError on its next read, even if it has
+        values left to read. Does nothing if the listener is not registered.
+        """
+        with self._condition:
+            cursor = self._cursors.get(listener)
+            if cursor is not None:
+                cursor.closed = True
+                self._condition.notify_all()
+
+    def rewind(self, cursor, count):
+        """Move the cursor back by up to 'count' values, but not past the history
+
+        Returns the number of values the cursor was moved back.
+        """
+        with self._condition:
+            position = max(cursor.position - count, min(self._history_start(), cursor.position))
+            rewound = cursor.position - position
+            cursor.position = position
+            self._min_position = min(self._min_position, position)
+            return rewound
+
+    def read(self, cursor, timeout_seconds):
+        """Return the value at the cursor position and advance the cursor
+
+        Blocks until a value is available. Returns END_OF_STREAM if the
+        dispatcher is closed and there are no more values to read. Raises
+        TimeoutError if no value arrived in time.
+        """
+        with self._condition:
+            if not self._can_take(cursor):
+                if not self._condition.wait_for(lambda: self._can_take(cursor), timeout=timeout_seconds):
+                    raise TimeoutError()
+            lag = self._write_position - cursor.position
+            value = self._take(cursor)
+        # Recorded outside the condition, so that the metrics lock is not
+        # taken while the producer may be waiting for the dispatcher lock
+        if metrics.enabled:
+            metrics.observe("stream.listener_lag", lag)
+        return value
+
+    def poll(self, cursor):
+        """Like 'read', but return NO_VALUE instead of waiting"""
+        with self._condition:
+            if not self._can_take(cursor):
+                return NO_VALUE
+            lag = self._write_position - cursor.position
+            value = self._take(cursor)
+        if metrics.enabled:
+            metrics.observe("stream.listener_lag", lag)
+        return value
+
+    def _can_take(self, cursor):
+        return cursor.position != self._write_position or self._is_closed or cursor.closed
+
+    def _take(self, cursor):
+        if cursor.overflowed:
+            cursor.overflowed = False
+            raise BufferOverflowError(f"Listener fell more than {self._capacity} values behind, "
+                                      f"{cursor.dropped} values dropped so far")
+        if cursor.position == self._write_position or cursor.closed:
+            return END_OF_STREAM
+        value = self._buffer[cursor.position % self._capacity]
+        cursor.position += 1
+        if self._producer_waiting:
+            self._condition.notify_all()
+        if self._capacity > self._initial_capacity and cursor.position == self._write_position:
+            self._shrink_if_caught_up()
+        return value
+
+
+class _Cursor:
+    """Read position of one listener in the ring buffer of a dispatcher"""
+    __slots__ = ("position", "dropped", "overflowed", "closed")
+
+    def __init__(self, position):
+        self.position = position
+        self.dropped = 0
+        self.overflowed = False  # Values were dropped since the last read, with OverflowPolicy.RAISE
+        self.closed = False  # Set by Dispatcher.close_listener
 
 
 class Listener:
@@ -94,56 +370,115 @@ class Listener:
     This class acts as the consumer in a producer-consumer pattern.
 
     Within the context the methods of this class can be used to consume values
-    from the stream.
+    from the stream. Timeouts can be given in seconds or as a
+    fw.timeout.Deadline, and never extend past the deadline set with
+    fw.timeout.deadline.
+
+    If the dispatcher keeps a history, 'since' (a sequence number or a
+    time.monotonic() timestamp) makes the listener start with earlier values
+    and 'rewind' goes back to values that were already consumed.
     """
-    def __init__(self, dispatcher):
+    def __init__(self, dispatcher, since=None):
         self._logger = logging.getLogger(__name__ + "." + self.__class__.__name__)
         self._dispatcher = dispatcher
-        self._queue = None
+        self._since = since
+        self._cursor = None
 
     def __enter__(self):
         self._logger.debug("enter")
-        self._queue = self._dispatcher.add_listener(self)
+        self._cursor = self._dispatcher.add_listener(self, self._since)
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         self._logger.debug("exit")
         self._dispatcher.remove_listener(self)
-        self._queue = None
+        self._cursor = None
         return False
 
-    def _next(self, timeout_seconds):
-        assert self._queue is not None, "Listener not registered"
-        try:
-            value = self._queue.get(timeout=timeout_seconds)
-        except Empty:  # "Empty" is the exception type used for get() timeouts
-            raise TimeoutError() from None  # Don't chain the new exception with the old one
+    def close(self):
+        """End the stream for this listener only
+
+        Safe to call from any thread, also after the context has exited. A
+        thread waiting in 'next' raises EndOfStreamError right away.
+        """
+        self._dispatcher.close_listener(self)
+
+    @property
+    def dropped(self):
+        """Number of values that were dropped before this listener read them"""
+        assert self._cursor is not None, "Listener not registered"
+        return self._cursor.dropped
+
+    @property
+    def lagged(self):
+        """Whether this listener has fallen behind and missed values"""
+        return self.dropped > 0
+
+    @property
+    def position(self):
+        """Sequence number of the next value this listener will consume"""
+        assert self._cursor is not None, "Listener not registered"
+        return self._cursor.position
+
+    def rewind(self, count):
+        """Go back 'count' values, as far as the history of the dispatcher allows
+
+        Returns the number of values actually gone back.
+        """
+        assert self._cursor is not None, "Listener not registered"
+        rewound = self._dispatcher.rewind(self._cursor, count)
+        self._logger.debug(f"rewind: {rewound}")
+        return rewound
+
+    def _next(self, deadline):
+        assert self._cursor is not None, "Listener not registered"
+        value = self._dispatcher.read(self._cursor, deadline.time_left_now())
         if value is END_OF_STREAM:
             raise EndOfStreamError()
         return value
 
     def next(self, timeout_seconds=DEFAULT_TIMEOUT_SECONDS):
         """Return the next value in the stream and advance the current position"""
-        line = self._next(timeout_seconds)
-        self._logger.debug(f"next: {line}")
+        line = self._next(resolve_timeout(timeout_seconds))
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(f"next: {line}")
         return line
 
-    def expect_next(self, expected_line, timeout_seconds=DEFAULT_TIMEOUT_SECONDS):
-        """Consume the next value in the stream and check that it matches the given value"""
-        self._logger.debug("expect_next: " + expected_line)
-        actual_line = self._next(timeout_seconds)
-        if actual_line != expected_line:
-            raise MatchError(f'Expected "{expected_line}", got "{actual_line}"')
+    def expect_next(self, expected, timeout_seconds=DEFAULT_TIMEOUT_SECONDS):
+        """Consume the next value in the stream and check that it matches the given pattern
 
-    def skip_until(self, expected_line, timeout_seconds=DEFAULT_TIMEOUT_SECONDS):
-        """Consume values in the stream until one that matches the given value is found"""
-        self._logger.debug(f"skip_until: {expected_line}")
+        The pattern can be anything accepted by fw.matcher.as_matcher. Returns
+        a fw.matcher.Match.
+        """
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(f"expect_next: {expected}")
+        matcher = as_matcher(expected)
+        actual_line = self._next(resolve_timeout(timeout_seconds))
+        match = matcher.match(actual_line)
+        if match is None:
+            raise MatchError(f'Expected "{expected}", got "{actual_line}"')
+        return match
+
+    def skip_until(self, expected, timeout_seconds=DEFAULT_TIMEOUT_SECONDS):
+        """Consume values in the stream until one that matches the given pattern is found
+
+        The pattern can be anything accepted by fw.matcher.as_matcher, so
+        several alternatives can be waited for at once. Returns a
+        fw.matcher.Match telling which pattern matched.
+        """
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(f"skip_until: {expected}")
+        matcher = as_matcher(expected)
         skipped = 0
-        tc = TimeoutCalculator(timeout_seconds)
+        start = time.monotonic()
+        deadline = resolve_timeout(timeout_seconds)
         while True:
-            line = self._next(tc.time_left_now())
-            if line == expected_line:
+            line = self._next(deadline)
+            match = matcher.match(line)
+            if match is not None:
                 self._logger.debug(f"skipped {skipped} lines")
-                return
+                metrics.observe_seconds("stream.skip_until.wait", time.monotonic() - start)
+                metrics.observe("stream.skip_until.skipped", skipped)
+                return match
             else:
                 skipped += 1
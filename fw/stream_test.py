@@ -0,0 +1,187 @@
+import threading
+import time
+
+import pytest
+
+from fw.stream import (Dispatcher, Listener, OverflowPolicy, BufferOverflowError,
+                       EndOfStreamError, MatchError, TimeoutError)
+
+
+TEST_TIMEOUT_SECONDS = 1  # Should be instant in unit tests
+
+
+def test_all_listeners_see_all_values():
+    d = Dispatcher()
+    with Listener(d) as a, Listener(d) as b:
+        for value in ["x", "y", "z"]:
+            d.dispatch(value)
+        assert [a.next(TEST_TIMEOUT_SECONDS) for _ in range(3)] == ["x", "y", "z"]
+        b.expect_next("x", TEST_TIMEOUT_SECONDS)
+        b.skip_until("z", TEST_TIMEOUT_SECONDS)
+
+
+def test_values_before_registration_are_not_seen():
+    d = Dispatcher()
+    d.dispatch("early")
+    with Listener(d) as lines:
+        d.dispatch("late")
+        assert lines.next(TEST_TIMEOUT_SECONDS) == "late"
+
+
+def test_expect_next_mismatch():
+    d = Dispatcher()
+    with Listener(d) as lines:
+        d.dispatch("x")
+        with pytest.raises(MatchError):
+            lines.expect_next("y", TEST_TIMEOUT_SECONDS)
+
+
+def test_timeout():
+    d = Dispatcher()
+    with Listener(d) as lines:
+        with pytest.raises(TimeoutError):
+            lines.next(timeout_seconds=0.01)
+
+
+def test_end_of_stream_after_buffered_values():
+    d = Dispatcher()
+    with Listener(d) as lines:
+        d.dispatch("x")
+        d.close()
+        assert lines.next(TEST_TIMEOUT_SECONDS) == "x"
+        with pytest.raises(EndOfStreamError):
+            lines.next(TEST_TIMEOUT_SECONDS)
+
+
+def test_close_listener_wakes_only_that_listener():
+    d = Dispatcher()
+    with Listener(d) as closed, Listener(d) as other:
+        waiter = threading.Thread(target=lambda: pytest.raises(EndOfStreamError, closed.next, None))
+        waiter.start()
+        closed.close()
+        waiter.join(TEST_TIMEOUT_SECONDS)
+        assert not waiter.is_alive()
+        d.dispatch("x")
+        assert other.next(TEST_TIMEOUT_SECONDS) == "x"
+        with pytest.raises(EndOfStreamError):
+            closed.next(TEST_TIMEOUT_SECONDS)
+    closed.close()  # Harmless after the context
+
+
+def test_drop_oldest_marks_listener_lagged():
+    d = Dispatcher(capacity=2, overflow=OverflowPolicy.DROP_OLDEST)
+    with Listener(d) as slow, Listener(d) as fast:
+        for value in ["a", "b", "c", "d"]:
+            d.dispatch(value)
+            fast.next(TEST_TIMEOUT_SECONDS)
+        assert slow.lagged
+        assert slow.dropped == 2
+        assert not fast.lagged
+        assert slow.next(TEST_TIMEOUT_SECONDS) == "c"
+
+
+def test_raise_on_overflow_in_lagging_listener():
+    d = Dispatcher(capacity=2, overflow=OverflowPolicy.RAISE)
+    with Listener(d) as slow, Listener(d) as fast:
+        for value in ["a", "b", "c"]:
+            d.dispatch(value)
+            fast.next(TEST_TIMEOUT_SECONDS)
+        with pytest.raises(BufferOverflowError):
+            slow.next(TEST_TIMEOUT_SECONDS)
+        assert slow.next(TEST_TIMEOUT_SECONDS) == "b"
+
+
+def test_grow_keeps_all_values_by_default():
+    d = Dispatcher(capacity=2, retention=2)
+    with Listener(d) as lines:
+        for value in ["a", "b", "c", "d", "e"]:
+            d.dispatch(value)
+        assert [lines.next(TEST_TIMEOUT_SECONDS) for _ in range(5)] == ["a", "b", "c", "d", "e"]
+        assert not lines.lagged
+        assert lines.rewind(5) == 2
+        assert lines.next(TEST_TIMEOUT_SECONDS) == "d"
+
+
+def test_grow_drops_oldest_at_max_capacity():
+    d = Dispatcher(capacity=2, max_capacity=4)
+    with Listener(d) as lines:
+        for value in ["a", "b", "c", "d", "e", "f"]:
+            d.dispatch(value)
+        assert [lines.next(TEST_TIMEOUT_SECONDS) for _ in range(4)] == ["c", "d", "e", "f"]
+        assert lines.dropped == 2
+
+
+def test_grown_buffer_shrinks_when_listeners_catch_up():
+    d = Dispatcher(capacity=2, retention=2)
+    with Listener(d) as lines:
+        for value in ["a", "b", "c", "d", "e"]:
+            d.dispatch(value)
+        assert d._capacity == 8
+        for _ in range(5):
+            lines.next(TEST_TIMEOUT_SECONDS)
+        assert d._capacity == 2
+        assert lines.rewind(2) == 2
+        assert lines.next(TEST_TIMEOUT_SECONDS) == "d"
+        d.dispatch("f")
+        assert [lines.next(TEST_TIMEOUT_SECONDS) for _ in range(2)] == ["e", "f"]
+
+
+def test_block_until_listener_catches_up():
+    d = Dispatcher(capacity=2, overflow=OverflowPolicy.BLOCK)
+    with Listener(d) as lines:
+        d.dispatch("a")
+        d.dispatch("b")
+        producer = threading.Thread(target=d.dispatch, args=("c",))
+        producer.start()
+        assert lines.next(TEST_TIMEOUT_SECONDS) == "a"
+        producer.join(TEST_TIMEOUT_SECONDS)
+        assert not producer.is_alive()
+        assert [lines.next(TEST_TIMEOUT_SECONDS) for _ in range(2)] == ["b", "c"]
+
+
+def test_listen_since_sequence_number():
+    d = Dispatcher(retention=2)
+    for value in ["a", "b", "c"]:
+        d.dispatch(value)
+    with Listener(d, since=2) as lines:
+        assert lines.next(TEST_TIMEOUT_SECONDS) == "c"
+    with Listener(d, since=0) as lines:
+        # "a" is no longer in the history
+        assert lines.position == 1
+        assert lines.next(TEST_TIMEOUT_SECONDS) == "b"
+
+
+def test_listen_since_timestamp():
+    d = Dispatcher(retention=10)
+    d.dispatch("before")
+    since = time.monotonic()
+    d.dispatch("after")
+    with Listener(d, since=since) as lines:
+        assert lines.next(TEST_TIMEOUT_SECONDS) == "after"
+
+
+def test_rewind_is_limited_by_retention():
+    d = Dispatcher(retention=2)
+    with Listener(d) as lines:
+        for value in ["a", "b", "c"]:
+            d.dispatch(value)
+            lines.next(TEST_TIMEOUT_SECONDS)
+        assert lines.rewind(5) == 2
+        assert [lines.next(TEST_TIMEOUT_SECONDS) for _ in range(2)] == ["b", "c"]
+
+
+def test_history_expires():
+    d = Dispatcher(retention=10, retention_seconds=0.01)
+    d.dispatch("old")
+    time.sleep(0.02)
+    d.dispatch("new")
+    with Listener(d, since=0) as lines:
+        assert lines.next(TEST_TIMEOUT_SECONDS) == "new"
+
+
+def test_no_history_by_default():
+    d = Dispatcher()
+    with Listener(d) as lines:
+        d.dispatch("a")
+        lines.next(TEST_TIMEOUT_SECONDS)
+        assert lines.rewind(1) == 0
@@ -0,0 +1,562 @@
+"""Pytest plugin with the fixtures for testing a DUT
+
+Load with "-p fw.systest_plugin". The plugin itself only imports pytest.
+Hardware fixtures import the fw modules they need, and open the serial port
+and other devices, only when a test actually uses them. So collecting tests
+or running tests that do not need the DUT stays fast.
+
+Lines from the DUT are checked by the watchers of the debug port (see
+fw.watchers), like the restart watcher of the RestartDetector. A match of a
+forbidden watcher that is not allowed fails the test that was running. Tests
+can add their own watchers with the "watchers" fixture.
+
+Tests marked with "device_cache" are skipped when they passed before with the
+same firmware version and the same source of the test module, its conftest
+files and the modules in the repository that define its fixtures (see
+fw.device_cache). The version is known once a test has recorded it through
+the "device_cache" fixture, like test_boot does. Use --no-device-cache to run
+them anyway.
+
+Tests that use the DUT are reordered to save boots: first those that power
+cycle it (marker "initialize"), then those that need it booted (marker
+"features", warm_booted or command_runner) and last those that use it
+otherwise and may leave it in any state. Tests that do not use the DUT keep
+their place. Within each group the tests that took longest in earlier runs go
+first, compared in power of two buckets so that small differences between
+runs do not change the order. With --replay-capture the tests run in the
+order they were recorded instead. Use --keep-test-order to run them in file
+order.
+
+Use --fixture-durations=N to list the N fixtures that took longest to set
+up (0 for all).
+"""
+from collections import Counter
+import inspect
+import math
+import os
+from pathlib import Path
+import time
+
+import pytest
+
+
+_DEVICE_KEY = pytest.StashKey()
+_TEST_FAILED_KEY = pytest.StashKey()
+_WATCHERS_KEY = pytest.StashKey()
+_DEVICE_CACHE_KEY = pytest.StashKey()
+_CALL_PASSED_KEY = pytest.StashKey()
+
+# Tests that use any of these get the session wide hardware checks
+_HARDWARE_FIXTURES = {"debug_port", "charging_cable"}
+
+
+def pytest_addoption(parser):
+    parser.addoption("--device-pool", metavar="PATH",
+                     help="JSON file listing the DUTs to spread test workers over")
+    parser.addoption("--traffic-capture", metavar="PATH",
+                     help="Record all debug port traffic in a binary capture file "
+                          "(one per pytest-xdist worker, with the worker id added to the name)")
+    parser.addoption("--no-traffic-log", action="store_true",
+                     help="Do not log each line sent and received on the debug port")
+    parser.addoption("--replay-capture", metavar="PATH",
+                     help="Play back a traffic capture instead of talking to a DUT")
+    parser.addoption("--replay-speed", type=float, default=0, metavar="FACTOR",
+                     help="Speed up playback of --replay-capture by FACTOR (default: as fast as possible)")
+    parser.addoption("--relay-settle-seconds", type=float, default=1, metavar="SECONDS",
+                     help="Time given to the charging cable relay before and after each switch")
+    parser.addoption("--virtual-dut", action="store_true",
+                     help="Test a simulated DUT (see fw.virtual_dut) instead of real hardware")
+    parser.addoption("--virtual-dut-speed", type=float, default=0, metavar="FACTOR",
+                     help="Run the clock of --virtual-dut FACTOR times faster (default: delays take no time)")
+    parser.addoption("--debug-port-broker", metavar="SOCKET",
+                     help="Share the debug port served by \"python -m fw.broker\" at SOCKET between workers")
+    parser.addoption("--latency-stats", metavar="PATH",
+                     help="File of command and boot durations that timeouts are learned from "
+                          "(default: in the pytest cache directory)")
+    parser.addoption("--fixed-timeouts", action="store_true",
+                     help="Use the default timeouts instead of learning them from earlier durations")
+    parser.addoption("--fixture-durations", type=int, metavar="N",
+                     help="Show the N slowest fixture setups (N=0 for all)")
+    parser.addoption("--keep-test-order", action="store_true",
+                     help="Run tests in file order instead of grouping them by the DUT state they need")
+    parser.addoption("--no-device-cache", action="store_true",
+                     help="Run tests marked device_cache even if they passed before on the same firmware")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "initialize")
+    config.addinivalue_line("markers", "features")
+    config.addinivalue_line("markers", "device_cache: skip the test if it passed before on the same firmware")
+    config.pluginmanager.register(_FixtureTimer(config), "fw-fixture-timer")
+    config.pluginmanager.register(_TestOrder(config), "fw-test-order")
+
+
+class _FixtureTimer:
+    def __init__(self, config):
+        self._config = config
+        self._durations = {}  # fixture name -> [setup count, total seconds, max seconds]
+
+    @pytest.hookimpl(wrapper=True)
+    def pytest_fixture_setup(self, fixturedef):
+        start = time.perf_counter()
+        try:
+            return (yield)
+        finally:
+            seconds = time.perf_counter() - start
+            duration = self._durations.setdefault(fixturedef.argname, [0, 0.0, 0.0])
+            duration[0] += 1
+            duration[1] += seconds
+            duration[2] = max(duration[2], seconds)
+
+    def pytest_terminal_summary(self, terminalreporter):
+        count = self._config.getoption("--fixture-durations")
+        if count is None:
+            return
+        slowest = sorted(self._durations.items(), key=lambda item: item[1][1], reverse=True)
+        if count > 0:
+            slowest = slowest[:count]
+        terminalreporter.section("fixture setup durations")
+        terminalreporter.write_line(f"{'fixture':<32} {'setups':>8} {'total s':>10} {'max s':>10}")
+        for name, (setups, total, longest) in slowest:
+            terminalreporter.write_line(f"{name:<32} {setups:>8} {total:>10.3f} {longest:>10.3f}")
+
+
+def _device_cache(config):
+    """The DeviceCache, or None if results of the DUT are not cached"""
+    if _DEVICE_CACHE_KEY not in config.stash:
+        cache = None
+        pytest_cache = getattr(config, "cache", None)  # Missing with -p no:cacheprovider
+        if pytest_cache is not None and not config.getoption("--virtual-dut") and \
+           config.getoption("--replay-capture") is None:
+            from fw.device_cache import DeviceCache
+            cache = DeviceCache(str(pytest_cache.mkdir("fw-device-cache")))
+        config.stash[_DEVICE_CACHE_KEY] = cache
+    return config.stash[_DEVICE_CACHE_KEY]
+
+
+def _device_cache_key(item):
+    """Return the cache key of a test marked device_cache, or None"""
+    if item.get_closest_marker("device_cache") is None:
+        return None
+    cache = _device_cache(item.config)
+    if cache is None or cache.firmware_version is None:
+        return None
+    from fw.device_cache import cache_key
+    params = getattr(item, "callspec", None)
+    return cache_key(cache.firmware_version, item.nodeid, _test_source(item),
+                     params.params if params is not None else None)
+
+
+def _test_source(item):
+    """Source of the test module, its conftest files and the modules of its fixtures
+
+    Only files in the root directory count, so that the result does not
+    depend on the installed pytest.
+    """
+    root = item.config.rootpath
+    paths = {item.path}
+    for directory in item.path.parents:
+        if (directory / "conftest.py").exists():
+            paths.add(directory / "conftest.py")
+        if directory == root:
+            break
+    fixture_info = getattr(item, "_fixtureinfo", None)
+    if fixture_info is not None:
+        for definitions in fixture_info.name2fixturedefs.values():
+            for definition in definitions:
+                try:
+                    path = inspect.getsourcefile(definition.func)
+                except TypeError:
+                    continue  # Built in
+                if path is not None:
+                    paths.add(Path(path))
+    source = b""
+    for path in sorted(path for path in paths if path.is_relative_to(root)):
+        source += str(path.relative_to(root)).encode("utf8") + b"\0" + path.read_bytes()
+    return source
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_runtest_setup(item):
+    if item.config.getoption("--no-device-cache"):
+        return
+    key = _device_cache_key(item)
+    if key is not None and _device_cache(item.config).has_passed(key):
+        pytest.skip(f"Passed before on firmware {_device_cache(item.config).firmware_version}")
+
+
+# Groups of tests by the state of the DUT they need. The ones after "no DUT" run in this order.
+_ORDER_GROUPS = ("no DUT", "power cycle", "booted", "any state")
+
+
+class _TestOrder:
+    def __init__(self, config):
+        self._config = config
+        self._durations = {}  # node id -> seconds, of tests that ran in this session
+        self._hardware_node_ids = set()  # Only these are reordered and their durations recorded
+        self._report = None
+
+    def _group(self, item):
+        names = item.fixturenames
+        if not _HARDWARE_FIXTURES.intersection(names):
+            return 0
+        elif "power_cycled" in names or item.get_closest_marker("initialize") is not None:
+            return 1
+        elif "warm_booted" in names or "command_runner" in names or \
+             item.get_closest_marker("features") is not None:
+            return 2
+        return 3
+
+    def _cache(self):
+        return getattr(self._config, "cache", None)  # Missing with -p no:cacheprovider
+
+    def _load_durations(self):
+        if self._cache() is None:
+            return {}
+        return self._cache().get("fw/test-durations", {})
+
+    @pytest.hookimpl(trylast=True)
+    def pytest_collection_modifyitems(self, items):
+        replay_path = self._config.getoption("--replay-capture")
+        if replay_path is not None:
+            # Durations are not recorded either, those of a replay say nothing about the DUT
+            self._order_as_recorded(items, replay_path)
+            return
+        groups = {item: self._group(item) for item in items}
+        self._hardware_node_ids = {item.nodeid for item in items if groups[item]}
+        if self._config.getoption("--keep-test-order"):
+            return
+        durations = self._load_durations()
+        keys = {item: (groups[item], -_duration_bucket(durations.get(item.nodeid, 0)), index)
+                for index, item in enumerate(items)}
+        hardware = iter(sorted((item for item in items if groups[item]), key=keys.get))
+        ordered = [next(hardware) if groups[item] else item for item in items]
+        moved = sum(1 for before, after in zip(items, ordered) if before is not after)
+        counts = Counter(groups.values())
+        self._report = [f"test order: {moved} of {len(items)} tests moved; " +
+                        ", ".join(f"{counts[group]} {name}" for group, name in enumerate(_ORDER_GROUPS))]
+        if self._config.getoption("verbose") > 0:
+            self._report += [f"  {_ORDER_GROUPS[groups[item]]:<12} {item.nodeid}" for item in ordered]
+        items[:] = ordered
+
+    def _order_as_recorded(self, items, path):
+        """A replay must send the same commands in the same order as the recording"""
+        if self._config.getoption("--keep-test-order"):
+            return
+        from fw.capture import CaptureReader
+        with CaptureReader(path) as reader:
+            recorded = {}
+            for index, test_id in enumerate(reader.test_ids()):
+                recorded.setdefault(test_id, index)
+        in_capture = iter(sorted((item for item in items if item.nodeid in recorded),
+                                 key=lambda item: recorded[item.nodeid]))
+        items[:] = [next(in_capture) if item.nodeid in recorded else item for item in items]
+        self._report = [f"test order: as recorded in {path}"]
+
+    def pytest_report_collectionfinish(self):
+        return self._report
+
+    def pytest_runtest_logreport(self, report):
+        if report.when == "call" and not report.skipped and report.nodeid in self._hardware_node_ids:
+            self._durations[report.nodeid] = report.duration
+
+    def pytest_sessionfinish(self):
+        if self._cache() is None or not self._durations:
+            return
+        durations = self._load_durations()
+        durations.update(self._durations)
+        self._cache().set("fw/test-durations", durations)
+
+
+def _duration_bucket(seconds):
+    """Bucket of a test duration: 0 below a second, then one per power of two seconds"""
+    return 0 if seconds < 1 else 1 + int(math.log2(seconds))
+
+
+@pytest.hookimpl(wrapper=True)
+def pytest_runtest_makereport(item, call):
+    report = yield
+    if report.failed:
+        item.stash[_TEST_FAILED_KEY] = True
+    if report.when == "call" and report.passed and not hasattr(report, "wasxfail"):
+        item.stash[_CALL_PASSED_KEY] = True
+    elif report.when == "teardown" and report.passed and item.stash.get(_CALL_PASSED_KEY, False):
+        key = _device_cache_key(item)
+        if key is not None:
+            _device_cache(item.config).record_pass(key, item.nodeid)
+    device = item.config.stash.get(_DEVICE_KEY, None)
+    if device is not None:
+        report.user_properties.append(("device", device.name))
+    return report
+
+
+@pytest.hookimpl(wrapper=True)
+def pytest_runtest_call(item):
+    result = yield
+    watchers = item.stash.get(_WATCHERS_KEY, None)
+    if watchers is not None:
+        violations = watchers.take_violations()
+        if violations:
+            pytest.fail("\n".join(f"Watcher {violation.name} matched: {violation.value}"
+                                   for violation in violations), pytrace=False)
+    return result
+
+
+def pytest_sessionfinish(session):
+    cache = session.config.stash.get(_DEVICE_CACHE_KEY, None)
+    if cache is not None:
+        cache.evict()
+
+
+def pytest_terminal_summary(terminalreporter):
+    per_device = {}
+    for outcome in ("passed", "failed", "error", "skipped", "xfailed", "xpassed"):
+        for report in terminalreporter.stats.get(outcome, []):
+            device = dict(getattr(report, "user_properties", [])).get("device")
+            if device is not None and (report.when == "call" or outcome != "passed"):
+                per_device.setdefault(device, Counter())[outcome] += 1
+    if per_device:
+        terminalreporter.section("results per device")
+        for device, counts in sorted(per_device.items()):
+            summary = ", ".join(f"{count} {outcome}" for outcome, count in sorted(counts.items()))
+            terminalreporter.write_line(f"{device}: {summary}")
+
+
+@pytest.fixture(scope="session")
+def device(request):
+    """The DUT leased by this test process
+
+    Without --device-pool the single default device is used. Under
+    pytest-xdist each worker leases a device of its own, unless they share
+    the first one through --debug-port-broker.
+    """
+    from fw.device_pool import DevicePool, DEFAULT_DEVICES, load_device_configs, worker_index
+    path = request.config.getoption("--device-pool")
+    devices = load_device_configs(path) if path else DEFAULT_DEVICES
+    if request.config.getoption("--debug-port-broker"):
+        # All workers share the DUT behind the broker
+        request.config.stash[_DEVICE_KEY] = devices[0]
+        yield devices[0]
+        return
+    with DevicePool(devices).lease(preferred_index=worker_index()) as leased:
+        request.config.stash[_DEVICE_KEY] = leased
+        yield leased
+
+
+@pytest.fixture(scope="session")
+def traffic_recorder(request):
+    """Records debug port traffic if --traffic-capture is given, otherwise None"""
+    path = request.config.getoption("--traffic-capture")
+    if path is None:
+        yield None
+        return
+    worker = os.environ.get("PYTEST_XDIST_WORKER")
+    if worker is not None:
+        root, extension = os.path.splitext(path)
+        path = f"{root}.{worker}{extension}"
+    from fw.capture import TrafficRecorder
+    with TrafficRecorder(path) as recorder:
+        yield recorder
+
+
+@pytest.fixture(autouse=True)
+def _hardware_checks(request):
+    """Keep the charging cable connected after the session and check the watchers
+
+    Only for tests that use the hardware, so that other tests do not open it.
+    """
+    if _HARDWARE_FIXTURES.intersection(request.fixturenames):
+        request.getfixturevalue("charging_cable")
+        request.getfixturevalue("restart_detector")
+        request.getfixturevalue("watchers")
+
+
+@pytest.fixture(autouse=True)
+def _mark_test_in_traffic_capture(request, traffic_recorder):
+    if traffic_recorder is None:
+        yield
+        return
+    traffic_recorder.mark(request.node.nodeid)
+    yield
+    traffic_recorder.mark("")
+
+
+@pytest.fixture(scope="session")
+def debug_port(request, device, traffic_recorder):
+    """Line-based access to the main debug serial port"""
+    replay_path = request.config.getoption("--replay-capture")
+    if replay_path is not None:
+        from fw.capture import CaptureReader
+        from fw.replay_port import ReplayPort
+        with CaptureReader(replay_path) as reader:
+            records = reader.records()
+        speed = request.config.getoption("--replay-speed") or None
+        with ReplayPort(records, speed=speed) as dp:
+            yield dp
+        return
+    if request.config.getoption("--virtual-dut"):
+        from fw.virtual_dut import VirtualDut, VirtualClock
+        speed = request.config.getoption("--virtual-dut-speed") or None
+        with VirtualDut(VirtualClock(speed)) as dut:
+            yield dut.port
+        return
+    broker_address = request.config.getoption("--debug-port-broker")
+    if broker_address is not None:
+        from fw.broker import BrokerPort
+        with BrokerPort(broker_address) as dp:
+            yield dp
+        return
+    from fw.serial_port import SerialPort
+    with SerialPort(device.serial_path, device.baudrate, recorder=traffic_recorder,
+                    log_traffic=not request.config.getoption("--no-traffic-log")) as dp:
+        yield dp
+
+
+@pytest.fixture(scope="session")
+def latency_model(request):
+    """Learns command and boot timeouts, or None with --fixed-timeouts
+
+    Durations are not learned when replaying a capture or testing a virtual
+    DUT, since they depend on the speed of those.
+    """
+    config = request.config
+    if config.getoption("--fixed-timeouts") or config.getoption("--virtual-dut") or \
+       config.getoption("--replay-capture") is not None:
+        yield None
+        return
+    from fw.latency_model import LatencyModel
+    path = config.getoption("--latency-stats")
+    cache = getattr(config, "cache", None)  # Missing with -p no:cacheprovider
+    if path is None and cache is not None:
+        path = str(cache.mkdir("fw-latency") / "stats.json")
+    model = LatencyModel(path)
+    yield model
+    model.save()
+
+
+@pytest.fixture(scope="session")
+def charging_cable(request, device):
+    """Control the charger cable
+
+    When tests are not running the charging cable should be left connected, so
+    that the battery does not drain.
+    """
+    from fw.cable_control import ChargingCable
+    settle_seconds = request.config.getoption("--relay-settle-seconds")
+    if request.config.getoption("--virtual-dut") or request.config.getoption("--replay-capture") is not None:
+        settle_seconds = 0  # No relay to wait for
+    cc = ChargingCable(device.cable_state_file, settle_seconds=settle_seconds)
+    yield cc
+    cc.connect()
+
+
+@pytest.fixture(scope="session")
+def hardware_scheduler():
+    """Run relay switches, DTR toggles and other slow hardware actions in the background"""
+    from fw.hardware_scheduler import HardwareScheduler
+    with HardwareScheduler() as hs:
+        yield hs
+
+
+@pytest.fixture
+def power_cycled(debug_port, charging_cable, restart_detector, boot_state, hardware_scheduler, latency_model):
+    """Make sure DUT is freshly restarted at beginning of test"""
+    _power_cycle(debug_port, charging_cable, restart_detector, boot_state, hardware_scheduler, latency_model)
+
+
+@pytest.fixture
+def warm_booted(request, debug_port, charging_cable, restart_detector, boot_state, hardware_scheduler,
+                latency_model):
+    """Make sure DUT is booted and logged in at beginning of test
+
+    Unlike power_cycled this reuses the DUT as it is if nothing has happened
+    since the last boot that could have changed its state and it still
+    responds to a ping. Otherwise the DUT is power cycled.
+    """
+    import logging
+    logger = logging.getLogger(__name__)
+    reason = boot_state.dirty_reason()
+    if reason is None and _responds_to_ping(debug_port):
+        logger.info("Reusing warm DUT")
+    else:
+        logger.info(f"Power cycling DUT: {reason or 'No response to ping'}")
+        _power_cycle(debug_port, charging_cable, restart_detector, boot_state, hardware_scheduler, latency_model)
+    yield
+    if request.node.stash.get(_TEST_FAILED_KEY, False):
+        boot_state.invalidate("Test failed")
+
+
+def _power_cycle(debug_port, charging_cable, restart_detector, boot_state, hardware_scheduler, latency_model):
+    from fw.bootup import bootup
+    boot_state.invalidate("Power cycle")
+    with restart_detector.allow_restarts(), \
+         debug_port.listen() as lines:
+        disconnected = hardware_scheduler.submit(charging_cable, charging_cable.disconnect)
+        reset = hardware_scheduler.submit(debug_port, debug_port.toggle_dtr, after=[disconnected])
+        # Reconnecting the charger overlaps with the boot
+        connected = hardware_scheduler.submit(charging_cable, charging_cable.connect, after=[reset])
+        reset.result()
+        bootup(debug_port, lines, latency_model=latency_model)
+        connected.result()
+    boot_state.record_boot()
+
+
+def _responds_to_ping(debug_port):
+    from fw.command_runner import CommandRunner
+    from fw.stream import StreamError
+    try:
+        ok, lines = CommandRunner(debug_port).try_run_command("ping", timeout_seconds=3)
+    except StreamError:
+        return False
+    return ok and lines == ["pong"]
+
+
+@pytest.fixture
+def command_runner(debug_port, boot_state, latency_model):
+    """Run commands on the DUT"""
+    from fw.command_runner import CommandRunner
+    cr = CommandRunner(debug_port, command_observer=boot_state.observe_command, latency_model=latency_model)
+    assert cr.run_command("ping") == ["pong"]
+    return cr
+
+
+@pytest.fixture(scope="session")
+def restart_detector(debug_port):
+    from fw.bootup import RestartDetector
+    with RestartDetector(debug_port) as rd:
+        yield rd
+        assert not rd.check_restart_found_and_clear(), "Restart was detected during test"
+
+
+@pytest.fixture
+def watchers(request, debug_port):
+    """The fw.watchers.WatcherRegistry of the debug port
+
+    Watchers added during the test are removed after it. Violations are
+    reported as failures of the test.
+    """
+    registry = debug_port.watchers
+    names = set(registry.names())
+    request.node.stash[_WATCHERS_KEY] = registry
+    yield registry
+    for name in set(registry.names()) - names:
+        registry.remove(name)
+    # Left over when the test failed anyway, or found after it
+    registry.take_violations()
+
+
+@pytest.fixture(scope="session")
+def device_cache(request):
+    """The fw.device_cache.DeviceCache, or None for a virtual DUT, a replay or without the pytest cache
+
+    Record the firmware version of the DUT with 'record_firmware_version'
+    to enable caching.
+    """
+    return _device_cache(request.config)
+
+
+@pytest.fixture(scope="session")
+def boot_state(restart_detector):
+    """Whether the DUT is still in the state left by the last boot"""
+    from fw.bootup import BootState
+    return BootState(restart_detector)
@@ -1,14 +1,82 @@
-from datetime import datetime, timedelta
+from contextlib import contextmanager
+from contextvars import ContextVar
+import time
 
 
-class TimeoutCalculator:
-    """Keeps track of how much time is left"""
+_NANOSECONDS_PER_SECOND = 1_000_000_000
+
+_current_deadline = ContextVar("current_deadline", default=None)
+
+
+class Deadline:
+    """Keeps track of how much time is left
+
+    The deadline is based on time.monotonic_ns, so it is not affected by jumps
+    in the wall-clock time. A timeout of None means waiting forever.
+
+    A Deadline can be passed wherever a timeout in seconds is accepted, so
+    nested operations can share one overall budget.
+    """
+    __slots__ = ("_end_ns",)
+
     def __init__(self, timeout_seconds):
-        self._end_time = datetime.now() + timedelta(seconds=timeout_seconds)
+        if timeout_seconds is None:
+            self._end_ns = None
+        else:
+            self._end_ns = time.monotonic_ns() + int(timeout_seconds * _NANOSECONDS_PER_SECOND)
 
     def time_left_now(self):
-        now = datetime.now()
-        if now > self._end_time:
+        if self._end_ns is None:
+            return None
+        left_ns = self._end_ns - time.monotonic_ns()
+        if left_ns <= 0:
             return 0
         else:
-            return (self._end_time - now).total_seconds()
+            return left_ns / _NANOSECONDS_PER_SECOND
+
+    def expired(self):
+        return self._end_ns is not None and time.monotonic_ns() >= self._end_ns
+
+    def earliest(self, other):
+        """Return whichever of this deadline and another one expires first"""
+        if other is None or other._end_ns is None:
+            return self
+        elif self._end_ns is None or other._end_ns < self._end_ns:
+            return other
+        else:
+            return self
+
+
+def resolve_timeout(timeout):
+    """Turn a timeout into a Deadline that also respects the current deadline
+
+    'timeout' can be a number of seconds, None (no limit) or a Deadline. The
+    returned deadline never expires later than the one set by the innermost
+    enclosing 'deadline' context.
+    """
+    own = timeout if isinstance(timeout, Deadline) else Deadline(timeout)
+    return own.earliest(_current_deadline.get())
+
+
+def current_deadline():
+    """Return the deadline set by the innermost 'deadline' context, or None"""
+    return _current_deadline.get()
+
+
+@contextmanager
+def deadline(timeout_seconds):
+    """Limit the time all stream and command operations in the context may take
+
+    Listener, CommandRunner and bootup take the deadline into account
+    automatically, in addition to their own timeouts. Nested contexts can
+    only make the deadline earlier. The context value is the Deadline.
+
+    The deadline is stored in a context variable, so it applies to the
+    current thread (or asyncio task) only.
+    """
+    new_deadline = resolve_timeout(timeout_seconds)
+    token = _current_deadline.set(new_deadline)
+    try:
+        yield new_deadline
+    finally:
+        _current_deadline.reset(token)
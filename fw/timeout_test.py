@@ -0,0 +1,45 @@
+import time
+
+import pytest
+
+from fw.stream import Dispatcher, Listener, TimeoutError
+from fw.timeout import Deadline, deadline, current_deadline, resolve_timeout
+
+
+def test_deadline_counts_down():
+    d = Deadline(10)
+    assert 9 < d.time_left_now() <= 10
+    assert not d.expired()
+    assert Deadline(0).time_left_now() == 0
+    assert Deadline(None).time_left_now() is None
+
+
+def test_earliest():
+    short = Deadline(1)
+    long = Deadline(10)
+    forever = Deadline(None)
+    assert short.earliest(long) is short
+    assert long.earliest(short) is short
+    assert forever.earliest(short) is short
+    assert short.earliest(forever) is short
+    assert short.earliest(None) is short
+
+
+def test_nested_deadline_contexts():
+    assert current_deadline() is None
+    with deadline(10) as outer:
+        with deadline(100) as inner:
+            assert inner is outer
+        with deadline(1) as inner:
+            assert resolve_timeout(60) is inner
+        assert resolve_timeout(60) is outer
+    assert current_deadline() is None
+
+
+def test_listener_respects_deadline_context():
+    d = Dispatcher()
+    with Listener(d) as lines, deadline(0.05):
+        start = time.monotonic()
+        with pytest.raises(TimeoutError):
+            lines.skip_until("never")
+        assert time.monotonic() - start < 1
@@ -0,0 +1,261 @@
+"""Python model of the firmware in mock_device/mock_device.ino
+
+A VirtualDut behaves like an Arduino running the mock firmware: it boots,
+loads blocks, asks for the password, runs commands (tagged ones too, see
+fw.channels) and restarts when DTR is toggled. Delays pass according to a
+VirtualClock, so a boot can take no time at all. This lets the system tests
+and the harness itself run without hardware.
+"""
+from contextlib import ExitStack
+import logging
+import os
+import selectors
+import threading
+import tty
+
+from fw.framing import LineFramer
+from fw.interface import Port
+from fw.pipe_port import pipe_port_pair
+from fw.stream import EndOfStreamError
+from fw.worker_thread import worker_thread, Waker
+
+
+PASSWORD = "hunter2"
+STARTUP_SECONDS = 3
+BLOCK_COUNT = 10
+BLOCK_SECONDS = 0.2
+LOGIN_DELAY_SECONDS = 0.5
+RESET_SECONDS = 0.5
+POWER_OFF_SECONDS = 3
+
+_RESET = object()  # Unique sentinel value
+
+
+class VirtualClock:
+    """Time as it passes for virtual DUTs
+
+    Delays take 1/'speed' of their real duration. A speed of None makes
+    them take no time at all.
+    """
+    def __init__(self, speed=None):
+        assert speed is None or speed > 0, "Speed must be positive"
+        self._speed = speed
+
+    def sleep(self, seconds, interrupt):
+        """Let 'seconds' of virtual time pass, unless 'interrupt' (a threading.Event) is set first
+
+        Returns whether it was interrupted.
+        """
+        if self._speed is None:
+            return interrupt.is_set()
+        return interrupt.wait(seconds / self._speed)
+
+
+class _Restart(Exception):
+    pass
+
+
+class VirtualDut(ExitStack):
+    """Simulated DUT running the mock firmware
+
+    'port' is the debug port of the DUT. Its 'toggle_dtr' restarts the
+    firmware, like on an Arduino. Lines sent to the DUT while it restarts
+    are lost.
+
+    This class is a context manager.
+    """
+    def __init__(self, clock=None):
+        super().__init__()
+        self._logger = logging.getLogger(__name__ + "." + self.__class__.__name__)
+        self._clock = clock if clock is not None else VirtualClock()
+        self._interrupt = threading.Event()
+        self._stopped = False
+        self._tag = ""
+        self._lines = None
+        external, self._internal = pipe_port_pair()
+        self.enter_context(external)
+        self.enter_context(self._internal)
+        self.port = _VirtualDutPort(self, external)
+        self.enter_context(worker_thread(self._run_firmware, stop_function=self._stop))
+
+    def _stop(self):
+        self._stopped = True
+        self._interrupt.set()
+        self._internal.close()
+
+    def restart(self):
+        """Restart the firmware, like toggling DTR does"""
+        self._logger.debug("restart")
+        self._interrupt.set()
+        # Wakes up the firmware if it is waiting for input
+        self.port.send(_RESET)
+
+    def _run_firmware(self, signal_thread_ready):
+        signal_thread_ready()
+        while not self._stopped:
+            self._interrupt.clear()
+            try:
+                with self._internal.listen() as lines:
+                    self._lines = lines
+                    # Like the Arduino loop() function
+                    while True:
+                        self._startup()
+                        self._delay(LOGIN_DELAY_SECONDS)
+                        self._authenticate()
+                        self._run_commands()
+            except _Restart:
+                pass
+            except EndOfStreamError:
+                return
+
+    def _delay(self, seconds):
+        if self._clock.sleep(seconds, self._interrupt):
+            raise _Restart()
+
+    def _println(self, line):
+        self._internal.send(line)
+
+    def _reply(self, line):
+        self._println(self._tag + line)
+
+    def _read_line(self):
+        while True:
+            line = self._lines.next(timeout_seconds=None)
+            if line is _RESET or self._interrupt.is_set():
+                raise _Restart()
+            line = line.strip()
+            if line:
+                self._println(line)
+                return line
+
+    def _startup(self):
+        self._println("Booting...")
+        self._delay(STARTUP_SECONDS)
+        self._println("Loading blocks...")
+        for i in range(BLOCK_COUNT):
+            self._delay(BLOCK_SECONDS)
+            self._println(f"Block {i} loaded")
+        self._println("Starting user space")
+
+    def _authenticate(self):
+        while True:
+            self._println("Enter secret password")
+            if self._read_line() == PASSWORD:
+                self._println("Logged in")
+                return
+            self._println("Wrong password")
+
+    def _run_commands(self):
+        self._println("Enter command")
+        while True:
+            command = self._take_tag(self._read_line())
+            result = self._run_command(command)
+            if result is None:
+                self._reply("OK")
+                self._tag = ""
+                self._println("Powering off...")
+                self._delay(POWER_OFF_SECONDS)
+                return
+            self._reply("OK" if result else "ERROR")
+            self._reply("Enter command")
+            self._tag = ""
+
+    def _run_command(self, command):
+        """Return True if the command succeeded, False if it failed or None to power off"""
+        if command == "ping":
+            self._reply("pong")
+        elif command == "version":
+            self._reply("v1.0")
+        elif command == "reset":
+            self._reply("Resetting...")
+            self._delay(RESET_SECONDS)
+            self._reply("Reset complete")
+            return None
+        elif command == "calculate":
+            self._reply("42")
+        else:
+            self._reply("Unknown command")
+            return False
+        return True
+
+    def _take_tag(self, line):
+        self._tag = ""
+        if line.startswith("@"):
+            space = line.find(" ")
+            if space > 1:
+                self._tag = line[:space + 1]
+                return line[space + 1:]
+        return line
+
+
+class _VirtualDutPort(Port):
+    def __init__(self, dut, port):
+        self._dut = dut
+        self._port = port
+
+    def send(self, value):
+        self._port.send(value)
+
+    def listen(self, since=None):
+        return self._port.listen(since)
+
+    @property
+    def watchers(self):
+        return self._port.watchers
+
+    def toggle_dtr(self):
+        self._dut.restart()
+
+    def close(self):
+        self._dut.close()
+
+
+class PtyVirtualDut(ExitStack):
+    """VirtualDut behind a pseudo terminal at 'device_path'
+
+    The device can be opened like a serial port, for example by
+    fw.serial_port.SerialPort. Lines from the DUT end with "\\r\\n", like
+    Serial.println does. Like on a real serial line, output is lost while
+    nobody reads the device. A pseudo terminal has no DTR line, so toggling
+    DTR on it does not restart the DUT.
+
+    This class is a context manager.
+    """
+    def __init__(self, clock=None):
+        super().__init__()
+        self._dut = self.enter_context(VirtualDut(clock))
+        self._framer = LineFramer()
+        self._controller_fd, device_fd = os.openpty()
+        os.set_blocking(self._controller_fd, False)
+        self.callback(os.close, self._controller_fd)
+        self.callback(os.close, device_fd)  # Keeps the device side usable
+        tty.setraw(device_fd)
+        self.device_path = os.ttyname(device_fd)
+        self._waker = self.enter_context(Waker())
+        self.enter_context(worker_thread(self._forward_output, stop_function=self._dut.close))
+        self.enter_context(worker_thread(self._forward_input, stop_function=self._waker.wake))
+
+    def _forward_input(self, signal_thread_ready):
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._controller_fd, selectors.EVENT_READ)
+            selector.register(self._waker, selectors.EVENT_READ)
+            signal_thread_ready()
+            while True:
+                ready = [key.fileobj for key, _ in selector.select()]
+                if self._waker in ready:
+                    return
+                for line in self._framer.feed(os.read(self._controller_fd, 4096)):
+                    self._dut.port.send(line)
+
+    def _forward_output(self, signal_thread_ready):
+        try:
+            with self._dut.port.listen() as lines:
+                signal_thread_ready()
+                while True:
+                    line = lines.next(timeout_seconds=None)
+                    try:
+                        os.write(self._controller_fd, line.encode("utf8") + b"\r\n")
+                    except BlockingIOError:
+                        pass  # Nobody is reading
+        except EndOfStreamError:
+            pass
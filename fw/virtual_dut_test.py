@@ -0,0 +1,76 @@
+import os
+import select
+import time
+
+from fw.bootup import bootup, RestartDetector
+from fw.command_runner import CommandRunner
+from fw.virtual_dut import VirtualDut, VirtualClock, PtyVirtualDut, STARTUP_SECONDS, BLOCK_COUNT, BLOCK_SECONDS
+
+
+TEST_TIMEOUT_SECONDS = 1  # Should be instant in unit tests
+
+
+def booted(dut):
+    with dut.port.listen() as lines:
+        dut.port.toggle_dtr()
+        bootup(dut.port, lines, timeout_seconds=TEST_TIMEOUT_SECONDS)
+
+
+def test_boot_and_run_commands():
+    with VirtualDut() as dut:
+        booted(dut)
+        cr = CommandRunner(dut.port)
+        assert cr.run_command("version", timeout_seconds=TEST_TIMEOUT_SECONDS) == ["v1.0"]
+        assert cr.try_run_command("bogus", timeout_seconds=TEST_TIMEOUT_SECONDS) == (False, ["Unknown command"])
+
+
+def test_reset_command_powers_off_and_boots_again():
+    with VirtualDut() as dut, \
+         dut.port.listen() as lines:
+        booted(dut)
+        dut.port.send("reset")
+        lines.skip_until("Powering off...", TEST_TIMEOUT_SECONDS)
+        lines.skip_until("Booting...", TEST_TIMEOUT_SECONDS)
+
+
+def test_toggle_dtr_restarts_in_the_middle_of_boot():
+    with VirtualDut(VirtualClock(speed=10)) as dut, \
+         RestartDetector(dut.port) as restart_detector:
+        with restart_detector.allow_restarts():
+            booted(dut)
+        with dut.port.listen() as lines:
+            dut.port.toggle_dtr()
+            lines.expect_next("Booting...", TEST_TIMEOUT_SECONDS)
+            dut.port.toggle_dtr()
+            lines.expect_next("Booting...", TEST_TIMEOUT_SECONDS)
+        assert restart_detector.check_restart_found_and_clear()
+
+
+def test_clock_speed():
+    with VirtualDut(VirtualClock(speed=100)) as dut, \
+         dut.port.listen() as lines:
+        start = time.monotonic()
+        dut.port.toggle_dtr()
+        lines.skip_until("Starting user space", TEST_TIMEOUT_SECONDS)
+        assert time.monotonic() - start >= (STARTUP_SECONDS + BLOCK_COUNT * BLOCK_SECONDS) / 100
+
+
+def read_lines(fd, count):
+    data = b""
+    end = time.monotonic() + TEST_TIMEOUT_SECONDS
+    while data.count(b"\r\n") < count:
+        assert select.select([fd], [], [], max(0, end - time.monotonic()))[0], f"Timed out, got {data!r}"
+        data += os.read(fd, 4096)
+    return data.decode("utf8").split("\r\n")[:count]
+
+
+def test_pty():
+    with PtyVirtualDut() as dut:
+        fd = os.open(dut.device_path, os.O_RDWR | os.O_NOCTTY)
+        try:
+            os.write(fd, b"hunter2\n")
+            assert read_lines(fd, 3) == ["hunter2", "Logged in", "Enter command"]
+            os.write(fd, b"ping\n")
+            assert read_lines(fd, 4) == ["ping", "pong", "OK", "Enter command"]
+        finally:
+            os.close(fd)
@@ -0,0 +1,130 @@
+from collections import namedtuple
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+from fw.matcher import Matcher
+
+
+Violation = namedtuple("Violation", ["name", "value", "timestamp"])
+Violation.__doc__ = """A value that matched a forbidden watcher while it was not allowed
+
+'timestamp' is the time.time() when the value was received.
+"""
+
+
+class _Watcher:
+    __slots__ = ("name", "pattern", "matcher", "callback", "forbidden", "allowed", "match_count")
+
+    def __init__(self, name, pattern, callback, forbidden):
+        self.name = name
+        self.pattern = pattern
+        self.matcher = Matcher(pattern)
+        self.callback = callback
+        self.forbidden = forbidden
+        self.allowed = 0  # Nesting depth of 'allow' contexts
+        self.match_count = 0
+
+
+class WatcherRegistry:
+    """Named patterns that every value of a dispatcher is checked against
+
+    The check runs in 'dispatch', on the thread that receives the values, so
+    watchers need no threads, listeners or buffers of their own. All patterns
+    are combined into one fw.matcher.Matcher, so a value that matches none of
+    them is checked in one pass. A value that does match is checked against
+    each watcher, so every watcher that matches it sees it.
+
+    A watcher can call a callback with (name, value) on each match. Callbacks
+    run on the receiving thread and must be quick. Exceptions from them are
+    logged, so that they do not stop the receiving thread. A forbidden watcher
+    records each match as a Violation, unless it is inside an 'allow' context
+    for that watcher. 'take_violations' returns and clears them.
+
+    All methods are thread safe.
+    """
+    def __init__(self):
+        self._logger = logging.getLogger(__name__ + "." + self.__class__.__name__)
+        self._lock = threading.Lock()
+        self._watchers = {}  # name -> _Watcher
+        self._violations = []
+        self._checked = (None, [])  # (Matcher, watchers), replaced as a whole so 'check' needs no lock for it
+
+    def add(self, name, pattern, callback=None, forbidden=False):
+        """Start watching for values that match 'pattern' (a single fw.matcher pattern)"""
+        with self._lock:
+            assert name not in self._watchers, f"Watcher {name} already exists"
+            self._watchers[name] = _Watcher(name, pattern, callback, forbidden)
+            self._rebuild()
+
+    def remove(self, name):
+        with self._lock:
+            del self._watchers[name]
+            self._rebuild()
+
+    def _rebuild(self):
+        watchers = list(self._watchers.values())
+        self._checked = (Matcher(*(watcher.pattern for watcher in watchers)) if watchers else None, watchers)
+
+    @contextmanager
+    def watch(self, name, pattern, callback=None, forbidden=False):
+        """Watch for values that match 'pattern' within the context"""
+        self.add(name, pattern, callback, forbidden)
+        try:
+            yield
+        finally:
+            self.remove(name)
+
+    def names(self):
+        with self._lock:
+            return list(self._watchers)
+
+    def match_count(self, name):
+        """Number of values that matched the watcher, both allowed and forbidden ones"""
+        with self._lock:
+            return self._watchers[name].match_count
+
+    @contextmanager
+    def allow(self, name):
+        """Do not count matches of a forbidden watcher as violations within the context"""
+        with self._lock:
+            self._watchers[name].allowed += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                watcher = self._watchers.get(name)
+                if watcher is not None:
+                    watcher.allowed -= 1
+
+    def take_violations(self, name=None):
+        """Return and clear the violations, of all watchers or only the named one"""
+        with self._lock:
+            taken = [violation for violation in self._violations if name is None or violation.name == name]
+            self._violations = [violation for violation in self._violations
+                                if name is not None and violation.name != name]
+            return taken
+
+    def check(self, value):
+        """Check a value against all watchers. Called by the dispatcher for each value."""
+        matcher, watchers = self._checked
+        if matcher is None or not isinstance(value, str) or matcher.match(value) is None:
+            return
+        matched = [watcher for watcher in watchers if watcher.matcher.match(value) is not None]
+        callbacks = []
+        with self._lock:
+            for watcher in matched:
+                if self._watchers.get(watcher.name) is not watcher:
+                    continue  # Removed meanwhile
+                watcher.match_count += 1
+                if watcher.forbidden and not watcher.allowed:
+                    self._logger.error(f"{watcher.name}: {value}")
+                    self._violations.append(Violation(watcher.name, value, time.time()))
+                if watcher.callback is not None:
+                    callbacks.append((watcher.name, watcher.callback))
+        for name, callback in callbacks:
+            try:
+                callback(name, value)
+            except Exception:
+                self._logger.exception(f"Callback of watcher {name} failed on: {value}")
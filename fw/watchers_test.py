@@ -0,0 +1,96 @@
+import re
+
+from fw.bootup import RestartDetector
+from fw.matcher import Prefix
+from fw.pipe_port import pipe_port_pair
+from fw.stream import Dispatcher, Listener
+from fw.watchers import WatcherRegistry
+
+
+TEST_TIMEOUT_SECONDS = 1  # Should be instant in unit tests
+
+
+def test_all_watchers_are_checked_in_one_pass():
+    registry = WatcherRegistry()
+    seen = []
+    registry.add("panic", Prefix("PANIC"), callback=lambda name, value: seen.append((name, value)))
+    registry.add("watchdog", re.compile("watchdog reset"), callback=lambda name, value: seen.append((name, value)))
+    registry.add("assert", "assertion failed")
+    for value in ["Booting...", "PANIC: oops", "after watchdog reset", "assertion failed", None]:
+        registry.check(value)
+    assert seen == [("panic", "PANIC: oops"), ("watchdog", "after watchdog reset")]
+    assert [registry.match_count(name) for name in ["panic", "watchdog", "assert"]] == [1, 1, 1]
+    assert registry.take_violations() == []
+
+
+def test_every_matching_watcher_sees_the_value():
+    registry = WatcherRegistry()
+    seen = []
+    registry.add("restart", "Booting...", callback=lambda name, value: seen.append(name))
+    registry.add("boot_log", "Booting...", callback=lambda name, value: seen.append(name))
+    registry.add("any_boot", Prefix("Boot"), forbidden=True)
+    registry.check("Booting...")
+    assert seen == ["restart", "boot_log"]
+    assert [registry.match_count(name) for name in ["restart", "boot_log", "any_boot"]] == [1, 1, 1]
+    assert [v.name for v in registry.take_violations()] == ["any_boot"]
+
+
+def test_failing_callback_does_not_stop_dispatch():
+    dispatcher = Dispatcher()
+    def fail(name, value):
+        raise RuntimeError("callback failed")
+    dispatcher.watchers.add("restart", "Booting...", callback=fail)
+    with Listener(dispatcher) as lines:
+        dispatcher.dispatch("Booting...")
+        lines.expect_next("Booting...", TEST_TIMEOUT_SECONDS)
+    assert dispatcher.watchers.match_count("restart") == 1
+
+
+def test_forbidden_matches_are_violations_unless_allowed():
+    registry = WatcherRegistry()
+    registry.add("panic", Prefix("PANIC"), forbidden=True)
+    registry.add("restart", "Booting...", forbidden=True)
+    registry.check("PANIC: first")
+    with registry.allow("panic"):
+        with registry.allow("panic"):
+            registry.check("PANIC: allowed")
+        registry.check("PANIC: still allowed")
+    registry.check("Booting...")
+    assert [v.value for v in registry.take_violations("restart")] == ["Booting..."]
+    assert [(v.name, v.value) for v in registry.take_violations()] == [("panic", "PANIC: first")]
+    assert registry.take_violations() == []
+    assert registry.match_count("panic") == 3
+
+
+def test_removed_watcher_no_longer_matches():
+    registry = WatcherRegistry()
+    with registry.watch("panic", Prefix("PANIC"), forbidden=True):
+        assert registry.names() == ["panic"]
+    registry.check("PANIC: oops")
+    assert registry.names() == []
+    assert registry.take_violations() == []
+
+
+def test_dispatcher_checks_values_before_listeners_see_them():
+    dispatcher = Dispatcher()
+    positions = []
+    dispatcher.watchers.add("restart", "Booting...",
+                            callback=lambda name, value: positions.append(dispatcher.position))
+    with Listener(dispatcher) as lines:
+        dispatcher.dispatch("Booting...")
+        lines.expect_next("Booting...", TEST_TIMEOUT_SECONDS)
+    assert positions == [0]
+
+
+def test_restart_detector_uses_port_watchers():
+    a, b = pipe_port_pair()
+    with a, b, RestartDetector(b) as restart_detector:
+        with restart_detector.allow_restarts():
+            a.send("Booting...")
+        assert restart_detector.restart_count == 1
+        assert not restart_detector.check_restart_found_and_clear()
+        a.send("Booting...")
+        assert restart_detector.restart_count == 2
+        assert restart_detector.check_restart_found_and_clear()
+        assert not restart_detector.check_restart_found_and_clear()
+    assert b.watchers.names() == []
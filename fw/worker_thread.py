@@ -1,5 +1,6 @@
 from contextlib import contextmanager
 import logging
+import os
 import threading
 
 
@@ -40,3 +41,34 @@ def worker_thread(worker_function, stop_function=None):
             except Exception as e:
                 logger.error("Error when stopping worker thread", exc_info=e)
         thread.join()
+
+
+class Waker:
+    """Self-pipe for waking up a thread that waits with select
+
+    Register this object with a selector next to the file descriptors the
+    thread waits for. 'wake' makes it readable, from any thread. That lets
+    the thread wait without a timeout and still stop right away when asked.
+
+    This class is a context manager. Exiting it closes the pipe.
+    """
+    def __init__(self):
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._write_fd, False)
+
+    def fileno(self):
+        return self._read_fd
+
+    def wake(self):
+        try:
+            os.write(self._write_fd, b"\0")
+        except BlockingIOError:
+            pass  # Already awake
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+        return False
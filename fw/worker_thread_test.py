@@ -0,0 +1,43 @@
+import os
+import selectors
+import time
+
+from fw.worker_thread import worker_thread, Waker
+
+
+TEST_TIMEOUT_SECONDS = 1  # Should be instant in unit tests
+
+
+def test_waker_stops_selecting_thread_right_away():
+    read_fd, write_fd = os.pipe()
+    received = []
+    def read_until_woken(waker, signal_thread_ready):
+        with selectors.DefaultSelector() as selector:
+            selector.register(read_fd, selectors.EVENT_READ)
+            selector.register(waker, selectors.EVENT_READ)
+            signal_thread_ready()
+            while True:
+                ready = [key.fileobj for key, _ in selector.select()]
+                if waker in ready:
+                    return
+                received.append(os.read(read_fd, 100))
+    try:
+        with Waker() as waker:
+            with worker_thread(lambda ready: read_until_woken(waker, ready), stop_function=waker.wake):
+                os.write(write_fd, b"data")
+                end = time.monotonic() + TEST_TIMEOUT_SECONDS
+                while not received and time.monotonic() < end:
+                    time.sleep(0.001)
+                start = time.monotonic()
+            assert time.monotonic() - start < 0.1
+        assert received == [b"data"]
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+def test_waking_twice_is_harmless():
+    with Waker() as waker:
+        waker.wake()
+        waker.wake()
+        assert os.read(waker.fileno(), 100) == b"\0\0"
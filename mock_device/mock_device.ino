@@ -4,6 +4,11 @@ enum Result {
   EXIT
 };
 
+// Tag of the command being run, like "@3 ", or "" for an untagged command.
+// Each line of the response and the prompt after it get the same tag, so
+// that the host can route them to the channel that sent the command.
+String tag = "";
+
 void setup() {
   Serial.begin(115200);
 }
@@ -42,44 +47,65 @@ void startup() {
 }
 
 bool run_commands() {
+  Serial.println("Enter command");
   while (true) {
-    Serial.println("Enter command");
-    String command = read_line();
+    String command = take_tag(read_line());
     Result result = run_command(command);
     if (result == OK) {
-      Serial.println("OK");
+      reply("OK");
     } else if (result == ERR) {
-      Serial.println("ERROR");
+      reply("ERROR");
     } else {
-      Serial.println("OK");
+      reply("OK");
+      tag = "";
       Serial.println("Powering off...");
       delay(3000);
       return;
     }
+    reply("Enter command");
+    tag = "";
   }
 }
 
 Result run_command(String command) {
   if (command == "ping") {
-    Serial.println("pong");
+    reply("pong");
     return OK;
   } else if (command == "version") {
-    Serial.println("v1.0");
+    reply("v1.0");
     return OK;
   } else if (command == "reset") {
-    Serial.println("Resetting...");
+    reply("Resetting...");
     delay(500);
-    Serial.println("Reset complete");
+    reply("Reset complete");
     return EXIT;
   } else if (command == "calculate") {
-    Serial.println("42");
+    reply("42");
     return OK;
   } else {
-    Serial.println("Unknown command");
+    reply("Unknown command");
     return ERR;
   }
 }
 
+// Remember the tag of a line like "@3 ping" and return the rest of it
+String take_tag(String line) {
+  tag = "";
+  if (line.startsWith("@")) {
+    int space = line.indexOf(' ');
+    if (space > 1) {
+      tag = line.substring(0, space + 1);
+      return line.substring(space + 1);
+    }
+  }
+  return line;
+}
+
+void reply(String line) {
+  Serial.print(tag);
+  Serial.println(line);
+}
+
 String read_line() {
   String line = "";
   while (line == "") {
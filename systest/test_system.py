@@ -2,11 +2,15 @@ import pytest
 
 
 @pytest.mark.initialize
-def test_boot(power_cycled, command_runner):
-    print(command_runner.run_command("version"))
+def test_boot(power_cycled, command_runner, device_cache):
+    [version] = command_runner.run_command("version")
+    print(version)
+    if device_cache is not None:
+        device_cache.record_firmware_version(version)
 
 
 @pytest.mark.features
+@pytest.mark.device_cache
 def test_calculate(command_runner):
     assert command_runner.run_command("calculate") == ["42"]
 
@@ -15,3 +19,9 @@ def test_unexpected_restart(debug_port):
     with debug_port.listen() as lines:
         debug_port.toggle_dtr()
         lines.skip_until("Loading blocks...")
+
+
+@pytest.mark.features
+@pytest.mark.device_cache
+def test_version_on_warm_dut(warm_booted, command_runner):
+    assert command_runner.run_command("version") == ["v1.0"]